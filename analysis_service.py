@@ -0,0 +1,301 @@
+import argparse
+import hashlib
+import json
+import os
+import re
+import threading
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+import pandas as pd
+from backends import available_backends
+from batch_profiling import profile_file, paired_file
+from ingestion import DATA_FILE_TYPES, file_extension
+from paired_engine import STDS
+from pipeline import file_fingerprint, fingerprint
+
+
+HOST = '127.0.0.1'
+PORT = 8765
+RESULT_CACHE_SIZE = 32
+MAX_PENDING = 64  # requests running or queued on the pool, more are refused with 503
+MAX_UPLOAD_BYTES = 1 << 30
+UPLOAD_BLOCK = 1 << 20
+FILE_ID = re.compile(r'^[0-9a-f]{40}\.[a-z]+$')
+PROFILE_DEFAULTS = {'groups': None, 'control_group': None, 'params': None, 'directions': None,
+                    'mean_difference': 0.3, 'deviation_difference': 0.3, 'sd': None,
+                    'permutations': 0, 'bootstraps': 0, 'seed': 0, 'backend': 'pandas'}
+PAIRED_DEFAULTS = {'stds': [1.0], 'contrasts': None, 'backend': 'pandas'}
+# json type of every setting: a number, an integer, a string, a list of numbers / strings, a list of [string, string]
+# pairs or a {string: string} object. settings that default to None may also be null
+SETTING_TYPES = {'groups': 'strings', 'control_group': 'string', 'params': 'strings', 'directions': 'object',
+                 'mean_difference': 'number', 'deviation_difference': 'number', 'sd': 'number',
+                 'permutations': 'integer', 'bootstraps': 'integer', 'seed': 'integer', 'stds': 'numbers',
+                 'contrasts': 'pairs', 'backend': 'string'}
+TYPE_NAMES = {'number': 'a number', 'integer': 'an integer', 'string': 'a string', 'strings': 'a list of strings',
+              'numbers': 'a list of numbers', 'pairs': 'a list of [earlier, later] sessions',
+              'object': 'an object of strings'}
+
+
+class RequestError(Exception):
+    # a request the service refuses, with its http status
+
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+def table_json(table, orient='split'):
+    # a table as json ready python objects, nan as null
+    return table.astype(object).where(table.notna(), None).to_dict(orient=orient)
+
+
+def encoded(response):
+    # numpy numbers (e.g. of an index) are written as python numbers, exactly
+    return json.dumps(response, default=lambda value: value.item()).encode('utf-8')
+
+
+def profile_job(data_path, settings):
+    # worker process: the behavioral profiling of one file, as the encoded json response
+    loaded, effects, max_of_max, true_columns, final_table = profile_file(data_path, None, settings)
+    return encoded({'max_of_max': table_json(pd.DataFrame(max_of_max, index=[0]), 'records')[0],
+                    'curves': table_json(true_columns),
+                    'final_table': table_json(final_table, 'records')})
+
+
+def paired_job(data_path, settings):
+    # worker process: the paired differences analysis of one file, as the encoded json response. a file of two
+    # sessions is answered with its percentages and affected tables, longitudinal files and requests with contrasts
+    # with a list of them per contrast
+    stds = [std for std in STDS if std in settings['stds']]
+    if not stds:
+        raise ValueError('stds must be some of ' + ', '.join(str(std) for std in STDS))
+    contrasts = paired_file(data_path, stds, settings['backend'], settings['contrasts'])
+    responses = [{'earlier': earlier, 'later': later, 'percentages': table_json(std_df),
+                  'affected': {str(std): table_json(table) for std, table in affected_tables.items()}}
+                 for (earlier, later), (affected_tables, std_df) in contrasts.items()]
+    if len(responses) == 1 and not settings['contrasts']:
+        return encoded({'percentages': responses[0]['percentages'], 'affected': responses[0]['affected']})
+    return encoded({'contrasts': responses})
+
+
+def is_number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+def has_type(value, setting_type):
+    if setting_type == 'number':
+        return is_number(value)
+    if setting_type == 'integer':
+        return isinstance(value, int) and not isinstance(value, bool)
+    if setting_type == 'string':
+        return isinstance(value, str)
+    if setting_type == 'strings':
+        return isinstance(value, list) and all(isinstance(item, str) for item in value)
+    if setting_type == 'numbers':
+        return isinstance(value, list) and all(is_number(item) for item in value)
+    if setting_type == 'pairs':
+        return isinstance(value, list) and all(isinstance(pair, list) and len(pair) == 2 and
+                                               all(isinstance(item, str) for item in pair) for pair in value)
+    return isinstance(value, dict) and all(isinstance(item, str) for item in value.values())
+
+
+def request_settings(payload, defaults):
+    # the settings of a request with the defaults filled in, unknown settings and settings of the wrong type are
+    # refused
+    unknown = sorted(set(payload) - set(defaults) - {'file_id', 'path'})
+    if unknown:
+        raise RequestError(400, 'unknown settings: ' + ', '.join(unknown))
+    settings = {name: payload.get(name, default) for name, default in defaults.items()}
+    for name, value in settings.items():
+        if not (value is None and defaults[name] is None) and not has_type(value, SETTING_TYPES[name]):
+            raise RequestError(400, name + ' must be ' + TYPE_NAMES[SETTING_TYPES[name]])
+    if settings['backend'] not in available_backends():
+        raise RequestError(400, 'backend must be one of ' + ', '.join(available_backends()))
+    return settings
+
+
+class AnalysisService:
+    # analyses on a bounded process pool. identical requests (same file content and settings) that are in flight
+    # share one job, and the encoded responses of the last cache_size requests are kept
+
+    def __init__(self, upload_dir, data_dir=None, workers=None, cache_size=RESULT_CACHE_SIZE,
+                 max_pending=MAX_PENDING):
+        self.upload_dir = upload_dir
+        self.data_dir = data_dir
+        self.workers = workers or os.cpu_count()
+        self.cache_size = cache_size
+        self.max_pending = max_pending
+        self.executor = ProcessPoolExecutor(self.workers)
+        self.results = OrderedDict()
+        self.in_flight = {}
+        self.lock = threading.RLock()  # a finished future runs its callback in the submitting thread
+        os.makedirs(upload_dir, exist_ok=True)
+
+    def upload(self, stream, length, name):
+        # store an uploaded data file under its content hash, the same content is stored once
+        extension = file_extension(name)
+        if extension[1:] not in DATA_FILE_TYPES:
+            raise RequestError(400, 'data files must be one of ' + ', '.join(DATA_FILE_TYPES))
+        if length > MAX_UPLOAD_BYTES:
+            raise RequestError(413, 'data files are limited to ' + str(MAX_UPLOAD_BYTES) + ' bytes')
+        digest = hashlib.sha1()
+        temporary_path = os.path.join(self.upload_dir, 'upload_' + str(threading.get_ident()) + '.tmp')
+        received = 0
+        with open(temporary_path, 'wb') as file:
+            while received < length:
+                block = stream.read(min(UPLOAD_BLOCK, length - received))
+                if not block:
+                    break
+                received += len(block)
+                digest.update(block)
+                file.write(block)
+        if not received or received < length:
+            os.remove(temporary_path)
+            raise RequestError(400, 'the upload is empty or incomplete')
+        file_id = digest.hexdigest() + extension
+        os.replace(temporary_path, os.path.join(self.upload_dir, file_id))
+        return {'file_id': file_id}
+
+    def data_path(self, payload):
+        # the uploaded file of 'file_id', or 'path' under the data folder
+        if payload.get('file_id'):
+            file_id = str(payload['file_id'])
+            path = os.path.join(self.upload_dir, file_id)
+            if not FILE_ID.match(file_id) or not os.path.isfile(path):
+                raise RequestError(404, 'no uploaded file ' + file_id)
+            return path, file_id[:40]
+        if payload.get('path') and self.data_dir:
+            root = os.path.realpath(self.data_dir)
+            path = os.path.realpath(os.path.join(root, str(payload['path'])))
+            if not path.startswith(root + os.sep) or not os.path.isfile(path):
+                raise RequestError(404, 'no data file ' + str(payload['path']))
+            return path, file_fingerprint(path)
+        raise RequestError(400, 'a file_id' + (' or a path' if self.data_dir else '') + ' is required')
+
+    def run(self, job, payload, defaults):
+        # the encoded response of a request, from the cache, an identical request in flight or a new job
+        data_path, content_key = self.data_path(payload)
+        settings = request_settings(payload, defaults)
+        key = fingerprint(job.__name__, content_key, settings)
+        with self.lock:
+            if key in self.results:
+                self.results.move_to_end(key)
+                return self.results[key]
+            future = self.in_flight.get(key)
+            if future is None:
+                if len(self.in_flight) >= self.max_pending:
+                    raise RequestError(503, 'too many requests in progress')
+                future = self.executor.submit(job, data_path, settings)
+                self.in_flight[key] = future
+                future.add_done_callback(lambda done: self.finished(key, done))
+        # the errors of a job are returned without the server side path of the data file
+        try:
+            return future.result()
+        except ValueError as error:  # settings that do not fit the data
+            raise RequestError(400, str(error).replace(data_path, 'the data file'))
+        except Exception as error:
+            raise RequestError(500, type(error).__name__ + ': ' + str(error).replace(data_path, 'the data file'))
+
+    def finished(self, key, future):
+        with self.lock:
+            self.in_flight.pop(key, None)
+            if not future.cancelled() and future.exception() is None:
+                self.results[key] = future.result()
+                while len(self.results) > self.cache_size:
+                    self.results.popitem(last=False)
+
+    def health(self):
+        with self.lock:
+            return {'status': 'ok', 'workers': self.workers, 'in flight': len(self.in_flight),
+                    'cached': len(self.results)}
+
+    def shutdown(self):
+        self.executor.shutdown(cancel_futures=True)
+
+
+class ServiceHandler(BaseHTTPRequestHandler):
+    # GET /health, POST /upload?name=<file name> with the file as the body, POST /profile and POST /paired with a
+    # json body of a file_id (or path) and the analysis settings of PROFILE_DEFAULTS / PAIRED_DEFAULTS. the
+    # mean / deviation differences are fractions, as in batch_profiling's settings, backend is the engine of the
+    # loading, statistics and scores and contrasts are [earlier, later] session pairs, e.g. ['group_0', 'group_2']
+
+    def do_GET(self):
+        if urlparse(self.path).path == '/health':
+            self.respond(200, json.dumps(self.server.service.health()).encode('utf-8'))
+        else:
+            self.respond_error(RequestError(404, 'unknown endpoint'))
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        service = self.server.service
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            if url.path == '/upload':
+                name = parse_qs(url.query).get('name', ['data.csv'])[0]
+                body = json.dumps(service.upload(self.rfile, length, name)).encode('utf-8')
+            elif url.path in ('/profile', '/paired'):
+                try:
+                    payload = json.loads(self.rfile.read(length) or b'{}')
+                except ValueError:
+                    raise RequestError(400, 'the request body must be json')
+                if not isinstance(payload, dict):
+                    raise RequestError(400, 'the request body must be a json object')
+                if url.path == '/profile':
+                    body = service.run(profile_job, payload, PROFILE_DEFAULTS)
+                else:
+                    body = service.run(paired_job, payload, PAIRED_DEFAULTS)
+            else:
+                raise RequestError(404, 'unknown endpoint')
+        except RequestError as error:
+            self.respond_error(error)
+            return
+        except Exception as error:
+            self.respond_error(RequestError(500, type(error).__name__ + ': ' + str(error)))
+            return
+        self.respond(200, body)
+
+    def respond(self, status, body):
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def respond_error(self, error):
+        self.respond(error.status, json.dumps({'error': str(error)}).encode('utf-8'))
+
+
+def serve(service, host=HOST, port=PORT):
+    server = ThreadingHTTPServer((host, port), ServiceHandler)
+    server.daemon_threads = True
+    server.service = service
+    return server
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description='Serve the behavioral profiling and paired analysis over http')
+    parser.add_argument('--host', default=HOST, help='address to listen on')
+    parser.add_argument('--port', type=int, default=PORT, help='port to listen on')
+    parser.add_argument('--upload-dir', default='service_uploads', help='folder of the uploaded data files')
+    parser.add_argument('--data-dir', help='folder of data files that requests may refer to by a relative path')
+    parser.add_argument('--cache-size', type=int, default=RESULT_CACHE_SIZE, help='number of responses to keep')
+    parser.add_argument('-j', '--workers', type=int, help='number of worker processes. defaults to the CPU count')
+    args = parser.parse_args(args)
+
+    service = AnalysisService(args.upload_dir, args.data_dir, args.workers, args.cache_size)
+    server = serve(service, args.host, args.port)
+    print('serving on http://' + args.host + ':' + str(args.port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.shutdown()
+    return 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -0,0 +1,193 @@
+import numpy as np
+import pandas as pd
+from ingestion import ARROW_EXTENSIONS, PARQUET_EXTENSIONS, file_extension, frame_statistics, ingest
+from paired_engine import classify_paired_diffs, paired_differences
+from profiling_engine import z_score_matrix, directional_scores, group_indices, count_thresholds
+
+# the core computations behind one interface, so a columnar engine can run them on cohorts too large for pandas.
+# the pipeline loads the data files and computes their statistics and directional scores with the selected backend,
+# on the backend's own frame. pandas frames are built only for the stages and widgets that need one:
+#   load(data_file)                                       -> (the backend's frame, parameters numeric (nan when not),
+#                                                             its group statistics)
+#   to_pandas(data)                                       -> the frame as pandas
+#   select(data, columns)                                 -> the columns of the frame as pandas
+#   columns(data)                                         -> column names, group, subject and the parameters
+#   group_statistics(data, group_col, params)             -> ingestion.OnlineGroupStats.statistics layout
+#   directional_scores(data, group_col, params, directions, control_mean, control_std)
+#                                                         -> (group values, subjects x parameters scores array)
+#   thresholds(data, group_col, groups, params, directions, control_mean, control_std, counts)
+#                                                         -> profiling_engine.count_thresholds of the groups' values
+#   paired_task_sums(data, group_col, subject_col, task_groups, std)
+#                                                         -> subjects x tasks affected counts of the paired analysis
+# data may also be a pandas frame. results are pandas / numpy in every backend, so they can be compared with the
+# pandas reference. the frames of a lazy backend are queries of the data file
+
+BACKENDS = ['pandas', 'polars']
+
+
+class PandasBackend:
+    # the reference implementation: chunked ingestion with online group statistics and numpy scores
+
+    name = 'pandas'
+    lazy = False
+
+    def load(self, data_file):
+        return ingest(data_file)
+
+    def to_pandas(self, data):
+        return data
+
+    def select(self, data, columns):
+        return data[list(columns)]
+
+    def columns(self, data):
+        return list(data.columns)
+
+    def group_statistics(self, data, group_col, params):
+        return frame_statistics(data, group_col, params)
+
+    def directional_scores(self, data, group_col, params, directions, control_mean, control_std):
+        z_scores = z_score_matrix(data, list(params), control_mean, control_std)
+        return data[group_col].to_numpy(), directional_scores(z_scores, list(directions))
+
+    def thresholds(self, data, group_col, groups, params, directions, control_mean, control_std, counts):
+        group_values, scores = self.directional_scores(data, group_col, params, directions, control_mean, control_std)
+        return count_thresholds(scores, group_indices(group_values, list(groups)), len(groups), counts)
+
+    def paired_task_sums(self, data, group_col, subject_col, task_groups, std):
+        affected = classify_paired_diffs(paired_differences(data, group_col, subject_col), [std])[0][std]
+        return pd.DataFrame({'affected_' + task: affected[params].sum(axis=1) for task, params in task_groups.items()})
+
+
+class PolarsBackend:
+    # multi-threaded polars queries. the data is a lazy query of the file: paths are scanned, so every query reads
+    # only the columns and rows it needs, uploaded files are read from their buffer. the parameters' statistics and
+    # scores are computed in parallel over the columns, the thresholds are sorted with the same numpy code as the
+    # reference. polars is optional, it is imported when used
+
+    name = 'polars'
+    lazy = True
+
+    def __init__(self):
+        import polars
+        self.pl = polars
+
+    def frame(self, data):
+        # a lazy query of a polars or pandas frame
+        if isinstance(data, pd.DataFrame):
+            return self.pl.from_pandas(data).lazy()
+        return data.lazy()
+
+    def load(self, data_file):
+        pl = self.pl
+        extension = file_extension(data_file)
+        if hasattr(data_file, 'read'):
+            data_file.seek(0)
+            if extension in PARQUET_EXTENSIONS:
+                frame = pl.read_parquet(data_file).lazy()
+            elif extension in ARROW_EXTENSIONS:
+                frame = pl.read_ipc(data_file).lazy()
+            else:
+                frame = pl.read_csv(data_file, infer_schema_length=10000).lazy()
+        elif extension in PARQUET_EXTENSIONS:
+            frame = pl.scan_parquet(data_file)
+        elif extension in ARROW_EXTENSIONS:
+            frame = pl.scan_ipc(data_file)
+        else:
+            frame = pl.scan_csv(data_file, infer_schema_length=10000)
+        names = frame.collect_schema().names()
+        frame = frame.rename({name: name.lower() for name in names})
+        # as in ingestion: non numeric parameter values and nan are missing
+        params = [name.lower() for name in names[2:]]
+        frame = frame.with_columns(pl.col(params).cast(pl.Float64, strict=False).fill_nan(None))
+        group_col = names[0].lower()
+        if frame.collect_schema()[group_col].is_integer() and \
+                frame.select(pl.col(group_col).null_count()).collect().item():  # a float column in pandas
+            frame = frame.with_columns(pl.col(group_col).cast(pl.Float64))
+        return frame, self.group_statistics(frame, group_col, params)
+
+    def to_pandas(self, data):
+        return self.frame(data).collect().to_pandas()
+
+    def select(self, data, columns):
+        return self.frame(data).select(list(columns)).collect().to_pandas()
+
+    def columns(self, data):
+        return self.frame(data).collect_schema().names()
+
+    def group_statistics(self, data, group_col, params):
+        pl = self.pl
+        params = list(params)
+        aggregated = self.frame(data).filter(pl.col(group_col).is_not_null()) \
+            .group_by(group_col, maintain_order=True) \
+            .agg([pl.len().alias(':size'),
+                  pl.col(params).count().name.suffix(':count'),
+                  pl.col(params).mean().name.suffix(':mean'),
+                  pl.col(params).std().name.suffix(':std')]) \
+            .collect()
+        groups = pd.Index(aggregated[group_col].to_numpy(), name=group_col)
+        stats = {'size': pd.Series(aggregated[':size'].to_numpy().astype(np.int64), index=groups)}
+        for statistic in ['count', 'mean', 'std']:
+            values = aggregated.select([param + ':' + statistic for param in params]).to_numpy().T
+            stats[statistic] = pd.DataFrame(values.astype(np.int64 if statistic == 'count' else float),
+                                            index=params, columns=groups)
+        return stats
+
+    def directional_scores(self, data, group_col, params, directions, control_mean, control_std):
+        pl = self.pl
+        scores = []
+        for param, direction in zip(params, directions):
+            z_score = (pl.col(param) - float(control_mean[param])) / float(control_std[param])
+            if direction == 'both':
+                z_score = z_score.abs()
+            elif direction == 'below control':
+                z_score = -z_score
+            scores.append(z_score.alias(param))
+        frame = self.frame(data).select([pl.col(group_col)] + scores).collect()
+        return frame[group_col].to_numpy(), frame.select(list(params)).to_numpy().astype(float)
+
+    def thresholds(self, data, group_col, groups, params, directions, control_mean, control_std, counts):
+        group_values, scores = self.directional_scores(data, group_col, params, directions, control_mean, control_std)
+        return count_thresholds(scores, group_indices(group_values, list(groups)), len(groups), counts)
+
+    def paired_task_sums(self, data, group_col, subject_col, task_groups, std):
+        # a subject's row whose group is one more than its previous row (pre 0, post 1) minus that row, then
+        # affected against the differences' mean +/- std. the previous rows come from one stable sort by subject
+        pl = self.pl
+        params = [param for task_params in task_groups.values() for param in task_params]
+        same_subject = pl.col(subject_col) == pl.col(subject_col).shift(1)
+        diffs = self.frame(data).with_row_index(':row') \
+            .sort(subject_col, maintain_order=True) \
+            .select([pl.col(':row'), pl.col(subject_col)] +
+                    [pl.when(same_subject).then(pl.col(column).diff()).alias(column)
+                     for column in [group_col] + params]) \
+            .filter(pl.col(group_col) == 1) \
+            .sort(':row')
+        bounds = [pl.col(param).std() * std for param in params]
+        affected = [((pl.col(param) > pl.col(param).mean() + bound) | (pl.col(param) < pl.col(param).mean() - bound))
+                    .cast(pl.Int64).alias(param) for param, bound in zip(params, bounds)]
+        sums = diffs.select([pl.col(subject_col)] + affected) \
+            .select([pl.col(subject_col)] + [pl.sum_horizontal(task_params).cast(pl.Float64).alias('affected_' + task)
+                                             for task, task_params in task_groups.items()]) \
+            .collect().to_pandas()
+        return sums.set_index(subject_col)
+
+
+def available_backends():
+    # the backends that can run here, the optional engines are skipped when they are not installed
+    names = []
+    for name in BACKENDS:
+        try:
+            get_backend(name)
+        except ImportError:
+            continue
+        names.append(name)
+    return names
+
+
+def get_backend(name='pandas'):
+    if name == 'pandas':
+        return PandasBackend()
+    if name == 'polars':
+        return PolarsBackend()
+    raise ValueError('unknown backend ' + str(name) + ', use one of ' + ', '.join(BACKENDS))
@@ -0,0 +1,216 @@
+import argparse
+import glob
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import pandas as pd
+from backends import available_backends
+from group_stats import group_label
+from ingestion import DATA_FILE_TYPES, file_extension, read_template
+from paired_engine import STDS, timepoint_pairs
+from paired_pipeline import paired_diffs_stage, paired_classify_stage, timepoints_stage, contrast_diffs_stage
+from pipeline import file_fingerprint, load_stage, stats_stage, screen_stage, sweep_stage, significance_stage, \
+    classify_stage, final_table_stage, param_table
+from profiling_engine import COUNTS, DIRECTIONS, SD_STEP
+
+
+TEMPLATE_SUFFIX = '_direction_preferences.csv'
+
+
+def find_data_files(inputs):
+    # data files of folders and glob patterns, direction preference templates are skipped
+    paths = []
+    for pattern in inputs:
+        if os.path.isdir(pattern):
+            candidates = [os.path.join(pattern, name) for name in sorted(os.listdir(pattern))]
+        else:
+            candidates = sorted(glob.glob(pattern))
+        for path in candidates:
+            if os.path.isfile(path) and file_extension(path)[1:] in DATA_FILE_TYPES \
+                    and not path.endswith(TEMPLATE_SUFFIX) and path not in paths:
+                paths.append(path)
+    return paths
+
+
+def find_template(data_path, templates_dir=None, default_template=None):
+    # the data file's own <name>_direction_preferences.csv, next to it or in templates_dir, else the default template
+    template_name = os.path.splitext(os.path.basename(data_path))[0] + TEMPLATE_SUFFIX
+    for folder in [templates_dir, os.path.dirname(data_path)]:
+        if folder and os.path.isfile(os.path.join(folder, template_name)):
+            return os.path.join(folder, template_name)
+    return default_template
+
+
+def profile_file(data_path, template_path, settings):
+    # run the behavioral profiling of one data file with the app's defaults: all groups, parameters pre-selected by
+    # the mean / deviation differences, directions from the template and the optimal SD and number of parameters.
+    # the optional settings 'groups', 'params' and 'directions' ({parameter: direction}) override the defaults.
+    # 'backend' is the engine of the loading, statistics and scores, pandas by default
+    if settings['sd'] is not None and settings['sd'] <= 0:
+        raise ValueError('sd must be positive')
+    loaded = load_stage(file_fingerprint(data_path), settings.get('backend', 'pandas'), data_file=data_path)
+    group_list = [group_label(value) for value in loaded['stats']['size'].index]
+    if settings.get('groups'):
+        unknown = [group for group in settings['groups'] if group not in group_list]
+        if unknown:
+            raise ValueError('groups ' + ', '.join(unknown) + ' are not in the data file')
+        group_list = [group for group in group_list if group in settings['groups']]
+    control_group = settings['control_group'] or group_list[0]
+    if control_group not in group_list:
+        raise ValueError('control group ' + control_group + ' is not in the data file')
+    if template_path:
+        template_df = read_template(template_path)
+        directions = {param: template_df.loc[0, param] for param in template_df.columns}
+    else:
+        directions = {param: 'both' for param in loaded['params']}
+    for param, direction in (settings.get('directions') or {}).items():
+        if param not in loaded['params'] or direction not in DIRECTIONS:
+            raise ValueError('direction ' + str(direction) + ' of parameter ' + str(param) + ' is not valid')
+        directions[param] = direction
+    params = tuple(directions)
+
+    stats = stats_stage(loaded, params)
+    screen = screen_stage(stats, tuple(group_list), control_group, params, settings['mean_difference'],
+                          settings['deviation_difference'])
+    included_params = tuple(screen['selected'])
+    if settings.get('params'):
+        unknown = [param for param in settings['params'] if param not in directions]
+        if unknown:
+            raise ValueError('parameters ' + ', '.join(unknown) + ' are not in the data file')
+        included_params = tuple(param for param in params if param in settings['params'])
+    if not included_params:
+        raise ValueError('no parameters passed the mean / deviation differences')
+    counts = tuple(COUNTS[:len(params)])
+    sweep = sweep_stage(loaded, stats, tuple(group_list), control_group, included_params,
+                        tuple(directions[param] for param in included_params), counts, SD_STEP)
+    max_of_max = sweep['max_of_max']
+    if settings['permutations'] or settings['bootstraps']:  # the files are already spread over the processes
+        max_of_max = dict(max_of_max, **significance_stage(
+            loaded, sweep, tuple(group_list), control_group, included_params,
+            tuple(directions[param] for param in included_params), counts, SD_STEP, settings['permutations'],
+            settings['bootstraps'], settings['seed'], workers=1))
+    dev_high = settings['sd'] if settings['sd'] is not None else max_of_max['SD']
+    classify = classify_stage(loaded, sweep, tuple(group_list), included_params, counts, dev_high)
+    final_table = param_table(final_table_stage(loaded, classify, included_params, max_of_max['# of params']))
+    return loaded, screen['effect_sizes'], max_of_max, classify['true_columns'], final_table
+
+
+def paired_file(data_path, stds, backend_name='pandas', contrasts=None):
+    # run the paired differences analysis of one data file, as {(earlier, later) session: (affected tables of stds,
+    # percentages by number of parameters)}. a file of two sessions is one contrast. with more sessions (longitudinal
+    # mode), or with contrasts ([earlier, later] session pairs), the contrasts are taken from the sessions pivoted
+    # once, every pair of sessions by default
+    loaded = load_stage(file_fingerprint(data_path), backend_name, data_file=data_path)
+    sessions = [group_label(value) for value in loaded['stats']['size'].index]
+    if len(sessions) < 2:
+        raise ValueError('the paired analysis needs at least two sessions')
+    if len(sessions) == 2 and not contrasts:
+        classified = paired_classify_stage(paired_diffs_stage(loaded), tuple(STDS))
+        return {tuple(sessions): ({std: classified['task_combinations'].table(std) for std in stds},
+                                  classified['std_df'])}
+    timepoints = timepoints_stage(loaded)
+    sessions = [group_label(value) for value in timepoints['timepoints']]
+    if contrasts:
+        unknown = [session for pair in contrasts for session in pair if session not in sessions]
+        if unknown:
+            raise ValueError('sessions ' + ', '.join(unknown) + ' are not in the data file')
+        pairs = [(sessions.index(earlier), sessions.index(later)) for earlier, later in contrasts]
+    else:
+        pairs = timepoint_pairs(len(sessions))
+    results = {}
+    for earlier, later in pairs:
+        classified = paired_classify_stage(contrast_diffs_stage(timepoints, earlier, later), tuple(STDS))
+        results[(sessions[earlier], sessions[later])] = ({std: classified['task_combinations'].table(std)
+                                                          for std in stds}, classified['std_df'])
+    return results
+
+
+def process_file(data_path, template_path, settings):
+    # analyse one file and write its outputs, returns a summary row
+    stem = os.path.splitext(os.path.basename(data_path))[0]
+    output_dir = settings['output_dir']
+    summary = {'file': data_path, 'template': template_path or ''}
+    if settings['mode'] in ('profile', 'both'):
+        loaded, effects, max_of_max, true_columns, final_table = profile_file(data_path, template_path, settings)
+        effects.to_csv(os.path.join(output_dir, stem + '_effect_sizes.csv'), index_label='parameter')
+        pd.DataFrame(max_of_max, index=[0]).to_csv(os.path.join(output_dir, stem + '_max_of_max.csv'), index=False)
+        true_columns.to_csv(os.path.join(output_dir, stem + '_percentages.csv'))
+        final_table.to_csv(os.path.join(output_dir, stem + '_final_table.csv'), index=False)
+        summary.update(max_of_max)
+    if settings['mode'] in ('paired', 'both'):
+        contrasts = paired_file(data_path, settings['paired_sds'], settings.get('backend', 'pandas'))
+        for (earlier, later), (affected_tables, std_df) in contrasts.items():
+            # longitudinal files are saved per contrast, named as in the app
+            contrast_name = '_' + later + '_' + earlier if len(contrasts) > 1 else ''
+            std_df.to_csv(os.path.join(output_dir, stem + '_affected_percentages' + contrast_name + '.csv'))
+            for std, table in affected_tables.items():
+                table.to_csv(os.path.join(output_dir, stem + '_affected_sd_' + str(std) + contrast_name + '.csv'))
+    return summary
+
+
+def run_batch(data_paths, templates, settings, workers=None):
+    # process the files on a pool of worker processes, failures are reported in the summary and do not stop the batch
+    os.makedirs(settings['output_dir'], exist_ok=True)
+    rows = []
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(process_file, path, templates[path], settings): path for path in data_paths}
+        for future in as_completed(futures):
+            try:
+                row = future.result()
+                row['status'] = 'ok'
+            except Exception as error:
+                row = {'file': futures[future], 'template': templates[futures[future]] or '',
+                       'status': 'error: ' + str(error)}
+            print(row['file'], row['status'])
+            rows.append(row)
+    summary = pd.DataFrame(rows).sort_values('file')
+    summary.to_csv(os.path.join(settings['output_dir'], 'batch_summary.csv'), index=False)
+    return summary
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description='Run the behavioral profiling and paired analysis on many data files')
+    parser.add_argument('inputs', nargs='+', help='data folders or glob patterns of data files')
+    parser.add_argument('-o', '--output-dir', default='profiling_output', help='folder for the results')
+    parser.add_argument('--mode', choices=['profile', 'paired', 'both'], default='profile',
+                        help='behavioral profiling, paired differences analysis or both')
+    parser.add_argument('--template', help='directions preferences file used for files without their own template')
+    parser.add_argument('--templates-dir', help='folder of <data file name>' + TEMPLATE_SUFFIX + ' files')
+    parser.add_argument('--control-group', help='control group name, e.g. group_1. defaults to the first group')
+    parser.add_argument('--mean-difference', type=int, default=30,
+                        help='mean differences between control and experiment groups, in percent')
+    parser.add_argument('--deviation-difference', type=int, default=30,
+                        help='deviation differences between control and experiment groups, in percent')
+    parser.add_argument('--sd', type=float, help='SD limit of the final table. defaults to the optimal SD')
+    parser.add_argument('--paired-sds', type=float, nargs='+', default=[1.0],
+                        help='SD levels of the paired affected tables to save')
+    parser.add_argument('--permutations', type=int, default=0,
+                        help='group label permutations for a p-value of the optimal weighted difference')
+    parser.add_argument('--bootstraps', type=int, default=0,
+                        help='bootstrap samples for confidence intervals of the optimal max / weighted difference')
+    parser.add_argument('--seed', type=int, default=0, help='random seed of the permutations and bootstraps')
+    parser.add_argument('--backend', choices=available_backends(), default='pandas',
+                        help='engine of the data loading, group statistics and scores')
+    parser.add_argument('-j', '--workers', type=int, help='number of worker processes. defaults to the CPU count')
+    args = parser.parse_args(args)
+
+    data_paths = find_data_files(args.inputs)
+    if not data_paths:
+        parser.error('no data files found')
+    templates = {path: find_template(path, args.templates_dir, args.template) for path in data_paths}
+    settings = {'output_dir': args.output_dir,
+                'mode': args.mode,
+                'control_group': args.control_group,
+                'mean_difference': args.mean_difference / 100,
+                'deviation_difference': args.deviation_difference / 100,
+                'sd': args.sd,
+                'paired_sds': [std for std in STDS if std in args.paired_sds],
+                'permutations': args.permutations,
+                'bootstraps': args.bootstraps,
+                'seed': args.seed,
+                'backend': args.backend}
+    summary = run_batch(data_paths, templates, settings, args.workers)
+    return 0 if (summary['status'] == 'ok').all() else 1
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -1,8 +1,21 @@
 import streamlit as st
 import pandas as pd
-import matplotlib.pyplot as plt
 import plotly.express as px
 import os
+from profiling_engine import COUNTS, SD_RANGE, SD_STEP, param_tasks, task_subsets
+from group_stats import group_label
+from ingestion import DATA_FILE_TYPES, read_template
+from resampling import PERMUTATIONS, BOOTSTRAPS
+from stability import FOLDS, STABILITY_MODES, optima_spread
+from backends import available_backends
+from instrumentation import sidebar_recorder, sidebar_panel
+from charts import affected_pies, two_level_pies
+from exports import EXPORT_FORMATS, preferences_csv
+from parameter_editor import DIRECTION_ICONS, parameter_editor
+from pipeline import file_fingerprint, load_stage, stats_stage, screen_stage, sweep_stage, significance_stage, \
+    classify_stage, level_counts_stage, two_level_stage, final_table_stage, two_level_final_table_stage, \
+    level_percentages, param_table_stage, final_csv_stage, profile_bundle_stage, task_counts_stage, task_sweep_stage, \
+    stability_stage
 
 
 def file_selector(folder_path='.'):
@@ -12,29 +25,26 @@ def file_selector(folder_path='.'):
     return os.path.join(folder_path, selected_filename)
 
 
-def to_lower_case():
-    return lambda text: str(text).lower()
-
-
 @st.cache_data
-def load_data(filename):
-    data = pd.read_csv(filename)
-    lowercase = to_lower_case()
-    data.rename(lowercase, axis=1, inplace=True)
-
-    return data
+def load_template(filename):
+    return read_template(filename)
 
 
 # initialize global variables
 final_table = pd.DataFrame()
-COUNTS = [2, 3, 4, 5, 6, 7, 8, 9, 10, 11, 12, 13, 14, 15, 16, 17, 18, 19, 20]
 
 # design title of page
 st.title('Behavioral Profiling Algorithm', )
 st.markdown('_powered by_  **GRL Lab**  :rat:')
+# stage timings of this run, see the Performance switches in the sidebar
+recorder = sidebar_recorder('behavioral_profiling')
+# engine of the data loading, the group statistics and the scores, the optional engines when they are installed
+backend_name = st.sidebar.selectbox('Computation backend', available_backends(), key='backend',
+                                    help='polars reads the data file and computes the statistics and scores '
+                                         'multi-threaded, for large cohorts')
 
 st.subheader('1. Upload your data file')
-data_file = st.file_uploader("Upload a CSV file to start analysis",
+data_file = st.file_uploader("Upload a CSV file to start analysis", type=DATA_FILE_TYPES,
                              help="If you don't have your file prepared according to the predefined format or you "
                                   "don't know how to format it, please download a data file template through the "
                                   "Download button below.")
@@ -63,21 +73,24 @@ if data_file:
                                   " selected parameters. If you don't have a template file you will be able to get it"
                                   " after you first selected the Up / Down preferences for you parameters")
 
-    # read data file
-    data_df = load_data(data_file)
-    # convert non numeric values to nan
-    data_df[data_df.columns[2:]] = data_df[data_df.columns[2:]].apply(
-        lambda value: pd.to_numeric(value, errors='coerce'))
-    group_col = data_df.columns[0]
+    # read data file, non numeric values are converted to nan while reading.
+    # every stage below is memoized on its inputs, so a widget change only recomputes the stages after it
+    with recorder.span('load data') as span:
+        loaded = load_stage(file_fingerprint(data_file), backend_name, data_file=data_file)
+        n_rows = len(loaded['group_labels'])
+        span['rows'], span['cols'] = n_rows, len(loaded['params']) + 2
+    data_stats = loaded['stats']
+    group_col = loaded['group_col']
 
-    subject_col = data_df.columns[1]
+    subject_col = loaded['subject_col']
 
     # read template file
     template_df = pd.DataFrame()
     if template_file and use_template_file == 'Yes':
-        template_df = load_data(template_file)
+        template_df = load_template(template_file)
 
-    group_list = {'group_' + str(i): {'selected': True} for i in data_df[group_col]}
+    # count, mean and std of all the groups were collected while reading, shared by all the steps below
+    group_list = {group_label(i): {'selected': True, 'value': i} for i in data_stats['size'].index}
     if use_template_file == 'Yes' and not template_file:
         st.write('You need to select a template file to continue')
     else:
@@ -86,7 +99,7 @@ if data_file:
 
         else:
             param_list = {i: {'selected': False, 'direction': 'both', 'dir_icon': ':arrow_up_down:'} for i in
-                          data_df.columns[2:]}
+                          loaded['params']}
         # control group selection. defaults to first group in data file
         control_group = st.selectbox('Select control group', list(group_list.keys()),
                                      help='Control group can be manually changed. The default is the first group in'
@@ -95,44 +108,9 @@ if data_file:
         for group in group_list:
             if group != control_group:
                 group_list[group]['selected'] = st.checkbox(group, group, group + '_key')
-        # 3. define the parameters list
-        st.subheader('3. Select parameters for analysis and set their direction')
-        directions = ['both', 'above control', 'below control']
-        # col1, col2 = st.columns(2)
-
-        for param in param_list:
-            col1, col2 = st.columns(2)
-            # 3. allow manual changes for parameter inclusion
-            param_list[param]['selected'] = col1.checkbox(param, value=param_list[param]['selected'], key=param)
-            # 4. allow manual changes for direction
-            param_list[param]['direction'] = col2.selectbox(param + ' direction', directions,
-                                                            index=directions.index(param_list[param]['direction']))
-
-            # update the arrow icons directions
-            if param_list[param]['direction'] == 'both':
-                param_list[param]['dir_icon'] = ':arrow_up_down:'
-            elif param_list[param]['direction'] == 'above control':
-                param_list[param]['dir_icon'] = ':arrow_up_small:'
-            else:
-                param_list[param]['dir_icon'] = ':arrow_down_small:'
-
-        # 4. save template to file
-        save_template_file = data_file.name[:-4] + '_direction_preferences.csv'
-        st.download_button('Save directions preferences file for later use?',
-                           data=pd.DataFrame.from_dict(param_list).drop('selected').to_csv(index=False),
-                           file_name=save_template_file,
-                           mime="text/csv",
-                           help='You can use this file when you come back around next time')
-
         # 1. collect group means and sd into dataframes
-        group_mean = pd.DataFrame()
-        group_std = pd.DataFrame()
-        # loop groups and calculate mean and sd + remove unwanted columns
-        for group in list(i for i in group_list.keys() if group_list[i]['selected']):
-            # collect all the groups means
-            group_mean[group] = data_df[data_df[group_col] == int(group[-1])][param_list.keys()].mean()
-            # collect all the groups SDs
-            group_std[group] = data_df[data_df[group_col] == int(group[-1])][param_list.keys()].std()
+        with recorder.span('group statistics', n_rows, len(param_list)):
+            stats = stats_stage(loaded, tuple(param_list))
 
         # 2.1. set the difference between control and other groups mean to be included
         mean_difference = st.slider('Select mean differences between control and experiment groups', 0, 100, 30, 5)
@@ -144,28 +122,34 @@ if data_file:
         deviation_difference = deviation_difference / 100
 
         # 2.3. find parameters that should be included
-        for group in list(i for i in group_list.keys() if group_list[i]['selected']):
-            for param in param_list:  # calculate deviation difference for all the parameters columns
-                if group_std[group][param] == 0:
-                    calculated_deviation_difference = 0
-                else:
-                    calculated_deviation_difference = group_std[group][param] / group_std[control_group][param]
-                if (((1 - deviation_difference) > calculated_deviation_difference > (1 + deviation_difference)) or
-                        ((abs(group_mean[group][param] - group_mean[control_group][param]) /
-                          group_mean[control_group][param]) > mean_difference)):
-                    param_list[param]['selected'] = True
-
-        # 3. define the parameters list
-        st.subheader('3. Select parameters for analysis')
-
-        # allow updating the selected parameters
+        with recorder.span('screen parameters', len(group_list), len(param_list)):
+            screen = screen_stage(stats, tuple(i for i in group_list.keys() if group_list[i]['selected']),
+                                  control_group, tuple(param_list), mean_difference, deviation_difference)
+        with st.expander('Effect sizes of the parameters, ranked by the standardized difference'):
+            st.dataframe(screen['effect_sizes'])
+
+        # 3. select the parameters and their directions in one table, the screened parameters are pre-selected.
+        # filter by name or task, select / clear the shown parameters or apply a directions preferences file
+        st.subheader('3. Select parameters for analysis and set their direction')
+        with recorder.span('parameter editor', len(param_list), 2):
+            selected_params, param_directions = parameter_editor(
+                list(param_list), screen['selected'],
+                {param: param_list[param]['direction'] for param in param_list}, screen['effect_sizes'],
+                'parameters_' + loaded.key + '_' + use_template_file)
         for param in param_list:
-            col1, col2 = st.columns(2)
-            # 3. allow manual changes for parameter inclusion
-            param_list[param]['selected'] = col1.checkbox(param, value=param_list[param]['selected'])
+            param_list[param]['direction'] = param_directions[param]
+            param_list[param]['dir_icon'] = DIRECTION_ICONS[param_directions[param]]
+        for param in selected_params:
+            param_list[param]['selected'] = True
 
-            # show direction arrows
-            col2.markdown(param_list[param]['dir_icon'])
+        # 4. save template to file
+        save_template_file = os.path.splitext(data_file.name)[0] + '_direction_preferences.csv'
+        st.download_button('Save directions preferences file for later use?',
+                           data=preferences_csv(tuple((param, param_list[param]['direction'],
+                                                       param_list[param]['dir_icon']) for param in param_list)),
+                           file_name=save_template_file,
+                           mime="text/csv",
+                           help='You can use this file when you come back around next time')
 
         included_group_list = list(i for i in group_list.keys() if group_list[i]['selected'])
         included_param_list = list(i for i in param_list.keys() if param_list[i]['selected'])
@@ -176,71 +160,14 @@ if data_file:
         #         group_list_for_dev[group] = {}
         #         group_list_for_dev[group]['selected'] = st.checkbox(group, group)
 
-        # keep the optimized and weighted maximum difference between control and group
-        max_of_max = {'SD': 0.5, '# of params': 0, 'max diff': 0,
-                      'weighted': 0}
-
         # 5. find the sd that has the largest difference between control and experiment groups
-        true_columns_dict = {}
-        true_false_dict = {}
-        for_pie = {}
-        group_len = {}
-        for sd in range(5, 21):
-            sd = sd / 10
-            # create the final count files infrastructure in the size of included groups x number of parameters
-            true_columns_dict[sd] = pd.DataFrame()
-            true_columns_dict[sd]['count'] = COUNTS[:len(param_list)]
-            for group in list(i for i in group_list.keys() if group_list[i]['selected']):
-                true_columns_dict[sd][group] = 0
-            true_columns_dict[sd] = true_columns_dict[sd].set_index('count')
-            true_false_dict[sd] = pd.DataFrame()
-            true_false_dict[sd][[group_col, subject_col]] = data_df[[group_col, subject_col]]
-            group_len[sd] = {}
-            # check the inclusion or exclusion for each animal in each parameter against the control group mean and SD
-            for group in included_group_list:  # loop thorough the included groups
-                for param in included_param_list:  # calculate for each of the parameters
-                    standard_param_col = (data_df[param] - group_mean[control_group][param]) /\
-                                         group_std[control_group][param]
-                    if param_list[param]['direction'] == 'both':
-                        true_false_dict[sd][param] = abs(standard_param_col) >= sd
-                    elif param_list[param]['direction'] == 'above control':
-                        true_false_dict[sd][param] = standard_param_col >= sd
-                    else:
-                        true_false_dict[sd][param] = standard_param_col <= -sd
-                group_len[sd][group] = data_df[data_df[group_col] == int(group[-1])].shape[0]
-
-            true_false_dict[sd]['sum'] = true_false_dict[sd][included_param_list].sum(axis=1)
-
-            # calculate the percentage of affected animals per group per level
-            # (if 2 is selected there are high_start and low levels)
-            for group in included_group_list:  # loop thorough the included groups
-                percentages = []
-                for count in true_columns_dict[sd].index:
-                    percentages.append(true_false_dict[sd][(true_false_dict[sd]['sum'] >= count) &
-                                                           (true_false_dict[sd][group_col] == int(group[-1]))].count()
-                                       ['sum'] / group_len[sd][group] * 100)
-                true_columns_dict[sd][group] = percentages
-
-            # test for max difference only if control group value is under 20%
-            true_sums_counts_cut = true_columns_dict[sd][true_columns_dict[sd][control_group] <= 20]
-
-            # calculate the maximum difference between any of the groups and the control group
-            true_sums_counts_cut.loc[:, 'max_diff'] = \
-                true_sums_counts_cut.loc[:, included_group_list].max(1) - true_sums_counts_cut[control_group]
-
-            # calculate the weighted index as max_diff divided by the number of parameters
-
-            true_sums_counts_cut.loc[:, 'weighted'] = true_sums_counts_cut['max_diff'] * true_sums_counts_cut.index
-
-            # replace value if weighted is grater than the value collected until now
-            if true_sums_counts_cut['weighted'].max() > max_of_max['weighted']:
-                max_index = true_sums_counts_cut['weighted'].idxmax()
-                max_of_max = {'SD': sd,
-                              '# of params': int(max_index),
-                              'max diff': true_sums_counts_cut.loc[max_index, 'max_diff'],
-                              'weighted': true_sums_counts_cut.loc[max_index, 'weighted']}
-            true_columns_dict[sd].index = true_columns_dict[sd].index.astype(int)
-        # true_sums_counts_cut
+        counts = COUNTS[:len(param_list)]
+        included_directions = tuple(param_list[param]['direction'] for param in included_param_list)
+        with recorder.span('sd sweep', n_rows, len(included_param_list)):
+            sweep = sweep_stage(loaded, stats, tuple(included_group_list), control_group, tuple(included_param_list),
+                                included_directions, tuple(counts), SD_STEP)
+        max_of_max = sweep['max_of_max']
+        group_len = sweep['group_len']
         # display the selected optimal result in table format
         st.subheader('The optimal weighted maximum difference between control and exp groups')
         # CSS to inject contained in a string
@@ -254,19 +181,73 @@ if data_file:
         st.markdown(hide_table_row_index, unsafe_allow_html=True)
         st.table(pd.DataFrame(max_of_max, index=[0]))
 
+        # 5.1. test the optimal result against shuffled group labels (permutations) and resampled subjects (bootstrap)
+        if st.checkbox('Test the optimal difference against chance?',
+                       help='Group labels are shuffled between the subjects to get a p-value for the weighted '
+                            'difference, and subjects are resampled within their groups for confidence intervals'):
+            col1, col2, col3 = st.columns(3)
+            permutations = col1.number_input('Permutations', 100, 100000, PERMUTATIONS, 100)
+            bootstraps = col2.number_input('Bootstrap samples', 0, 100000, BOOTSTRAPS, 100)
+            seed = col3.number_input('Random seed', 0, 2 ** 32 - 1, 0, 1)
+            progress_bar = st.progress(0.0, text='Resampling')
+            with recorder.span('significance', n_rows, len(included_param_list)):
+                significance = significance_stage(loaded, sweep, tuple(included_group_list), control_group,
+                                                  tuple(included_param_list), included_directions, tuple(counts),
+                                                  SD_STEP, int(permutations), int(bootstraps), int(seed),
+                                                  progress=lambda done: progress_bar.progress(done, text='Resampling'))
+            progress_bar.empty()
+            st.table(pd.DataFrame(significance, index=[0]))
+
+        # 5.2. the optimal result of every task (the parameter name prefix) and of task subsets, all from the hit
+        # counts per task of the same sweep
+        tasks = param_tasks(included_param_list)[0]
+        if len(tasks) > 1 and st.checkbox('Sweep the tasks separately?',
+                                          help='Find the optimal difference for every task and for subsets of the '
+                                               'tasks, to see which tasks drive the effect'):
+            col1, col2 = st.columns(2)
+            max_subset_size = col1.slider('Maximum number of tasks in a subset', 1, len(tasks), 1, 1)
+            extra_subset = col2.multiselect('Add a subset of tasks', tasks)
+            subsets = task_subsets(tasks, max_subset_size, [extra_subset])
+            with recorder.span('task sweep', n_rows, len(subsets)):
+                task_counts = task_counts_stage(sweep, tuple(included_param_list), SD_STEP)
+                task_sweep = task_sweep_stage(loaded, task_counts, tuple(included_group_list), control_group,
+                                              tuple(subsets), tuple(counts))
+            subset_names = [' + '.join(subset) for subset in subsets]
+            subset_table = pd.DataFrame(task_sweep['max_of_max'], index=pd.Index(subset_names, name='Tasks'))
+            subset_table.insert(0, 'Parameters', [sum(param.split('_')[0] in subset for param in included_param_list)
+                                                  for subset in subsets])
+            st.dataframe(subset_table)
+            shown_subset = st.selectbox('Tasks to plot', subset_names)
+            shown_position = subset_names.index(shown_subset)
+            shown_max = task_sweep['max_of_max'][shown_position]
+            sd_position = task_counts['sd_levels'].index(shown_max['SD'])
+            subset_curve = pd.DataFrame(task_sweep['percentages'][shown_position][sd_position],
+                                        columns=included_group_list)
+            subset_curve['Number of parameters'] = counts
+            c = px.line(subset_curve.melt(id_vars='Number of parameters', var_name='Group', value_name='Percentage'),
+                        x='Number of parameters', y='Percentage', color='Group', height=400,
+                        range_x=[2, subset_table['Parameters'].iloc[shown_position] + 1], range_y=[0, 100])
+            c.add_vline(x=shown_max['# of params'], line_dash="dash", line_color="darkgray")
+            c.layout.plot_bgcolor = 'white'
+            c.layout.title = 'Percentage of affected subject for each parameter count, ' + shown_subset + \
+                ', SD: ' + str(shown_max['SD'])
+            c.update_xaxes(dtick=1)
+            st.plotly_chart(c)
+
         # 6. show the sd slider with calculated sd value as default. allow selecting 2 limits (high, low)
         st.subheader('4. Select SD range to set limit between affected and unaffected animals')
         dev_high = st.slider('Select SD range high',
-                             0.5, 2.0, max_of_max['SD'], 0.1,
+                             SD_RANGE[0], SD_RANGE[1], max_of_max['SD'], SD_STEP,
                              help='If medium level is selected this will set the limit between highly affected and '
                                   'medium affected animal')
         second_level = st.checkbox('Add a medium level?',
                                    help='The default is to have affected / not affected animals. '
                                         'If a medium level is added, the affected animals will be divided into 2 '
                                         'levels - highly affected and medium affected.')
-        final_table[group_col] = data_df[group_col]  # final table
-        final_table[subject_col] = data_df[subject_col]  # final table
-        true_columns_dict[dev_high]['Number of parameters'] = true_columns_dict[dev_high].index
+        with recorder.span('classify', n_rows, len(included_param_list)):
+            classify = classify_stage(loaded, sweep, tuple(included_group_list), tuple(included_param_list),
+                                      tuple(counts), dev_high)
+        true_columns_dict = {dev_high: classify['true_columns']}
         if not second_level:  # only high level is selected
             # rearrange dataframe for line chart, format and draw line chart
             df_melt = pd.melt(true_columns_dict[dev_high],
@@ -274,14 +255,15 @@ if data_file:
                               id_vars='Number of parameters',
                               var_name='Group',
                               value_name='Percentage')
-            c = px.line(df_melt, x="Number of parameters", y='Percentage',
-                        color="Group",
-                        height=400, range_x=[2, len(included_param_list) + 1], range_y=[0, 100])
-            c.add_vline(x=max_of_max['# of params'], line_dash="dash", line_color="darkgray")
-            c.layout.plot_bgcolor = 'white'
-            c.layout.title = 'Percentage of affected subject for each parameter count'
-            c.update_xaxes(dtick=1)
-            st.plotly_chart(c)
+            with recorder.span('line chart', len(counts), len(included_group_list)):
+                c = px.line(df_melt, x="Number of parameters", y='Percentage',
+                            color="Group",
+                            height=400, range_x=[2, len(included_param_list) + 1], range_y=[0, 100])
+                c.add_vline(x=max_of_max['# of params'], line_dash="dash", line_color="darkgray")
+                c.layout.plot_bgcolor = 'white'
+                c.layout.title = 'Percentage of affected subject for each parameter count'
+                c.update_xaxes(dtick=1)
+                st.plotly_chart(c)
 
             # allow user to get pie charts for different parameter counts
             num_of_params = st.slider('Number of parameters to display in pie charts',
@@ -290,147 +272,102 @@ if data_file:
                                       max_of_max['# of params'],
                                       1)
 
-            # 11 + 12. create pie charts for 1 level
-            for group in included_group_list:
-                fig1, ax1 = plt.subplots()
-                labels = 'Affected', 'Unaffected'
-                explode = (0.1, 0)  # only "explode" the first slice_high
-                color = ['0.7', '0.85']
-                slice_high = int(true_columns_dict[dev_high].loc[num_of_params, group])
-                sizes = [slice_high / 100, 1 - (slice_high / 100)]
-                # 'Sizes =', sizes
-                pie_df = pd.DataFrame(sizes)
-
-                ax1.set_title('Group ' + group[-1] + ' / ' + 'SD: ' + str(dev_high) + ' / Params: ' +
-                              str(num_of_params),
-                              fontsize=18)
-                ax1.pie(sizes,
-                        explode=explode,
-                        labels=labels,
-                        autopct='%1.1f%%',
-                        shadow=True,
-                        startangle=90,
-                        colors=color,
-                        textprops={'fontsize': 14})
-                ax1.axis('equal')  # Equal aspect ratio ensures that pie is drawn as a circle.
-                st.pyplot(fig1)
-
-                # 13. create the final table of subjects and their respective list of affected parameters
-                # final_table.loc[true_false_dict[dev_high]['sum'].index, 'Affected'] = \
-                #     true_false_dict[dev_high]['sum'] >= max_of_max['# of params']
-                final_table['Affected'] = true_false_dict[dev_high]['sum'] >= max_of_max['# of params']
-                only_true_false_df = true_false_dict[dev_high].drop([group_col, subject_col, 'sum'], axis=1)
-                attended_params = only_true_false_df.apply(lambda row: row.index[row.astype(bool)].tolist(), 1)  #
-                final_table.loc[true_false_dict[dev_high]['sum'].index, 'Params'] = attended_params
+            # 11 + 12. create pie charts for 1 level, all the groups in one cached figure
+            with recorder.span('pie charts', len(included_group_list), 2):
+                pies = affected_pies(
+                    tuple('Group ' + str(group_list[group]['value']) + ' / ' + 'SD: ' + str(dev_high) +
+                          ' / Params: ' + str(num_of_params) for group in included_group_list),
+                    tuple(int(true_columns_dict[dev_high].loc[num_of_params, group]) for group in included_group_list))
+                st.image(pies)
+
+            # 13. create the final table of subjects and their respective list of affected parameters
+            with recorder.span('final table', n_rows, len(included_param_list)):
+                final = final_table_stage(loaded, classify, tuple(included_param_list), max_of_max['# of params'])
 
         else:  # selected to use medium level
             dev_low = round(st.slider('Select SD range for medium affected', 0.5, dev_high, dev_high * 0.7, 0.05), 2)
-            for group in included_group_list:  # loop thorough the included groups
-                for param in included_param_list:  # calculate for each of the parameters
-                    standard_param_col = \
-                        (data_df[param] - group_mean[control_group][param]) / group_std[control_group][param]
-                if param_list[param]['direction'] == 'both':
-                    true_false_dict[dev_high][param + '_med'] = (abs(standard_param_col) < dev_high) & \
-                                                                (abs(standard_param_col) >= dev_low)
-                elif param_list[param]['direction'] == 'above control':
-                    true_false_dict[dev_high][param + '_med'] = (standard_param_col < dev_high) & \
-                                                                (standard_param_col >= dev_low)
-                else:
-                    true_false_dict[dev_high][param + '_med'] = (standard_param_col > -dev_high) & \
-                                                                (standard_param_col <= -dev_low)
-
-            # 7. count and find percent of own group of affected animals for 2 levels - high and medium affected
-            true_false_dict[dev_high]['sum'] = true_false_dict[dev_high][included_param_list].sum(axis=1)
-            true_false_dict[dev_high]['perc_of_included_high'] = \
-                true_false_dict[dev_high]['sum'] / len(included_param_list) * 100
-            true_false_dict[dev_high]['sum_med'] = \
-                true_false_dict[dev_high].loc[:, [x for x in true_false_dict[dev_high].columns
-                                                  if x.endswith('_med')]].sum(axis=1)
-            true_false_dict[dev_high]['perc_of_included_med'] = \
-                true_false_dict[dev_high]['sum_med'] / len(included_param_list) * 100
-
-            # 8. calculate the correct value of affected for each subject
-            true_false_dict[dev_high]['affect_value_corrected'] = \
-                true_false_dict[dev_high]['perc_of_included_high'] + \
-                (true_false_dict[dev_high]['perc_of_included_med'] / 2)
-            # 9. calculate low-med point by the mean and sd of 'affect_value_corrected' for control group
-            control_values = \
-                true_false_dict[dev_high]['affect_value_corrected'][true_false_dict[dev_high]['group'] ==
-                                                                    int(control_group[-1])]
-            medium_default = int(control_values.mean() + control_values.std())
-
-            # 10. calculate med-high point by the mean of remaining value' - (max + min) / 2
+            # hit counts of the whole SD grid are computed once per sweep, so moving either SD slider is a lookup
+            with recorder.span('two level classification', n_rows, len(included_param_list)):
+                level_counts = level_counts_stage(sweep, SD_STEP)
+                two_level = two_level_stage(loaded, sweep, level_counts, classify, tuple(included_group_list),
+                                            control_group, dev_high, dev_low)
+            medium_default = two_level['medium_default']
+
+            # 9. + 10. select the low-med and med-high cut points, defaults are calculated from the control group
             medium_start = st.slider('Select medium cut point', 0, 100, medium_default, 1)
-            high_series = true_false_dict[dev_high]['affect_value_corrected'][
-                true_false_dict[dev_high]['affect_value_corrected'] > medium_default]
-            high_default = int((high_series.max() + high_series.min()) / 2)
+            high_default = two_level['high_default']
             high_start = st.slider('Select high cut point', medium_start, 100, high_default + 1, 1)
 
-            # 12. create pie charts for 2 levels
-            for group in included_group_list:
-                for_pie[group] = {}
-                highly_affected_count = round(
-                    true_false_dict[dev_high][(true_false_dict[dev_high]['affect_value_corrected'] >
-                                               high_start) & (true_false_dict[dev_high]['group'] ==
-                                                              int(group[-1]))]['group'].count() /
-                    group_len[dev_high][group] * 100, 1)
-                # true_false_dict[dev_high]['group'] == int(group[-1])
-                medium_affected_count = round(
-                    true_false_dict[dev_high][(true_false_dict[dev_high]['affect_value_corrected'] < high_start) &
-                                              (true_false_dict[dev_high]['affect_value_corrected'] > medium_start) &
-                                              (true_false_dict[dev_high]['group'] == int(group[-1]))]['group'].count() /
-                    group_len[dev_high][group] * 100, 1)
-
-                labels = ['Highly Affected', 'Medium Affected', 'Not Affected']
-                explode = (0.1, 0.1, 0)  # only "explode" the first slice_high
-                color = ['0.7', '0.6', '0.85']
-                sizes = [highly_affected_count,
-                         medium_affected_count,
-                         100 - (highly_affected_count + medium_affected_count)]
-                fig1, ax1 = plt.subplots()
-                ax1.set_title('Group ' + group[-1] + ' / ' + 'SD (high / medium): ' + str(dev_high) +
-                              ' / ' + str(dev_low), fontsize=18)
-
-                ax1.pie(sizes,
-                        explode=explode,
-                        labels=labels,
-                        autopct='%1.1f%%',
-                        shadow=True,
-                        startangle=90,
-                        colors=color,
-                        textprops={'fontsize': 14})
-                ax1.axis('equal')  # Equal aspect ratio ensures that pie is drawn as a circle.
-                st.pyplot(fig1)
-
-                # 13. create the final table of subjects and their respective list of affected parameters
-                final_table.loc[true_false_dict[dev_high]['sum'].index, 'Affected_high'] = \
-                    true_false_dict[dev_high]['sum'] >= max_of_max['# of params']
-                final_table.loc[true_false_dict[dev_high]['sum_med'].index, 'Affected_med'] = \
-                    (max_of_max['# of params'] >= true_false_dict[dev_high]['sum_med']) & \
-                    (true_false_dict[dev_high]['sum_med'] >= int(max_of_max['# of params'] * (dev_low / dev_high)))
-
-                high_columns = included_param_list
-                med_columns = \
-                    [c + '_med' for c in included_param_list if c + '_med' in true_false_dict[dev_high].columns]
-                # only_true_false_low_df = only_true_false_df[[columns_low]]
-                attended_params_high = true_false_dict[dev_high][high_columns].apply(
-                    lambda row: row.index[row.astype(bool)].tolist(), 1)  #
-                attended_params_med = true_false_dict[dev_high][med_columns].apply(
-                    lambda row: row.index[row.astype(bool)].tolist(), 1)  #
-                final_table.loc[true_false_dict[dev_high]['sum'].index, 'Params_high'] = attended_params_high
-                final_table.loc[true_false_dict[dev_high]['sum_med'].index, 'Params_med'] = attended_params_med
+            # 12. create pie charts for 2 levels, all the groups in one cached figure
+            with recorder.span('pie charts', len(included_group_list), 3):
+                for_pie = level_percentages(two_level, included_group_list, group_len, medium_start, high_start)
+                pies = two_level_pies(
+                    tuple('Group ' + str(group_list[group]['value']) + ' / ' + 'SD (high / medium): ' +
+                          str(dev_high) + ' / ' + str(dev_low) for group in included_group_list),
+                    tuple((for_pie[group]['high'], for_pie[group]['medium']) for group in included_group_list))
+                st.image(pies)
+
+            # 13. create the final table of subjects and their respective list of affected parameters
+            with recorder.span('final table', n_rows, len(included_param_list)):
+                final = two_level_final_table_stage(loaded, sweep, classify, two_level, tuple(included_param_list),
+                                                    max_of_max['# of params'], dev_high, dev_low)
 
         # 13. create the final table of subjects and their respective list of affected parameters
+        with recorder.span('parameter lists', n_rows, len(included_param_list)):
+            final_table = param_table_stage(final)['final_table']
         st.subheader('Final table')
         st.dataframe(final_table)
 
+        # 14. how much the affected classification and the optimal result depend on single control subjects, with
+        # the control statistics of every leave-one-out or k-fold resample of the control group
+        if st.checkbox('Check the stability of the classification?',
+                       help='The control group mean and SD are recomputed without each control subject (leave one '
+                            'out) or without each fold of them (k-fold), and the subjects are classified again'):
+            col1, col2, col3, col4 = st.columns(4)
+            stability_mode = col1.radio('Resampling', STABILITY_MODES, 0)
+            control_len = group_len[control_group]
+            folds, repeats, seed = None, 1, 0
+            if stability_mode == 'k-fold':
+                folds = int(col2.number_input('Folds', 2, max(2, control_len), min(FOLDS, max(2, control_len)), 1))
+                repeats = int(col3.number_input('Repeats', 1, 100, 1, 1))
+                seed = int(col4.number_input('Random seed', 0, 2 ** 32 - 1, 0, 1, key='stability_seed'))
+            if control_len < 3:
+                st.write('The control group needs at least 3 subjects to be resampled')
+            else:
+                with recorder.span('stability', n_rows, control_len if folds is None else folds * repeats):
+                    stability = stability_stage(loaded, tuple(included_group_list), control_group,
+                                                tuple(included_param_list), included_directions, tuple(counts),
+                                                SD_STEP, dev_high, max_of_max['# of params'], folds, repeats, seed)
+                st.table(pd.DataFrame(optima_spread(stability['optima'], max_of_max)))
+                stability_table = final_table.iloc[:, :3].copy()
+                stability_table['Stability'] = stability['stability']
+                stability_table['Affected share'] = stability['affected share']
+                st.write('Share of the resamples in which each subject keeps its classification, least stable first')
+                st.dataframe(stability_table.dropna(subset=['Stability']).sort_values('Stability', kind='stable'))
+
         # button for downloading the final table
         if second_level:
             levels = 2
         else:
             levels = 1
         final_table_filename = 'final_table_' + str(levels) + '_levels' + data_file.name  # data_file[2:]
-        st.download_button(label="Save table as CSV",
-                           data=final_table.to_csv(index=False),
-                           file_name=final_table_filename,
-                           mime="text/csv")
+        # the downloads are only built when asked for, and cached on the results they are built from
+        if st.checkbox('Prepare downloads', help='Build the final table CSV and a compressed bundle of all results'):
+            with recorder.span('csv export', *final_table.shape):
+                final_table_csv = final_csv_stage(final, final_table=final_table)['csv']
+            st.download_button(label="Save table as CSV",
+                               data=final_table_csv,
+                               file_name=final_table_filename,
+                               mime="text/csv")
+            export_format = st.selectbox('Bundle format', EXPORT_FORMATS,
+                                         help='The final table, the curves of every SD level and the optimal result')
+            with recorder.span('export bundle', *final_table.shape):
+                export = profile_bundle_stage(final, sweep, tuple(included_group_list), tuple(counts), SD_STEP,
+                                              export_format, final_table=final_table)
+            st.download_button(label='Save all results',
+                               data=export['bundle'],
+                               file_name=os.path.splitext(final_table_filename)[0] + '_results.zip',
+                               mime='application/zip')
+
+# stage timings and the cProfile output of this run
+sidebar_panel(recorder)
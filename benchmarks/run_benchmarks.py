@@ -0,0 +1,226 @@
+import argparse
+import json
+import os
+import platform
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timezone
+import numpy as np
+import pandas as pd
+from backends import BACKENDS, available_backends, get_backend
+from benchmarks.synthetic_data import make_cohort, write_cohort
+from ingestion import frame_statistics, ingest
+from paired_engine import STDS
+from paired_pipeline import paired_diffs_stage, paired_classify_stage, task_parameter_groups
+from pipeline import load_data, stats_stage, sweep_stage, classify_stage, level_counts_stage, two_level_stage, \
+    final_table_stage, two_level_final_table_stage, level_percentages, param_table
+from profiling_engine import COUNTS, SD_STEP
+
+# run from the repository root: python -m benchmarks.run_benchmarks --scales 1000x50 5000x300
+
+DEFAULT_SCALES = ['300x20', '3000x100', '15000x300']
+GROUPS = 3
+TASKS = ('openfield', 'maze', 'social', 'novel')
+
+
+def parse_scale(scale):
+    # '<subjects>x<parameters>'
+    subjects, params = scale.lower().split('x')
+    return int(subjects), int(params)
+
+
+def measure(function, repeats):
+    # best wall time of repeats runs, then one more run under tracemalloc for the peak memory in MB
+    seconds = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        result = function()
+        seconds.append(time.perf_counter() - start)
+    tracemalloc.start()
+    try:
+        function()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return result, min(seconds), peak / 2 ** 20
+
+
+def profiling_stages(path, repeats):
+    # the profiling hot paths of one data file, each timed on its own (the stage memoization is bypassed)
+    _, seconds, peak = measure(lambda: ingest(path), repeats)
+    timings = {'ingestion': (seconds, peak)}
+    loaded = load_data('pandas', path)
+    params = tuple(loaded['params'])
+    _, seconds, peak = measure(lambda: frame_statistics(loaded['frame'], loaded['group_col'], params), repeats)
+    timings['group_statistics'] = (seconds, peak)
+
+    stats = stats_stage.__wrapped__(loaded, params)
+    groups = tuple('group_' + str(group) for group in loaded['stats']['size'].index)
+    control_group = groups[0]
+    directions = tuple('both' for _ in params)
+    counts = tuple(COUNTS[:len(params)])
+    sweep, seconds, peak = measure(lambda: sweep_stage.__wrapped__(loaded, stats, groups, control_group, params,
+                                                                   directions, counts, SD_STEP), repeats)
+    timings['sd_sweep'] = (seconds, peak)
+
+    max_of_max = sweep['max_of_max']
+    dev_high = max_of_max['SD']
+    dev_low = round(dev_high * 0.7, 2)
+    classify = classify_stage.__wrapped__(loaded, sweep, groups, params, counts, dev_high)
+    level_counts, seconds, peak = measure(lambda: level_counts_stage.__wrapped__(sweep, SD_STEP), repeats)
+    timings['two_level_sd_grid'] = (seconds, peak)
+    two_level, seconds, peak = measure(lambda: two_level_stage.__wrapped__(loaded, sweep, level_counts, classify,
+                                                                           groups, control_group, dev_high, dev_low),
+                                       repeats)
+    timings['two_level_classification'] = (seconds, peak)
+    _, seconds, peak = measure(lambda: level_percentages(two_level, groups, sweep['group_len'],
+                                                         two_level['medium_default'], two_level['high_default']),
+                               repeats)
+    timings['two_level_cut_points'] = (seconds, peak)
+    _, seconds, peak = measure(lambda: param_table(final_table_stage.__wrapped__(loaded, classify, params,
+                                                                                 max_of_max['# of params'])), repeats)
+    timings['final_table'] = (seconds, peak)
+    _, seconds, peak = measure(lambda: param_table(two_level_final_table_stage.__wrapped__(
+        loaded, sweep, classify, two_level, params, max_of_max['# of params'], dev_high, dev_low)), repeats)
+    timings['final_table_two_levels'] = (seconds, peak)
+    return timings
+
+
+def paired_stages(path, repeats):
+    # the paired analysis hot paths of one paired data file
+    loaded = load_data('pandas', path)
+    diffs, seconds, peak = measure(lambda: paired_diffs_stage.__wrapped__(loaded), repeats)
+    timings = {'paired_diffs': (seconds, peak)}
+    _, seconds, peak = measure(lambda: paired_classify_stage.__wrapped__(diffs, tuple(STDS)), repeats)
+    timings['paired_classification'] = (seconds, peak)
+    return timings
+
+
+def backend_stages(name, path, paired_path, repeats):
+    # the core computations of one backend on a parquet file. tracemalloc only sees the python allocations, the
+    # peak of a native engine is not measured
+    backend = get_backend(name)
+    data = backend.load(path)[0]
+    columns = backend.columns(data)
+    group_col, params = columns[0], columns[2:]
+    stats, seconds, peak = measure(lambda: backend.group_statistics(data, group_col, params), repeats)
+    timings = {name + '_group_statistics': (seconds, peak)}
+    groups = list(stats['size'].index)
+    control = groups[0]
+    _, seconds, peak = measure(lambda: backend.thresholds(data, group_col, groups, params, ['both'] * len(params),
+                                                          stats['mean'][control], stats['std'][control],
+                                                          COUNTS[:len(params)]), repeats)
+    timings[name + '_thresholds'] = (seconds, peak)
+    if paired_path:
+        paired_data = backend.load(paired_path)[0]
+        paired_columns = backend.columns(paired_data)
+        task_groups = task_parameter_groups(paired_columns[2:])
+        _, seconds, peak = measure(lambda: backend.paired_task_sums(paired_data, paired_columns[0], paired_columns[1],
+                                                                    task_groups, 1.0), repeats)
+        timings[name + '_paired_task_sums'] = (seconds, peak)
+    return timings
+
+
+def check_backends(names, path, paired_path, rtol=1e-9):
+    # result equivalence of the backends with the pandas reference, returns the differences found
+    reference = get_backend('pandas')
+    problems = []
+    for name in names:
+        backend = get_backend(name)
+        results = []
+        for engine in [reference, backend]:
+            data = engine.load(path)[0]
+            columns = engine.columns(data)
+            group_col, params = columns[0], columns[2:]
+            stats = engine.group_statistics(data, group_col, params)
+            groups = list(stats['size'].index)
+            directions = [['both', 'above control', 'below control'][i % 3] for i in range(len(params))]
+            thresholds = engine.thresholds(data, group_col, groups, params, directions, stats['mean'][groups[0]],
+                                           stats['std'][groups[0]], COUNTS[:len(params)])
+            paired_data = engine.load(paired_path)[0]
+            paired_columns = engine.columns(paired_data)
+            task_sums = engine.paired_task_sums(paired_data, paired_columns[0], paired_columns[1],
+                                                task_parameter_groups(paired_columns[2:]), 1.0)
+            results.append((stats, thresholds, task_sums))
+        (stats_a, thresholds_a, sums_a), (stats_b, thresholds_b, sums_b) = results
+        try:
+            pd.testing.assert_series_equal(stats_a['size'], stats_b['size'], check_names=False,
+                                           check_index_type=False)
+            for statistic in ['count', 'mean', 'std']:
+                pd.testing.assert_frame_equal(stats_a[statistic], stats_b[statistic], rtol=rtol, check_names=False,
+                                              check_column_type=False)
+            for group_a, group_b in zip(thresholds_a, thresholds_b):
+                np.testing.assert_allclose(group_a, group_b, rtol=rtol)
+            pd.testing.assert_frame_equal(sums_a, sums_b, check_names=False, check_index_type=False)
+        except AssertionError as error:
+            problems.append(name + ': ' + str(error).strip().splitlines()[0])
+    return problems
+
+
+def run(scales, repeats=3, missing_rate=0.05, seed=0, paired=True, backends=(), check=False):
+    results = []
+    with tempfile.TemporaryDirectory() as folder:
+        for scale in scales:
+            subjects, n_params = parse_scale(scale)
+            cohort = make_cohort(GROUPS, max(2, subjects // GROUPS), n_params, TASKS, missing_rate, seed=seed)
+            path = os.path.join(folder, 'cohort_' + scale + '.csv')
+            write_cohort(cohort, path)
+            timings = profiling_stages(path, repeats)
+            paired_cohort = make_cohort(2, max(2, subjects // 2), n_params, TASKS, missing_rate, paired=True,
+                                        seed=seed)
+            if paired:
+                paired_path = os.path.join(folder, 'paired_' + scale + '.csv')
+                write_cohort(paired_cohort, paired_path)
+                timings.update(paired_stages(paired_path, repeats))
+            if backends or check:
+                parquet_path = os.path.join(folder, 'cohort_' + scale + '.parquet')
+                paired_parquet_path = os.path.join(folder, 'paired_' + scale + '.parquet')
+                write_cohort(cohort, parquet_path)
+                write_cohort(paired_cohort, paired_parquet_path)
+                for name in backends:
+                    timings.update(backend_stages(name, parquet_path, paired_parquet_path if paired else None,
+                                                  repeats))
+                if check:
+                    names = [name for name in available_backends() if name != 'pandas']
+                    problems = check_backends(names, parquet_path, paired_parquet_path)
+                    print('{:>12} backends {} {}'.format(scale, ', '.join(['pandas'] + names),
+                                                         'differ: ' + '; '.join(problems) if problems else 'agree'))
+                    if problems:
+                        raise SystemExit(1)
+            for stage_name, (seconds, peak) in timings.items():
+                results.append({'scale': scale, 'subjects': subjects, 'params': n_params, 'stage': stage_name,
+                                'seconds': round(seconds, 6), 'peak_mb': round(peak, 3)})
+                print('{:>12} {:<28} {:>10.4f} s {:>10.1f} MB'.format(scale, stage_name, seconds, peak))
+    return results
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description='Time the profiling and paired analysis hot paths on synthetic data')
+    parser.add_argument('--scales', nargs='+', default=DEFAULT_SCALES, help='<subjects>x<parameters> data sizes')
+    parser.add_argument('--repeats', type=int, default=3, help='timed runs per stage, the best one is reported')
+    parser.add_argument('--missing-rate', type=float, default=0.05)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--no-paired', action='store_true', help='skip the paired analysis stages')
+    parser.add_argument('--backends', nargs='+', choices=BACKENDS, default=[],
+                        help='also time the core computations of these backends on parquet copies of the data')
+    parser.add_argument('--check-backends', action='store_true',
+                        help='check that the installed backends give the results of the pandas reference')
+    parser.add_argument('-o', '--output', default='bench_report.json', help='json report file')
+    args = parser.parse_args(args)
+
+    results = run(args.scales, args.repeats, args.missing_rate, args.seed, not args.no_paired, args.backends,
+                  args.check_backends)
+    report = {'created': datetime.now(timezone.utc).isoformat(),
+              'python': platform.python_version(),
+              'numpy': np.__version__,
+              'pandas': pd.__version__,
+              'machine': platform.machine(),
+              'repeats': args.repeats,
+              'results': results}
+    with open(args.output, 'w') as file:
+        json.dump(report, file, indent=2)
+
+
+if __name__ == '__main__':
+    main()
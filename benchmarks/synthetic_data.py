@@ -0,0 +1,64 @@
+import argparse
+import numpy as np
+import pandas as pd
+
+
+def make_cohort(groups=3, subjects_per_group=20, n_params=10, tasks=('task1', 'task2'), missing_rate=0.0,
+                effect_size=1.0, affected_fraction=0.5, paired=False, seed=0):
+    # synthetic data file in the resources/datafile_template.csv layout: Group, SubjectID and the parameters.
+    # parameters are named <task>_p<number> so paired_affected_v1.1.py splits them into tasks. every group after the
+    # first is shifted by effect_size SDs in affected_fraction of the parameters. with paired=True the groups are
+    # time points 0, 1, ... of the same subjects
+    rng = np.random.default_rng(seed)
+    params = [tasks[i % len(tasks)] + '_p' + str(i + 1) for i in range(n_params)]
+    n_affected = int(round(n_params * affected_fraction))
+    shift = np.zeros(n_params)
+    shift[rng.choice(n_params, n_affected, replace=False)] = effect_size * rng.choice([-1, 1], n_affected)
+    base = rng.normal(10, 2, n_params)
+
+    group_values = list(range(groups)) if paired else list(range(1, groups + 1))
+    subject_ids = np.arange(1, subjects_per_group + 1)
+    frames = []
+    for position, group in enumerate(group_values):
+        values = base + rng.normal(0, 2, (subjects_per_group, n_params)) + shift * 2 * position
+        frame = pd.DataFrame(values, columns=params)
+        frame.insert(0, 'SubjectID', subject_ids if paired else [str(group) + '_' + str(i) for i in subject_ids])
+        frame.insert(0, 'Group', group)
+        frames.append(frame)
+    data = pd.concat(frames, ignore_index=True)
+    if missing_rate > 0:
+        values = data[params].to_numpy()
+        values[rng.random(values.shape) < missing_rate] = np.nan
+        data[params] = values
+    return data
+
+
+def write_cohort(data, path):
+    # csv, parquet or feather by the file extension
+    if path.endswith(('.parquet', '.pq')):
+        data.to_parquet(path, index=False)
+    elif path.endswith(('.feather', '.arrow')):
+        data.to_feather(path)
+    else:
+        data.to_csv(path, index=False)
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description='Write a synthetic behavioral data file')
+    parser.add_argument('path', help='output file, .csv, .parquet or .feather')
+    parser.add_argument('--groups', type=int, default=3)
+    parser.add_argument('--subjects', type=int, default=20, help='subjects per group')
+    parser.add_argument('--params', type=int, default=10)
+    parser.add_argument('--tasks', nargs='+', default=['task1', 'task2'], help='task prefixes of the parameters')
+    parser.add_argument('--missing-rate', type=float, default=0.0)
+    parser.add_argument('--effect-size', type=float, default=1.0, help='group shift in control SDs')
+    parser.add_argument('--affected-fraction', type=float, default=0.5, help='fraction of shifted parameters')
+    parser.add_argument('--paired', action='store_true', help='groups are time points of the same subjects')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args(args)
+    write_cohort(make_cohort(args.groups, args.subjects, args.params, args.tasks, args.missing_rate, args.effect_size,
+                             args.affected_fraction, args.paired, args.seed), args.path)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,48 @@
+import io
+from functools import lru_cache
+from matplotlib.figure import Figure
+
+
+PIE_COLUMNS = 3
+CHART_CACHE_SIZE = 32
+AFFECTED_PIE = (('Affected', 'Unaffected'), ('0.7', '0.85'), (0.1, 0))
+TWO_LEVEL_PIE = (('Highly Affected', 'Medium Affected', 'Not Affected'), ('0.7', '0.6', '0.85'), (0.1, 0.1, 0))
+
+
+@lru_cache(maxsize=CHART_CACHE_SIZE)
+def pie_grid(pies, labels, colors, explode):
+    # png of all the groups' pie charts in one grid figure, pies is a tuple of (title, sizes) per group.
+    # cached on the titles and percentages, so a chart is only drawn again when its data changes. the figure is not
+    # registered with pyplot and is freed with the function's references
+    n_cols = min(PIE_COLUMNS, len(pies))
+    n_rows = -(-len(pies) // n_cols)
+    figure = Figure(figsize=(6.4 * n_cols, 4.8 * n_rows))
+    axes = figure.subplots(n_rows, n_cols, squeeze=False)
+    for ax, (title, sizes) in zip(axes.flat, pies):
+        ax.set_title(title, fontsize=18)
+        ax.pie(sizes,
+               explode=explode,
+               labels=labels,
+               autopct='%1.1f%%',
+               shadow=True,
+               startangle=90,
+               colors=colors,
+               textprops={'fontsize': 14})
+        ax.axis('equal')  # Equal aspect ratio ensures that pie is drawn as a circle.
+    for ax in axes.flat[len(pies):]:
+        ax.axis('off')
+    buffer = io.BytesIO()
+    figure.savefig(buffer, format='png')
+    return buffer.getvalue()
+
+
+def affected_pies(titles, percentages):
+    # 1 level: the affected percentage of every group
+    pies = tuple((title, (slice_high / 100, 1 - slice_high / 100)) for title, slice_high in zip(titles, percentages))
+    return pie_grid(pies, *AFFECTED_PIE)
+
+
+def two_level_pies(titles, percentages):
+    # 2 levels: the highly and medium affected percentages of every group
+    pies = tuple((title, (high, medium, 100 - (high + medium))) for title, (high, medium) in zip(titles, percentages))
+    return pie_grid(pies, *TWO_LEVEL_PIE)
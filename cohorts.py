@@ -0,0 +1,103 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import pandas as pd
+from group_stats import group_label
+from pipeline import file_fingerprint, load_stage, loaded_frame, stage
+from profiling_engine import directional_scores, group_indices, count_thresholds, threshold_curves, fine_sd_levels, \
+    find_max_of_max
+
+
+COHORT_WORKERS = 4
+
+
+def cohort_names(data_files):
+    # cohort name of every file, its name without the extension, numbered when two files share a name
+    names = []
+    for data_file in data_files:
+        name = os.path.splitext(os.path.basename(str(getattr(data_file, 'name', data_file))))[0]
+        names.append(name if name not in names else name + '_' + str(len(names) + 1))
+    return names
+
+
+def load_cohorts(data_files, backend_name='pandas', workers=COHORT_WORKERS):
+    # load the cohorts' files concurrently, each through the memoized load stage
+    with ThreadPoolExecutor(max(1, min(workers, len(data_files)))) as executor:
+        return list(executor.map(lambda data_file: load_stage(file_fingerprint(data_file), backend_name,
+                                                              data_file=data_file), data_files))
+
+
+def cohort_groups(loaded):
+    # group labels of a cohort in order of first appearance, with their values in the data file
+    return {group_label(value): value for value in loaded['stats']['size'].index}
+
+
+def merged_statistics(counts, means, stds):
+    # chan's parallel merge of per cohort count, mean and sd (ddof=1), cohorts x parameters arrays, into the count,
+    # mean and sd of all the cohorts' subjects
+    counts = np.asarray(counts, dtype=float)
+    present = counts > 0
+    means = np.where(present, means, 0)
+    total = counts.sum(axis=0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mean = (counts * means).sum(axis=0) / total
+        m2 = np.where(counts > 1, np.asarray(stds, dtype=float) ** 2 * (counts - 1), 0).sum(axis=0) + \
+            np.where(present, counts * (means - mean) ** 2, 0).sum(axis=0)
+        std = np.where(total > 1, np.sqrt(m2 / (total - 1)), np.nan)
+    return total, np.where(total > 0, mean, np.nan), std
+
+
+def control_statistics(cohorts, params, control_group, pooled):
+    # control mean and sd of every cohort, cohorts x parameters arrays. pooled: the control subjects of all the
+    # cohorts as one group, merged from the statistics collected while reading (the raw data is not read again)
+    counts, means, stds = [], [], []
+    for loaded in cohorts:
+        control_value = cohort_groups(loaded)[control_group]
+        counts.append(loaded['stats']['count'][control_value].reindex(params).to_numpy(dtype=float))
+        means.append(loaded['stats']['mean'][control_value].reindex(params).to_numpy(dtype=float))
+        stds.append(loaded['stats']['std'][control_value].reindex(params).to_numpy(dtype=float))
+    if pooled:
+        _, mean, std = merged_statistics(counts, means, stds)
+        return np.tile(mean, (len(cohorts), 1)), np.tile(std, (len(cohorts), 1))
+    return np.array(means), np.array(stds)
+
+
+@stage()
+def cohort_sweep_stage(cohort_keys, names, params, directions, control_group, pooled, counts, sd_step, cohorts=None):
+    # one sweep over the subjects of all the cohorts: every subject is scored against its cohort's (or the pooled)
+    # control statistics, the groups of all cohorts are swept together and each cohort's optimum is found against
+    # its own control subjects. cohorts are the loaded cohorts, keyed by cohort_keys
+    params = list(params)
+    control_mean, control_std = control_statistics(cohorts, params, control_group, pooled)
+    values, cohort_index, group_index, groups = [], [], [], []
+    for position, loaded in enumerate(cohorts):
+        labels = list(cohort_groups(loaded))
+        values.append(loaded_frame(loaded, params).to_numpy(dtype=float))
+        cohort_index.append(np.full(len(loaded['group_labels']), position))
+        group_index.append(group_indices(loaded['group_labels'], labels) + len(groups))
+        groups += [(names[position], label) for label in labels]
+    cohort_index = np.concatenate(cohort_index)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        z_scores = (np.vstack(values) - control_mean[cohort_index]) / control_std[cohort_index]
+    scores = directional_scores(z_scores, list(directions))
+    thresholds = count_thresholds(scores, np.concatenate(group_index), len(groups), counts)
+
+    sd_levels = fine_sd_levels(sd_step)
+    percentages = threshold_curves(thresholds, sd_levels)
+    max_of_max = {}
+    for name in names:
+        positions = [position for position, (cohort, _) in enumerate(groups) if cohort == name]
+        cohort_labels = [groups[position][1] for position in positions]
+        max_of_max[name] = find_max_of_max(percentages[:, :, positions], cohort_labels.index(control_group), counts,
+                                           sd_levels)
+    return {'groups': groups, 'thresholds': thresholds, 'max_of_max': max_of_max,
+            'control_mean': control_mean, 'control_std': control_std}
+
+
+def cohort_curves(sweep, counts, sd):
+    # long table of the percentage of affected subjects of every cohort and group at one SD level, for an overlay
+    percentages = threshold_curves(sweep['thresholds'], [sd])[0]
+    return pd.DataFrame({'Cohort': np.repeat([cohort for cohort, _ in sweep['groups']], len(counts)),
+                         'Group': np.repeat([group for _, group in sweep['groups']], len(counts)),
+                         'Number of parameters': np.tile(np.asarray(counts), len(sweep['groups'])),
+                         'Percentage': percentages.T.ravel()})
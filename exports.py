@@ -0,0 +1,35 @@
+import gzip
+import io
+import zipfile
+from functools import lru_cache
+import pandas as pd
+
+
+EXPORT_FORMATS = ['csv.gz', 'parquet']
+ZIP_DATE = (1980, 1, 1, 0, 0, 0)  # fixed entry dates, the same tables give the same bundle bytes
+
+
+def table_bytes(table, export_format, index=False):
+    # one table as gzip compressed csv or parquet
+    if export_format == 'csv.gz':
+        return gzip.compress(table.to_csv(index=index).encode('utf-8'), mtime=0)
+    buffer = io.BytesIO()
+    table.to_parquet(buffer, index=index)
+    return buffer.getvalue()
+
+
+def bundle(tables, export_format):
+    # zip of named tables, tables maps a file name to (table, write the index). the entries are compressed already
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_STORED) as archive:
+        for name, (table, index) in tables.items():
+            entry = zipfile.ZipInfo(name + '.' + export_format, ZIP_DATE)
+            archive.writestr(entry, table_bytes(table, export_format, index))
+    return buffer.getvalue()
+
+
+@lru_cache(maxsize=16)
+def preferences_csv(directions):
+    # directions preferences file of (parameter, direction, icon) tuples, only serialized when the directions change
+    return pd.DataFrame({param: {'direction': direction, 'dir_icon': icon} for param, direction, icon in directions}) \
+        .to_csv(index=False)
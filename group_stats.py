@@ -0,0 +1,32 @@
+def group_label(value):
+    # name of a group in the app, e.g. 'group_1', from its value in the data file
+    return 'group_' + str(value)
+
+
+def labeled(stats_table):
+    # parameter x group table with the group columns named as in the app (group_<value>)
+    return stats_table.rename(columns=group_label)
+
+
+def effect_sizes(group_mean, group_std, control_group, groups):
+    # per parameter effect sizes of the groups against the control group, the largest over the groups: absolute mean
+    # difference relative to the control mean, the sd ratio furthest from 1 and the mean difference in control sds.
+    # a zero or missing sd gives no sd ratio. rows are ranked by the standardized difference
+    others = [group for group in groups if group != control_group]
+    control_mean = group_mean[control_group]
+    control_std = group_std[control_group].where(group_std[control_group] > 0)
+    mean_gap = group_mean[others].sub(control_mean, axis=0).abs().max(axis=1)
+    ratios = group_std[others].where(group_std[others] > 0).div(control_std, axis=0)
+    low_ratio = ratios.min(axis=1)
+    high_ratio = ratios.max(axis=1)
+    effects = mean_gap.div(control_mean).to_frame('mean difference')
+    effects['sd ratio'] = high_ratio.where((high_ratio - 1).abs() >= (1 - low_ratio).abs(), low_ratio)
+    effects['standardized difference'] = mean_gap / control_std
+    return effects.sort_values('standardized difference', ascending=False, kind='stable')
+
+
+def screened(effects, mean_difference, deviation_difference):
+    # parameters whose mean differs from the control by more than mean_difference of the control mean, or whose sd
+    # ratio is outside 1 +- deviation_difference
+    return (effects['mean difference'] > mean_difference) | (effects['sd ratio'] < 1 - deviation_difference) | \
+        (effects['sd ratio'] > 1 + deviation_difference)
@@ -0,0 +1,163 @@
+import os
+from contextlib import nullcontext
+import numpy as np
+import pandas as pd
+
+
+CHUNK_SIZE = 50000
+PARQUET_BUFFER_SIZE = 1 << 20  # parquet pages are read through a buffer, not a whole row group at once
+PARQUET_EXTENSIONS = ('.parquet', '.pq')
+ARROW_EXTENSIONS = ('.arrow', '.feather', '.ipc')
+DATA_FILE_TYPES = ['csv', 'parquet', 'pq', 'arrow', 'feather', 'ipc']
+
+
+def file_extension(data_file):
+    # extension of a path or of an uploaded file's name
+    return os.path.splitext(str(getattr(data_file, 'name', data_file)))[1].lower()
+
+
+def read_chunks(data_file, chunksize=CHUNK_SIZE):
+    # yield the data file as dataframes of at most chunksize rows. csv, parquet and arrow ipc (feather) are accepted
+    extension = file_extension(data_file)
+    if extension in PARQUET_EXTENSIONS:
+        import pyarrow.parquet as pq
+        for batch in pq.ParquetFile(data_file, buffer_size=PARQUET_BUFFER_SIZE).iter_batches(batch_size=chunksize):
+            yield batch.to_pandas()
+    elif extension in ARROW_EXTENSIONS:
+        import pyarrow as pa
+        try:
+            reader = pa.ipc.open_file(data_file)
+            batches = (reader.get_batch(i) for i in range(reader.num_record_batches))
+        except pa.ArrowInvalid:  # arrow ipc stream format
+            if hasattr(data_file, 'seek'):
+                data_file.seek(0)
+            batches = pa.ipc.open_stream(data_file)
+        for batch in batches:
+            yield batch.to_pandas()
+    else:
+        yield from pd.read_csv(data_file, chunksize=chunksize)
+
+
+def to_numeric_chunk(chunk):
+    # lower case the column names and convert non numeric parameter values to nan
+    chunk = chunk.rename(lambda text: str(text).lower(), axis=1)
+    params = chunk.columns[2:]
+    chunk[params] = chunk[params].apply(lambda value: pd.to_numeric(value, errors='coerce'))
+    return chunk
+
+
+class OnlineGroupStats:
+    # per group count, mean and std of the parameters, accumulated chunk by chunk with Welford / Chan updates so the
+    # statistics are known without the whole raw file in memory. statistics() returns 'size', a series of rows per
+    # group, and 'count', 'mean' and 'std' parameter x group tables keyed by the real group values, in order of first
+    # appearance in the data file
+
+    def __init__(self, params):
+        self.params = list(params)
+        self.size = {}
+        self.count = {}
+        self.mean = {}
+        self.m2 = {}
+
+    def update(self, chunk, group_col):
+        grouped = chunk.groupby(group_col, sort=False)
+        chunk_count = grouped[self.params].count()
+        chunk_mean = grouped[self.params].mean()
+        chunk_m2 = grouped[self.params].var(ddof=0) * chunk_count
+        for group, group_size in grouped.size().items():
+            count_b = chunk_count.loc[group].to_numpy(dtype=float)
+            mean_b = chunk_mean.loc[group].to_numpy(dtype=float)
+            m2_b = chunk_m2.loc[group].to_numpy(dtype=float)
+            if group not in self.size:
+                self.size[group] = 0
+                self.count[group] = np.zeros(len(self.params))
+                self.mean[group] = np.zeros(len(self.params))
+                self.m2[group] = np.zeros(len(self.params))
+            count_a, mean_a, m2_a = self.count[group], self.mean[group], self.m2[group]
+            total = count_a + count_b
+            with np.errstate(divide='ignore', invalid='ignore'):
+                delta = np.where(count_b > 0, mean_b - mean_a, 0)
+                weight_b = np.where(total > 0, count_b / total, 0)
+            self.size[group] += group_size
+            self.mean[group] = mean_a + delta * weight_b
+            self.m2[group] = m2_a + np.where(count_b > 0, m2_b, 0) + delta ** 2 * count_a * weight_b
+            self.count[group] = total
+
+    def statistics(self):
+        groups = list(self.size)
+        count = pd.DataFrame(self.count, index=self.params, columns=groups)
+        mean = pd.DataFrame(self.mean, index=self.params, columns=groups).where(count > 0)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            std = np.sqrt(pd.DataFrame(self.m2, index=self.params, columns=groups) / (count - 1)).where(count > 1)
+        return {'size': pd.Series(self.size, dtype=np.int64),
+                'count': count.astype(np.int64),
+                'mean': mean,
+                'std': std}
+
+
+def frame_statistics(data_df, group_col, params, chunksize=CHUNK_SIZE):
+    # the group statistics of ingest for a frame in memory, accumulated over the same chunks
+    stats = OnlineGroupStats(params)
+    for start in range(0, len(data_df), chunksize):
+        stats.update(data_df.iloc[start:start + chunksize], group_col)
+    return stats.statistics()
+
+
+def read_template(template_file):
+    # directions preferences template saved by the app: one column per parameter, first row holds the direction
+    template = pd.read_csv(template_file)
+    template.rename(lambda text: str(text).lower(), axis=1, inplace=True)
+    return template
+
+
+def row_capacity(data_file, block_size=1 << 20):
+    # an upper bound of the number of rows, known without parsing the file: the parquet metadata or the lines of a
+    # csv. None for arrow ipc, whose row count is only known once its batches are read
+    extension = file_extension(data_file)
+    if extension in ARROW_EXTENSIONS:
+        return None
+    if extension in PARQUET_EXTENSIONS:
+        import pyarrow.parquet as pq
+        rows = pq.ParquetFile(data_file).metadata.num_rows
+    else:
+        rows = 1
+        with (open(data_file, 'rb') if isinstance(data_file, (str, os.PathLike)) else nullcontext(data_file)) as file:
+            block = file.read(block_size)
+            while block:
+                rows += block.count(b'\n' if isinstance(block, bytes) else '\n')
+                block = file.read(block_size)
+    if hasattr(data_file, 'seek'):
+        data_file.seek(0)
+    return rows
+
+
+def ingest(data_file, chunksize=CHUNK_SIZE):
+    # read the data file chunk by chunk, coercing each chunk to numbers and updating the group statistics.
+    # returns the numeric data frame and its group statistics. the parameters of every chunk are written into one
+    # array allocated for all the rows of the file, so the peak memory stays close to one copy of the data
+    capacity = row_capacity(data_file)
+    values = None
+    keys = []
+    rows = 0
+    stats = None
+    for chunk in read_chunks(data_file, chunksize):
+        chunk = to_numeric_chunk(chunk)
+        if stats is None:
+            stats = OnlineGroupStats(chunk.columns[2:])
+            # rows x parameters, filled chunk after chunk. the frame is built on the array without a copy
+            values = np.empty((capacity or len(chunk), len(stats.params)))
+        stats.update(chunk, chunk.columns[0])
+        if rows + len(chunk) > len(values):  # arrow ipc, the array grows as the batches are read
+            grown = np.empty((max(2 * len(values), rows + len(chunk)), len(stats.params)))
+            grown[:rows] = values[:rows]
+            values = grown
+        values[rows:rows + len(chunk)] = chunk[stats.params].to_numpy(dtype=float)
+        rows += len(chunk)
+        keys.append(chunk.iloc[:, :2].copy())
+    if stats is None:
+        raise ValueError('the data file is empty')
+    data = pd.DataFrame(values[:rows], columns=stats.params, copy=False)
+    key_columns = pd.concat(keys, ignore_index=True)
+    data.insert(0, key_columns.columns[0], key_columns.iloc[:, 0])
+    data.insert(1, key_columns.columns[1], key_columns.iloc[:, 1])
+    return data, stats.statistics()
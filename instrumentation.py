@@ -0,0 +1,151 @@
+import cProfile
+import io
+import json
+import marshal
+import os
+import pstats
+import threading
+import time
+import tracemalloc
+import uuid
+from contextlib import contextmanager
+from datetime import datetime, timezone
+import pandas as pd
+
+
+SPAN_LOG = os.environ.get('PROFILING_SPAN_LOG', 'profiling_spans.jsonl')
+SPAN_COLUMNS = ['span', 'seconds', 'rows', 'cols', 'cached', 'peak_mb']
+PROFILE_LINES = 40
+
+_local = threading.local()
+_log_lock = threading.Lock()
+
+
+def _open_spans():
+    # spans open in this thread (streamlit runs every session in its own thread), innermost last
+    if not hasattr(_local, 'spans'):
+        _local.spans = []
+    return _local.spans
+
+
+def annotate(**fields):
+    # add fields to the innermost open span of this thread, if any
+    open_spans = _open_spans()
+    if open_spans:
+        open_spans[-1].update(fields)
+
+
+def profiling():
+    # True inside a span that runs under cProfile, memoized stages then recompute instead of returning a cached result
+    return any(record.get('_profiled') for record in _open_spans())
+
+
+class SpanRecorder:
+    # named spans of one run of a script: wall time, rows / columns handled, stage cache hits and optionally the
+    # peak traced memory. finished spans are kept in order and appended to a json lines log. the span named
+    # `profiled` runs under cProfile. peak memory is process wide, so it includes concurrent sessions
+
+    def __init__(self, script, log_path=SPAN_LOG, trace_memory=False, profiled=None, show=False):
+        self.script = script
+        self.show = show
+        self.run = uuid.uuid4().hex[:12]
+        self.log_path = log_path
+        self.trace_memory = trace_memory
+        self.profiled = profiled
+        self.spans = []
+        self.profile = None
+
+    @contextmanager
+    def span(self, name, rows=None, cols=None):
+        record = {'span': name, 'rows': rows, 'cols': cols}
+        open_spans = _open_spans()
+        started_tracing = False
+        if self.trace_memory:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+                started_tracing = True
+            current, peak = tracemalloc.get_traced_memory()
+            if open_spans:  # keep the enclosing span's peak before starting this span's own
+                open_spans[-1]['_peak'] = max(open_spans[-1].get('_peak', 0), peak)
+            tracemalloc.reset_peak()
+            record['_base'] = current
+        profiler = None
+        if name == self.profiled:
+            profiler = cProfile.Profile()
+            record['_profiled'] = True
+        open_spans.append(record)
+        start = time.perf_counter()
+        try:
+            if profiler is not None:
+                profiler.enable()
+            yield record
+        finally:
+            if profiler is not None:
+                profiler.disable()
+                self.profile = profiler
+            record['seconds'] = time.perf_counter() - start
+            open_spans.pop()
+            if self.trace_memory:
+                peak = max(tracemalloc.get_traced_memory()[1], record.get('_peak', 0))
+                record['peak_mb'] = (peak - record['_base']) / 2 ** 20
+                if started_tracing:
+                    tracemalloc.stop()
+            self.finish(record)
+
+    def finish(self, record):
+        record = {key: value for key, value in record.items() if not key.startswith('_')}
+        record.update({'script': self.script,
+                       'run': self.run,
+                       'time': datetime.now(timezone.utc).isoformat()})
+        self.spans.append(record)
+        if self.log_path:
+            try:
+                with _log_lock, open(self.log_path, 'a') as log:
+                    log.write(json.dumps(record, default=str) + '\n')
+            except OSError:  # the log is best effort, e.g. on a read only deployment
+                pass
+
+    def table(self):
+        # spans of this run in the order they finished
+        spans = pd.DataFrame(self.spans)
+        return spans.reindex(columns=[column for column in SPAN_COLUMNS if column in spans.columns])
+
+    def profile_report(self, lines=PROFILE_LINES):
+        # cumulative time listing of the profiled span
+        stream = io.StringIO()
+        pstats.Stats(self.profile, stream=stream).sort_stats('cumulative').print_stats(lines)
+        return stream.getvalue()
+
+    def profile_bytes(self):
+        # the profile in the pstats file format (as written by dump_stats), for snakeviz and friends
+        return marshal.dumps(pstats.Stats(self.profile).stats)
+
+
+def sidebar_recorder(script):
+    # sidebar switches of the instrumentation, returns the recorder of this run
+    import streamlit as st
+    with st.sidebar.expander('Performance'):
+        show = st.checkbox('Show stage timings', key='instrumentation_show')
+        trace_memory = st.checkbox('Trace peak memory', key='instrumentation_memory',
+                                   help='Measures the peak memory of every stage, the app runs slower meanwhile')
+        span_names = st.session_state.get('instrumentation_spans', [])
+        profiled = st.selectbox('Profile a stage with cProfile', ['None'] + span_names, key='instrumentation_profiled')
+    return SpanRecorder(script, trace_memory=trace_memory, profiled=None if profiled == 'None' else profiled,
+                        show=show)
+
+
+def sidebar_panel(recorder):
+    # the spans of this run and the profile of the profiled span, in the sidebar
+    import streamlit as st
+    # span names seen in this session, kept so the profiled stage stays selectable
+    st.session_state['instrumentation_spans'] = list(dict.fromkeys(
+        st.session_state.get('instrumentation_spans', []) + [span['span'] for span in recorder.spans]))
+    if recorder.show and recorder.spans:
+        st.sidebar.subheader('Stage timings')
+        st.sidebar.dataframe(recorder.table())
+    if recorder.profile is not None:
+        st.sidebar.subheader('Profile of ' + recorder.profiled)
+        st.sidebar.text(recorder.profile_report(20))
+        st.sidebar.download_button('Download profile', data=recorder.profile_bytes(),
+                                   file_name=recorder.script + '_' + recorder.profiled.replace(' ', '_') + '.prof',
+                                   mime='application/octet-stream')
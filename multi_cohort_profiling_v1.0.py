@@ -0,0 +1,82 @@
+import streamlit as st
+import pandas as pd
+import plotly.express as px
+from cohorts import cohort_names, load_cohorts, cohort_groups, cohort_sweep_stage, cohort_curves
+from profiling_engine import COUNTS, SD_RANGE, SD_STEP
+from ingestion import DATA_FILE_TYPES
+from backends import available_backends
+from instrumentation import sidebar_recorder, sidebar_panel
+from parameter_editor import parameter_editor
+
+# design title of page
+st.title('Behavioral Profiling Algorithm - cohorts')
+st.markdown('_powered by_  **GRL Lab**  :rat:')
+# stage timings of this run, see the Performance switches in the sidebar
+recorder = sidebar_recorder('multi_cohort_profiling')
+# engine of the data loading, the group statistics and the scores, the optional engines when they are installed
+backend_name = st.sidebar.selectbox('Computation backend', available_backends(), key='backend',
+                                    help='polars reads the data file and computes the statistics and scores '
+                                         'multi-threaded, for large cohorts')
+
+st.subheader('1. Upload the data files of the cohorts')
+data_files = st.file_uploader('Upload one data file per cohort, in the behavioral profiling format',
+                              type=DATA_FILE_TYPES, accept_multiple_files=True)
+
+if data_files:
+    # the files are read concurrently, every one through the memoized load stage
+    names = cohort_names(data_files)
+    with recorder.span('load cohorts') as span:
+        cohorts = load_cohorts(data_files, backend_name)
+        span['rows'], span['cols'] = sum(len(loaded['group_labels']) for loaded in cohorts), len(cohorts)
+
+    # parameters and groups shared by all the cohorts
+    params = [param for param in cohorts[0]['params'] if all(param in loaded['params'] for loaded in cohorts[1:])]
+    shared_groups = [group for group in cohort_groups(cohorts[0])
+                     if all(group in cohort_groups(loaded) for loaded in cohorts[1:])]
+    st.table(pd.DataFrame({'subjects': [len(loaded['group_labels']) for loaded in cohorts],
+                           'groups': [', '.join(cohort_groups(loaded)) for loaded in cohorts]}, index=names))
+    if not params or not shared_groups:
+        st.write('The cohorts need at least one parameter and the control group in common to be compared')
+    else:
+        control_group = st.selectbox('Select control group', shared_groups,
+                                     help='The control group has to be in every cohort')
+        pooled = st.radio('Control statistics', ('Per cohort', 'Pooled over the cohorts'), 0, horizontal=True,
+                          help='Score every cohort against its own control group, or against the control groups of '
+                               'all the cohorts taken together') == 'Pooled over the cohorts'
+
+        st.subheader('2. Select parameters for analysis and set their direction')
+        state_key = 'cohort_parameters_' + '_'.join(loaded.key for loaded in cohorts)
+        with recorder.span('parameter editor', len(params), 2):
+            selected_params, directions = parameter_editor(params, params, {param: 'both' for param in params}, None,
+                                                           state_key)
+        if len(selected_params) < 2:
+            st.write('Select at least 2 parameters to continue')
+        else:
+            # 3. one sweep over the subjects of all the cohorts
+            counts = COUNTS[:len(selected_params)]
+            selected_directions = tuple(directions[param] for param in selected_params)
+            with recorder.span('cohort sweep', sum(len(loaded['group_labels']) for loaded in cohorts), len(selected_params)):
+                sweep = cohort_sweep_stage(tuple(loaded.key for loaded in cohorts), tuple(names),
+                                           tuple(selected_params), selected_directions, control_group, pooled,
+                                           tuple(counts), SD_STEP, cohorts=cohorts)
+            st.subheader('The optimal weighted maximum difference between control and exp groups of every cohort')
+            max_of_max = pd.DataFrame.from_dict(sweep['max_of_max'], orient='index')
+            st.table(max_of_max)
+
+            # 4. overlay the curves of all the cohorts at one SD level
+            dev_high = st.slider('Select SD', SD_RANGE[0], SD_RANGE[1], round(float(max_of_max['SD'].median()), 2),
+                                 SD_STEP, help='Defaults to the median of the cohorts\' optimal SD')
+            with recorder.span('line chart', len(counts), len(sweep['groups'])):
+                curves = cohort_curves(sweep, counts, dev_high)
+                c = px.line(curves, x='Number of parameters', y='Percentage', color='Cohort', line_dash='Group',
+                            height=500, range_x=[2, len(selected_params) + 1], range_y=[0, 100])
+                for cohort, optimum in sweep['max_of_max'].items():
+                    c.add_vline(x=optimum['# of params'], line_dash='dot', line_color='darkgray',
+                                annotation_text=cohort, annotation_position='top')
+                c.layout.plot_bgcolor = 'white'
+                c.layout.title = 'Percentage of affected subject for each parameter count, all cohorts'
+                c.update_xaxes(dtick=1)
+                st.plotly_chart(c)
+
+# stage timings and the cProfile output of this run
+sidebar_panel(recorder)
@@ -0,0 +1,167 @@
+import warnings
+import numpy as np
+import pandas as pd
+from itertools import combinations
+
+
+STDS = [float(x / 10) for x in range(0, 21)]
+
+
+def paired_differences(data_df, group_col, subject_col):
+    # differences per subject per parameter: a subject's row whose group is one more than its previous row (pre 0,
+    # post 1) minus that row
+    per_subject_diffs = data_df.groupby([subject_col])[data_df.columns].diff()
+    per_subject_diffs[subject_col] = data_df[subject_col]
+    per_subject_diffs = per_subject_diffs[per_subject_diffs[group_col] == 1].set_index(subject_col)
+    return per_subject_diffs.drop(columns=group_col)
+
+
+def classify_paired_diffs(per_subject_diffs, stds=STDS):
+    # classify every subject x parameter difference against mean +/- std * SD for all the SD levels in one pass.
+    # returns {std: affected (1 / 0)}, {std: affected_full (+1 / -1 / 0)} and {std: '+1' / '-1' / '0' counts}.
+    # missing differences stay nan in the tables and are not counted
+    values = per_subject_diffs.to_numpy(dtype=float)
+    mean = per_subject_diffs.mean().to_numpy(dtype=float)
+    bounds = per_subject_diffs.std().to_numpy(dtype=float)[np.newaxis, :] * np.asarray(stds, dtype=float)[:, np.newaxis]
+    # sd x subject x parameter
+    above = values[np.newaxis, :, :] > (mean + bounds)[:, np.newaxis, :]
+    below = values[np.newaxis, :, :] < (mean - bounds)[:, np.newaxis, :]
+    missing = np.isnan(values)[np.newaxis, :, :]
+    affected_values = np.where(missing, np.nan, (above | below).astype(float))
+    affected_full_values = np.where(missing, np.nan, above.astype(float) - below)
+    plus = above.sum(axis=1)
+    minus = below.sum(axis=1)
+    zero = (~missing).sum(axis=1) - plus - minus
+
+    affected = {}
+    affected_full = {}
+    sign_counts = {}
+    for level, std in enumerate(stds):
+        affected[std] = pd.DataFrame(affected_values[level], index=per_subject_diffs.index,
+                                     columns=per_subject_diffs.columns)
+        affected_full[std] = pd.DataFrame(affected_full_values[level], index=per_subject_diffs.index,
+                                          columns=per_subject_diffs.columns)
+        sign_counts[std] = pd.DataFrame({'+1': plus[level], '-1': minus[level], '0': zero[level]},
+                                        index=per_subject_diffs.columns)
+
+    return affected, affected_full, sign_counts
+
+
+def affected_percentages(affected_sums, n_params):
+    # percentage of subjects with at least 1..n_params affected parameters
+    sums = np.asarray(affected_sums, dtype=float)
+    at_least = (sums[:, np.newaxis] >= np.arange(1, n_params + 1)[np.newaxis, :]).sum(axis=0)
+    with np.errstate(invalid='ignore'):  # no paired subjects
+        return at_least / len(sums) * 100
+
+
+def timepoint_array(data_df, timepoint_col, subject_col, params):
+    # pivot the long table once into a subjects x timepoints x parameters array. subjects are in order of first
+    # appearance and timepoints sorted, present marks the subject x timepoint rows of the file (the last row wins
+    # when a subject has a timepoint twice). rows without a timepoint or a subject are left out
+    rows = (data_df[timepoint_col].notna() & data_df[subject_col].notna()).to_numpy()
+    subject_codes, subjects = pd.factorize(data_df[subject_col][rows])
+    subjects = subjects.rename(subject_col)  # factorize drops the name the differences are indexed by
+    timepoint_codes, timepoints = pd.factorize(data_df[timepoint_col][rows], sort=True)
+    values = np.full((len(subjects), len(timepoints), len(params)), np.nan)
+    values[subject_codes, timepoint_codes] = data_df[list(params)].to_numpy(dtype=float)[rows]
+    present = np.zeros((len(subjects), len(timepoints)), dtype=bool)
+    present[subject_codes, timepoint_codes] = True
+    return subjects, list(timepoints), values, present
+
+
+def timepoint_pairs(n_timepoints, baseline_only=False):
+    # (earlier, later) timepoint positions of every contrast: each session against the first one, or all the pairs
+    if baseline_only:
+        return [(0, later) for later in range(1, n_timepoints)]
+    return list(combinations(range(n_timepoints), 2))
+
+
+def contrast_diffs(values, present, pairs):
+    # later - earlier differences of all the contrasts at once, a pairs x subjects x parameters array. as with the
+    # two timepoint diff, a subject is in a contrast when it has both timepoints
+    earlier, later = np.asarray(pairs, dtype=np.int64).reshape(-1, 2).T
+    diffs = values[:, later].transpose(1, 0, 2) - values[:, earlier].transpose(1, 0, 2)
+    return diffs, (present[:, later] & present[:, earlier]).T
+
+
+def contrast_percentages(diffs, included, stds=STDS):
+    # percentage of the included subjects with at least 1..n_params affected parameters for every contrast and SD
+    # level, a pairs x stds x n_params array. the mean and std of each contrast are over its included subjects
+    n_pairs, _, n_params = diffs.shape
+    diffs = np.where(included[:, :, np.newaxis], diffs, np.nan)
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)  # contrasts without subjects or differences
+        mean = np.nanmean(diffs, axis=1, keepdims=True)
+        std = np.nanstd(diffs, axis=1, ddof=1, keepdims=True)
+    n_included = included.sum(axis=1)
+    thresholds = np.arange(1, n_params + 1)
+    percentages = np.empty((n_pairs, len(stds), n_params))
+    for level, level_std in enumerate(stds):
+        with np.errstate(invalid='ignore'):
+            sums = ((diffs > mean + std * level_std) | (diffs < mean - std * level_std)).sum(axis=2)
+            at_least = ((sums[:, :, np.newaxis] >= thresholds) & included[:, :, np.newaxis]).sum(axis=1)
+            percentages[:, level] = at_least / n_included[:, np.newaxis] * 100
+    return percentages
+
+
+def task_bitmasks(task_flags):
+    # pack a subjects x tasks boolean matrix into per subject bitmasks of affected tasks, 64 tasks per word
+    flags = np.asarray(task_flags, dtype=bool)
+    masks = np.zeros((flags.shape[0], max(1, -(-flags.shape[1] // 64))), dtype=np.uint64)
+    for task in range(flags.shape[1]):
+        masks[flags[:, task], task // 64] |= np.uint64(1) << np.uint64(task % 64)
+    return masks
+
+
+class TaskCombinations:
+    # percentages of subjects affected in every task of a task combination, computed on demand from bitmasks
+    # instead of materializing two columns per combination and SD level. results are cached per SD and combination
+
+    def __init__(self, affected_full, task_names):
+        self.task_names = list(task_names)
+        self.affected_full = affected_full
+        self._masks = {}
+        self._percentages = {}
+
+    def masks(self, std):
+        if std not in self._masks:
+            flags = self.affected_full[std][['bin_affected_' + task for task in self.task_names]].to_numpy()
+            self._masks[std] = task_bitmasks(flags)
+        return self._masks[std]
+
+    def combinations(self, max_size=None):
+        # task combinations in the order of the original column layout, limited to max_size tasks
+        max_size = len(self.task_names) if max_size is None else min(max_size, len(self.task_names))
+        for size in range(1, max_size + 1):
+            yield from combinations(range(len(self.task_names)), size)
+
+    def affected_in_all(self, std, positions):
+        # AND of the subject bitmasks with the combination's bitmask
+        subset = task_bitmasks(np.isin(np.arange(len(self.task_names)), positions)[np.newaxis, :])[0]
+        return np.all((self.masks(std) & subset) == subset, axis=1)
+
+    def percentage(self, std, positions):
+        key = (std, positions)
+        if key not in self._percentages:
+            both = self.affected_in_all(std, positions)
+            self._percentages[key] = both.sum() / len(both) * 100
+        return self._percentages[key]
+
+    def percentages(self, std, max_size=None):
+        return {'bin_' + self.name(positions): self.percentage(std, positions)
+                for positions in self.combinations(max_size)}
+
+    def name(self, positions):
+        return 'affected_' + '_'.join(self.task_names[position] for position in positions)
+
+    def table(self, std, max_size=None):
+        # affected_full table of one SD level with the combination columns materialized, e.g. for download
+        table = self.affected_full[std]
+        columns = {}
+        for positions in self.combinations(max_size):
+            if len(positions) > 1:
+                columns[self.name(positions)] = \
+                    table[['affected_' + self.task_names[position] for position in positions]].sum(axis=1)
+                columns['bin_' + self.name(positions)] = self.affected_in_all(std, positions).astype(int)
+        return pd.concat([table, pd.DataFrame(columns, index=table.index)], axis=1)
@@ -0,0 +1,121 @@
+import pandas as pd
+from paired_engine import classify_paired_diffs, affected_percentages, TaskCombinations, timepoint_array, \
+    contrast_diffs, contrast_percentages, paired_differences
+from exports import bundle
+from pipeline import EXPORT_CACHE_SIZE, loaded_frame, stage
+
+
+CONTRAST_CACHE_SIZE = 28  # every pair of 8 sessions, switching between the contrasts does not recompute them
+
+
+def task_parameter_groups(params):
+    # tasks and their parameter list, from the task prefix of the parameter names
+    task_groups = {}
+    for col in params:
+        task_name = col.split('_')[0]
+        if task_name not in task_groups:
+            task_groups[task_name] = []
+        task_groups[task_name].append(col)
+    return task_groups
+
+
+def grouped_differences(per_subject_diffs, delta_std=1.0):
+    # mean, count and scaled std of the differences of every parameter
+    grouped_diffs = pd.DataFrame()
+    grouped_diffs['mean'] = per_subject_diffs.mean()
+    grouped_diffs['count'] = per_subject_diffs.count()
+    grouped_diffs['std_' + str(delta_std)] = per_subject_diffs.std() * delta_std
+    return grouped_diffs
+
+
+@stage()
+def paired_diffs_stage(loaded, delta_std=1.0):
+    # tasks and their parameter list, and the differences per subject per parameter
+    data_df = loaded_frame(loaded)
+    group_col = loaded['group_col']
+    subject_col = loaded['subject_col']
+
+    # get tasks and their parameter list from file
+    task_groups = task_parameter_groups(data_df.columns[2:])
+
+    # for paired - calculate differences per subject per parameter
+    per_subject_diffs = paired_differences(data_df, group_col, subject_col)
+
+    return {'task_groups': task_groups, 'per_subject_diffs': per_subject_diffs,
+            'grouped_diffs': grouped_differences(per_subject_diffs, delta_std)}
+
+
+@stage()
+def timepoints_stage(loaded):
+    # longitudinal mode: the data pivoted once into a subjects x timepoints x parameters array, the group column
+    # holds the timepoints (sessions)
+    data_df = loaded_frame(loaded)
+    params = list(loaded['params'])
+    subjects, timepoints, values, present = timepoint_array(data_df, loaded['group_col'], loaded['subject_col'],
+                                                            params)
+    return {'subjects': subjects, 'timepoints': timepoints, 'values': values, 'present': present, 'params': params,
+            'task_groups': task_parameter_groups(params)}
+
+
+@stage(maxsize=CONTRAST_CACHE_SIZE)
+def contrast_diffs_stage(timepoints, earlier, later, delta_std=1.0):
+    # the differences per subject per parameter of one contrast (timepoint positions), in the paired_diffs_stage
+    # layout so the classification and the tables downstream are shared with the two timepoint analysis
+    diffs, included = contrast_diffs(timepoints['values'], timepoints['present'], [(earlier, later)])
+    per_subject_diffs = pd.DataFrame(diffs[0][included[0]], index=timepoints['subjects'][included[0]],
+                                     columns=timepoints['params'])
+    per_subject_diffs.index.name = timepoints['subjects'].name
+    return {'task_groups': timepoints['task_groups'], 'per_subject_diffs': per_subject_diffs,
+            'grouped_diffs': grouped_differences(per_subject_diffs, delta_std)}
+
+
+@stage()
+def contrast_overview_stage(timepoints, pairs, stds):
+    # percentage of subjects by number of affected parameters for all the contrasts and SD levels in one pass
+    diffs, included = contrast_diffs(timepoints['values'], timepoints['present'], pairs)
+    return {'percentages': contrast_percentages(diffs, included, stds)}
+
+
+@stage(maxsize=CONTRAST_CACHE_SIZE, persist=True)
+def paired_classify_stage(diffs, stds):
+    # affected subjects and parameters for all the SD levels, per task sums and percentages by number of parameters
+    per_subject_diffs = diffs['per_subject_diffs']
+    task_groups = diffs['task_groups']
+    grouped_diffs = diffs['grouped_diffs'].copy()
+    std_df = pd.DataFrame(index=range(1, len(grouped_diffs) + 1))
+    # classify all the subjects and parameters for every SD level at once
+    affected, affected_full, sign_counts = classify_paired_diffs(per_subject_diffs, stds)
+    for std in stds:
+        grouped_diffs['std_' + str(std)] = per_subject_diffs.std() * std
+        grouped_diffs[['+1', '-1', '0']] = sign_counts[std]
+
+        affected[std]['affected'] = affected[std].sum(axis=1)
+        affected_full[std]['affected'] = affected[std]['affected']
+        for task, groups in task_groups.items():
+            affected[std]['affected_' + task] = affected[std].loc[:, task_groups[task]].sum(axis=1)
+            affected_full[std]['affected_' + task] = affected[std]['affected_' + task]
+            affected_full[std]['bin_affected_' + task] = affected_full[std]['affected_' + task].astype(bool).astype(int)
+        grouped_diffs['affected'] = grouped_diffs['+1'] + grouped_diffs['-1']
+        std_df['{:.1f}'.format(std)] = affected_percentages(affected[std]['affected'], len(grouped_diffs))
+    return {'affected': affected,
+            'affected_full': affected_full,
+            'grouped_diffs': grouped_diffs,
+            'std_df': std_df,
+            'task_combinations': TaskCombinations(affected_full, task_groups.keys())}
+
+
+@stage(maxsize=EXPORT_CACHE_SIZE)
+def paired_csv_stage(classified, std, max_combination_size):
+    # csv of the affected table of one SD level with its task combinations, built only when a download is asked for
+    return {'csv': classified['task_combinations'].table(std, max_combination_size).to_csv().encode('utf-8')}
+
+
+@stage(maxsize=EXPORT_CACHE_SIZE)
+def paired_bundle_stage(classified, stds, max_combination_size, export_format):
+    # zip of the affected tables of every SD level, the percentages by number of parameters and the group differences
+    task_combinations = classified['task_combinations']
+    tables = {'affected_percentages': (classified['std_df'], True),
+              'grouped_diffs': (classified['grouped_diffs'], True)}
+    for std in stds:
+        tables['affected_sd_' + str(std)] = (task_combinations.table(std, max_combination_size), True)
+    return {'bundle': bundle(tables, export_format)}
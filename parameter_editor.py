@@ -0,0 +1,111 @@
+import numpy as np
+import pandas as pd
+from ingestion import read_template
+from profiling_engine import DIRECTIONS
+
+
+PAGE_SIZE = 100
+DIRECTION_ICONS = {'both': ':arrow_up_down:',
+                   'above control': ':arrow_up_small:',
+                   'below control': ':arrow_down_small:'}
+
+
+def task_of(param):
+    # task prefix of a parameter name, as in the paired analysis
+    return param.split('_')[0]
+
+
+def parameter_table(params, selected, directions, effects=None):
+    # one row per parameter with its task, inclusion and direction, and the standardized difference when known
+    table = pd.DataFrame({'parameter': list(params),
+                          'task': [task_of(param) for param in params],
+                          'selected': [selected[param] for param in params],
+                          'direction': [directions[param] for param in params]})
+    if effects is not None:
+        table['standardized difference'] = effects['standardized difference'].reindex(list(params)).to_numpy()
+    return table
+
+
+def filtered(table, text='', tasks=()):
+    # rows whose parameter name contains text (ignoring case) and whose task is one of tasks, all when empty
+    keep = np.ones(len(table), dtype=bool)
+    if text:
+        keep &= table['parameter'].str.contains(text, case=False, regex=False).to_numpy()
+    if tasks:
+        keep &= table['task'].isin(list(tasks)).to_numpy()
+    return table[keep]
+
+
+def page_of(table, page, page_size=PAGE_SIZE):
+    # the rows of one page, pages are numbered from 1
+    return table.iloc[(page - 1) * page_size:page * page_size]
+
+
+def parameter_editor(params, screened, directions, effects, state_key, page_size=PAGE_SIZE):
+    # one paginated table to select the parameters and set their directions, instead of a checkbox and a selectbox
+    # per parameter. inclusion defaults to the screened parameters, the user's changes are kept in the session
+    # state under state_key. returns the selected parameters (in params order) and the direction of every parameter
+    import streamlit as st
+    state = st.session_state.setdefault(state_key, {'selected': {}, 'directions': {}, 'version': 0,
+                                                    'template': None})
+    screened = set(screened)
+    selected = {param: state['selected'].get(param, param in screened) for param in params}
+    directions = {param: state['directions'].get(param, directions[param]) for param in params}
+
+    col1, col2 = st.columns(2)
+    text = col1.text_input('Filter parameters by name', key=state_key + '_text')
+    tasks = col2.multiselect('Tasks', list(dict.fromkeys(task_of(param) for param in params)),
+                             key=state_key + '_tasks')
+    shown = filtered(parameter_table(params, selected, directions), text, tasks)['parameter'].tolist()
+
+    # bulk changes of the shown parameters reset the table widget, so its own pending edits do not override them
+    col1, col2, col3, col4 = st.columns(4)
+    bulk = {}
+    if col1.button('Select shown', key=state_key + '_select'):
+        bulk = {'selected': True}
+    if col2.button('Clear shown', key=state_key + '_clear'):
+        bulk = {'selected': False}
+    direction = col3.selectbox('Direction of shown', DIRECTIONS, key=state_key + '_direction',
+                               label_visibility='collapsed')
+    if col4.button('Set direction of shown', key=state_key + '_set_direction'):
+        bulk = {'direction': direction}
+    template_file = st.file_uploader('Apply a directions preferences file', type='csv', key=state_key + '_template',
+                                     help='Directions of the parameters in the file are applied to the table')
+    if template_file is not None and state['template'] != (template_file.name, template_file.size):
+        state['template'] = (template_file.name, template_file.size)
+        template_df = read_template(template_file)
+        for param in template_df.columns:
+            if param in directions and template_df.loc[0, param] in DIRECTIONS:
+                directions[param] = state['directions'][param] = template_df.loc[0, param]
+        state['version'] += 1
+    for param in shown if bulk else []:
+        if 'selected' in bulk:
+            selected[param] = state['selected'][param] = bulk['selected']
+        else:
+            directions[param] = state['directions'][param] = bulk['direction']
+    if bulk:
+        state['version'] += 1
+
+    n_pages = max(1, -(-len(shown) // page_size))
+    page = 1
+    if n_pages > 1:
+        page = st.number_input('Page', 1, n_pages, 1, 1, key=state_key + '_page_' + str(n_pages),
+                               help=str(len(shown)) + ' parameters shown, ' + str(page_size) + ' per page')
+    table = page_of(parameter_table(shown, selected, directions, effects), int(page), page_size)
+    edited = st.data_editor(
+        table,
+        column_config={'selected': st.column_config.CheckboxColumn('selected'),
+                       'direction': st.column_config.SelectboxColumn('direction', options=DIRECTIONS,
+                                                                     required=True),
+                       'standardized difference': st.column_config.NumberColumn(format='%.2f')},
+        disabled=['parameter', 'task', 'standardized difference'],
+        hide_index=True,
+        use_container_width=True,
+        key='_'.join([state_key, 'table', str(state['version']), text, ','.join(tasks), str(page)]))
+
+    # keep the edits of this page
+    changed = (edited['selected'] != table['selected']) | (edited['direction'] != table['direction'])
+    for param, param_selected, param_direction in edited.loc[changed, ['parameter', 'selected', 'direction']].values:
+        selected[param] = state['selected'][param] = bool(param_selected)
+        directions[param] = state['directions'][param] = param_direction
+    return [param for param in params if selected[param]], directions
@@ -0,0 +1,346 @@
+import hashlib
+import threading
+from collections import OrderedDict
+from functools import wraps
+import numpy as np
+import pandas as pd
+from backends import get_backend
+from exports import bundle
+from group_stats import labeled, effect_sizes, screened
+from instrumentation import annotate, profiling
+from resampling import resampling_problem, significance
+from result_store import result_store
+from stability import control_stability
+from profiling_engine import group_indices, count_thresholds, threshold_curves, fine_sd_levels, find_max_of_max, \
+    curve_table, sparse_hits, param_lists, level_hit_counts, counts_at_level, corrected_affect_values, \
+    sorted_by_group, level_shares, sd_curves_table, param_tasks, task_hit_counts, subset_curves
+
+
+STAGE_CACHE_SIZE = 8
+EXPORT_CACHE_SIZE = 4
+FINGERPRINT_BLOCK = 1 << 20
+
+
+def fingerprint(*parts):
+    # stable hash of stage inputs: bytes, strings, numbers and (nested) tuples / lists / dicts of them
+    digest = hashlib.sha1()
+    for part in parts:
+        if isinstance(part, bytes):
+            digest.update(part)
+        elif isinstance(part, dict):
+            digest.update(fingerprint(*sorted(part.items(), key=repr)).encode())
+        elif isinstance(part, (tuple, list)):
+            digest.update(fingerprint(*part).encode())
+        else:
+            digest.update(repr(part).encode())
+        digest.update(b'\x00')
+    return digest.hexdigest()
+
+
+def file_fingerprint(data_file):
+    # content hash of an uploaded file or a path, read in blocks
+    digest = hashlib.sha1()
+    if hasattr(data_file, 'read'):
+        data_file.seek(0)
+        for block in iter(lambda: data_file.read(FINGERPRINT_BLOCK), b''):
+            digest.update(block)
+        data_file.seek(0)
+    else:
+        with open(data_file, 'rb') as file:
+            for block in iter(lambda: file.read(FINGERPRINT_BLOCK), b''):
+                digest.update(block)
+    return digest.hexdigest()
+
+
+class StageResult(dict):
+    # outputs of a stage together with the key they were computed for, so downstream stages are keyed on it.
+    # results are shared between reruns and sessions and must not be changed by the caller
+
+    def __init__(self, key, outputs):
+        super().__init__(outputs)
+        self.key = key
+
+
+def stage(maxsize=STAGE_CACHE_SIZE, persist=False):
+    # memoize a pipeline stage on its positional inputs, keeping the maxsize most recently used results.
+    # upstream StageResults are keyed by their own key, keyword arguments carry data that is not part of the key.
+    # with persist the results are also kept in the on-disk result store, so they outlive the process.
+    # cache hits are noted on the open instrumentation span, and a stage profiled with cProfile always recomputes
+    def decorator(function):
+        cache = OrderedDict()
+        lock = threading.Lock()
+
+        @wraps(function)
+        def wrapper(*inputs, **data):
+            key = fingerprint(function.__name__,
+                              *[part.key if isinstance(part, StageResult) else part for part in inputs])
+            with lock:
+                if key in cache and not profiling():
+                    cache.move_to_end(key)
+                    annotate(cached=True)
+                    return cache[key]
+            store = result_store() if persist and not profiling() else None
+            outputs = store.get(key) if store is not None else None
+            annotate(cached='disk' if outputs is not None else False)
+            if outputs is None:
+                outputs = function(*inputs, **data)
+                if store is not None:
+                    store.put(key, function.__name__, outputs)
+            result = StageResult(key, outputs)
+            with lock:
+                cache[key] = result
+                while len(cache) > maxsize:
+                    cache.popitem(last=False)
+            return result
+
+        wrapper.cache = cache
+        return wrapper
+
+    return decorator
+
+
+def load_data(backend_name, data_file):
+    # read and convert the data file and collect its group statistics with the backend. the frame is the backend's
+    # own, a query of the data file for a lazy backend. group_labels are the app's group names of the rows
+    backend = get_backend(backend_name)
+    frame, data_stats = backend.load(data_file)
+    columns = backend.columns(frame)
+    group_col = columns[0]
+    return {'frame': frame,
+            'stats': data_stats,
+            'group_col': group_col,
+            'subject_col': columns[1],
+            'params': columns[2:],
+            'group_labels': 'group_' + backend.select(frame, [group_col])[group_col].astype(str),
+            'backend': backend_name}
+
+
+@stage(maxsize=2, persist=True)
+def ingest_stage(file_key, backend_name, data_file=None):
+    # load_data of an eager backend, kept in the result store
+    return load_data(backend_name, data_file)
+
+
+@stage(maxsize=2)
+def scan_stage(file_key, backend_name, data_file=None):
+    # load_data of a lazy backend. its frame reads the data file by path and is not stored: a stored query would
+    # read whatever the path holds later under the key of the content it had
+    return load_data(backend_name, data_file)
+
+
+def load_stage(file_key, backend_name, data_file=None):
+    # the loaded data file, memoized on its content and the backend
+    if get_backend(backend_name).lazy:
+        return scan_stage(file_key, backend_name, data_file=data_file)
+    return ingest_stage(file_key, backend_name, data_file=data_file)
+
+
+def loaded_frame(loaded, columns=None):
+    # the loaded data, or some of its columns, as a pandas frame for the stages and widgets that need one
+    backend = get_backend(loaded['backend'])
+    if columns is None:
+        return backend.to_pandas(loaded['frame'])
+    return backend.select(loaded['frame'], columns)
+
+
+@stage()
+def stats_stage(loaded, params):
+    # group means and sd of the parameters, named as the groups in the app
+    return {'group_mean': labeled(loaded['stats']['mean']).loc[list(params)],
+            'group_std': labeled(loaded['stats']['std']).loc[list(params)]}
+
+
+@stage()
+def screen_stage(stats, groups, control_group, params, mean_difference, deviation_difference):
+    # find parameters that should be included, from the effect sizes of all groups and parameters at once
+    effects = effect_sizes(stats['group_mean'].loc[list(params)], stats['group_std'].loc[list(params)], control_group,
+                           groups)
+    effects['selected'] = screened(effects, mean_difference, deviation_difference)
+    selected = effects['selected'].reindex(list(params))
+    return {'selected': selected.index[selected].tolist(), 'effect_sizes': effects}
+
+
+@stage(persist=True)
+def sweep_stage(loaded, stats, groups, control_group, params, directions, counts, sd_step):
+    # find the sd that has the largest difference between control and experiment groups.
+    # the subject x parameter directional score matrix is built once by the backend, sorted per subject and searched
+    # over a fine SD range
+    groups = list(groups)
+    directional = get_backend(loaded['backend']).directional_scores(
+        loaded['frame'], loaded['group_col'], list(params), list(directions), stats['group_mean'][control_group],
+        stats['group_std'][control_group])[1]
+    group_index = group_indices(loaded['group_labels'], groups)
+    thresholds = count_thresholds(directional, group_index, len(groups), counts)
+    sd_levels = fine_sd_levels(sd_step)
+    max_of_max = find_max_of_max(threshold_curves(thresholds, sd_levels), groups.index(control_group), counts,
+                                 sd_levels)
+    group_len = {group: int((group_index == position).sum()) for position, group in enumerate(groups)}
+    return {'directional': directional,
+            'thresholds': thresholds,
+            'max_of_max': max_of_max,
+            'group_len': group_len}
+
+
+@stage(persist=True)
+def significance_stage(loaded, sweep, groups, control_group, params, directions, counts, sd_step, permutations,
+                       bootstraps, seed, progress=None, workers=None):
+    # permutation p-value and bootstrap confidence intervals of the optimal weighted maximum difference
+    groups = list(groups)
+    problem = resampling_problem(loaded_frame(loaded, params), params, directions,
+                                 group_indices(loaded['group_labels'], groups), len(groups), groups.index(control_group),
+                                 counts, fine_sd_levels(sd_step))
+    return significance(problem, sweep['max_of_max'], permutations, bootstraps, seed, workers, progress=progress)
+
+
+@stage(persist=True)
+def stability_stage(loaded, groups, control_group, params, directions, counts, sd_step, dev_high, num_of_params, folds,
+                    repeats, seed):
+    # the affected classification and the optimal result under leave-one-out (folds None) or k-fold resampling of
+    # the control group. the per subject shares are in the order of the data file, nan outside the groups
+    groups = list(groups)
+    group_index = group_indices(loaded['group_labels'], groups)
+    problem = resampling_problem(loaded_frame(loaded, params), params, directions, group_index, len(groups),
+                                 groups.index(control_group), counts, fine_sd_levels(sd_step))
+    stability = control_stability(problem, dev_high, num_of_params, folds, repeats, seed)
+    included = group_index >= 0
+    per_subject = {}
+    for name in ['stability', 'affected share']:
+        per_subject[name] = np.full(len(group_index), np.nan)
+        per_subject[name][included] = stability[name]
+    return {'stability': per_subject['stability'], 'affected share': per_subject['affected share'],
+            'optima': stability['optima']}
+
+
+@stage(persist=True)
+def classify_stage(loaded, sweep, groups, params, counts, dev_high):
+    # percentage curves and the affected parameters of every subject at the selected SD level. the subject x
+    # parameter flags are kept as compressed sparse rows, name lists are built only for the final table
+    true_columns = curve_table(threshold_curves(sweep['thresholds'], [dev_high])[0], counts, groups)
+    true_columns['Number of parameters'] = true_columns.index
+    hits = sweep['directional'] >= dev_high
+    return {'true_columns': true_columns,
+            'sum': hits.sum(axis=1),
+            'affected': sparse_hits(hits)}
+
+
+@stage(persist=True)
+def level_counts_stage(sweep, sd_step):
+    # hit counts of every subject on the whole SD grid, so the medium level of any (high, low) SD pair is a lookup
+    sd_levels = fine_sd_levels(sd_step)
+    return {'sd_levels': sd_levels, 'counts': level_hit_counts(sweep['directional'], sd_levels)}
+
+
+@stage(persist=True)
+def task_counts_stage(sweep, params, sd_step):
+    # hit counts of every subject per task on the whole SD grid, from the sweep's directional scores, so the counts
+    # of any subset of tasks are a sum of its tasks' counts
+    tasks, task_index = param_tasks(params)
+    sd_levels = fine_sd_levels(sd_step)
+    return {'tasks': tasks, 'sd_levels': sd_levels,
+            'counts': task_hit_counts(sweep['directional'], task_index, len(tasks), sd_levels)}
+
+
+@stage(persist=True)
+def task_sweep_stage(loaded, task_counts, groups, control_group, subsets, counts):
+    # percentage curves and the optimal result of every subset of tasks, all from one pass over the task counts
+    groups = list(groups)
+    tasks = task_counts['tasks']
+    membership = np.zeros((len(tasks), len(subsets)))
+    for position, subset in enumerate(subsets):
+        membership[[tasks.index(task) for task in subset], position] = 1
+    percentages = subset_curves(task_counts['counts'], membership, group_indices(loaded['group_labels'], groups),
+                                len(groups), counts)
+    return {'percentages': percentages,
+            'max_of_max': [find_max_of_max(subset_percentages, groups.index(control_group), counts,
+                                           task_counts['sd_levels']) for subset_percentages in percentages]}
+
+
+@stage(persist=True)
+def two_level_stage(loaded, sweep, level_counts, classify, groups, control_group, dev_high, dev_low):
+    # high and medium hit counts and the corrected affect value of every subject, sorted per group for the cut point
+    # sliders, with the default cut points
+    groups = list(groups)
+    n_params = sweep['directional'].shape[1]
+    group_index = group_indices(loaded['group_labels'], groups)
+    # 7. count the highly (SD >= dev_high) and medium (dev_low <= SD < dev_high) affected parameters
+    sum_high = classify['sum']
+    sum_med = np.maximum(counts_at_level(sweep['directional'], level_counts['counts'], level_counts['sd_levels'],
+                                         dev_low) - sum_high, 0)
+    # 8. calculate the correct value of affected for each subject
+    corrected = corrected_affect_values(sum_high, sum_med, n_params)
+    # 9. calculate low-med point by the mean and sd of 'affect_value_corrected' for control group
+    control_values = corrected[group_index == groups.index(control_group)]
+    medium_default = int(control_values.mean() + control_values.std(ddof=1))
+    # 10. calculate med-high point by the mean of remaining value' - (max + min) / 2
+    high_values = corrected[corrected > medium_default]
+    high_default = int((high_values.max() + high_values.min()) / 2)
+    return {'sum_high': sum_high,
+            'sum_med': sum_med,
+            'affect_value_corrected': corrected,
+            'sorted_corrected': dict(zip(groups, sorted_by_group(corrected, group_index, len(groups)))),
+            'medium_default': medium_default,
+            'high_default': high_default}
+
+
+@stage(persist=True)
+def final_table_stage(loaded, classify, params, num_of_params):
+    # final table of subjects and the sparse rows of their affected parameters, 1 level
+    final_table = loaded_frame(loaded, [loaded['group_col'], loaded['subject_col']]).copy()
+    final_table['Affected'] = classify['sum'] >= num_of_params
+    return {'final_table': final_table, 'params': {'Params': classify['affected'] + (list(params),)}}
+
+
+@stage(persist=True)
+def two_level_final_table_stage(loaded, sweep, classify, two_level, params, num_of_params, dev_high, dev_low):
+    # final table of subjects and the sparse rows of their highly and medium affected parameters, 2 levels
+    directional = sweep['directional']
+    final_table = loaded_frame(loaded, [loaded['group_col'], loaded['subject_col']]).copy()
+    final_table['Affected_high'] = two_level['sum_high'] >= num_of_params
+    final_table['Affected_med'] = (num_of_params >= two_level['sum_med']) & \
+                                  (two_level['sum_med'] >= int(num_of_params * (dev_low / dev_high)))
+    return {'final_table': final_table,
+            'params': {'Params_high': classify['affected'] + (list(params),),
+                       'Params_med': sparse_hits((directional >= dev_low) & (directional < dev_high)) +
+                       ([param + '_med' for param in params],)}}
+
+
+def param_table(final, sep=None):
+    # the final table with the list (or sep delimited string) of affected parameters of every subject, for display
+    # and export
+    final_table = final['final_table'].copy()
+    for column, (indptr, indices, names) in final['params'].items():
+        final_table[column] = param_lists(indptr, indices, names, sep)
+    return final_table
+
+
+@stage(maxsize=EXPORT_CACHE_SIZE)
+def param_table_stage(final, sep=None):
+    # param_table of final, the name lists are built once per final table and not on every rerun
+    return {'final_table': param_table(final, sep)}
+
+
+@stage(maxsize=EXPORT_CACHE_SIZE)
+def final_csv_stage(final, final_table=None):
+    # csv of the final table (param_table of final), built only when a download is asked for
+    return {'csv': final_table.to_csv(index=False)}
+
+
+@stage(maxsize=EXPORT_CACHE_SIZE)
+def profile_bundle_stage(final, sweep, groups, counts, sd_step, export_format, final_table=None):
+    # zip of the final table, the percentage curves of every SD level and the optimal result
+    sd_levels = fine_sd_levels(sd_step)
+    curves = sd_curves_table(threshold_curves(sweep['thresholds'], sd_levels), sd_levels, counts, groups)
+    tables = {'final_table': (final_table, False),
+              'sd_curves': (curves, False),
+              'max_of_max': (pd.DataFrame(sweep['max_of_max'], index=[0]), False)}
+    return {'bundle': bundle(tables, export_format)}
+
+
+def level_percentages(two_level, groups, group_len, medium_start, high_start):
+    # percentage of highly and medium affected subjects of every group for the selected cut points
+    percentages = {}
+    for group in groups:
+        highly_affected, medium_affected = level_shares(two_level['sorted_corrected'][group], group_len[group],
+                                                        medium_start, high_start)
+        percentages[group] = {'high': highly_affected, 'medium': medium_affected}
+    return percentages
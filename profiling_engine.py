@@ -0,0 +1,221 @@
+from itertools import combinations
+import numpy as np
+import pandas as pd
+
+
+COUNTS = [2, 3, 4, 5, 6, 7, 8, 9, 10, 11, 12, 13, 14, 15, 16, 17, 18, 19, 20]
+SD_LEVELS = [sd / 10 for sd in range(5, 21)]
+SD_RANGE = (0.5, 2.0)
+SD_STEP = 0.01
+DIRECTIONS = ['both', 'above control', 'below control']
+CONTROL_LIMIT = 20  # test for max difference only if control group value is under 20%
+LEVEL_BLOCK = 4096  # subjects binned at a time by level_hit_counts
+SUBSET_BLOCK = 8  # task subsets summed at a time by subset_curves
+
+
+def z_score_matrix(data_df, params, control_mean, control_std):
+    # subject x parameter matrix of standard scores against the control group mean and SD
+    values = data_df[params].to_numpy(dtype=float)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return (values - control_mean[params].to_numpy(dtype=float)) / control_std[params].to_numpy(dtype=float)
+
+
+def directional_scores(z_scores, directions):
+    # fold the three direction modes into one score, so a parameter is affected when its score >= sd:
+    # 'both' -> |z|, 'above control' -> z, 'below control' -> -z. parameters are on the last axis
+    directions = np.asarray(directions)
+    scores = np.where(directions == 'below control', -z_scores, z_scores)
+    both = directions == 'both'
+    scores[..., both] = np.abs(scores[..., both])
+    return scores
+
+
+def group_indices(group_labels, group_names):
+    # position of every subject's group in group_names, -1 for subjects outside the listed groups
+    return pd.Categorical(np.asarray(group_labels), categories=group_names).codes.astype(np.int64)
+
+
+def sparse_hits(hits):
+    # compressed sparse rows of a subjects x parameters hits matrix,
+    # subject i's affected parameters are indices[indptr[i]:indptr[i + 1]]
+    rows, indices = np.nonzero(hits)
+    indptr = np.concatenate([[0], np.cumsum(np.bincount(rows, minlength=hits.shape[0]))])
+    return indptr, indices
+
+
+def param_lists(indptr, indices, names, sep=None):
+    # per subject lists, or sep delimited strings, of affected parameter names. only built for display and export
+    per_subject = np.split(np.asarray(names, dtype=object)[indices], indptr[1:-1])[:len(indptr) - 1]
+    if sep is None:
+        return [names.tolist() for names in per_subject]
+    return [sep.join(names) for names in per_subject]
+
+
+def count_curves(sums, group_index, n_groups, counts):
+    # percentage of each group's subjects with at least `count` affected parameters, for every SD level.
+    # sums is a (levels x subjects) array of affected parameter counts
+    sums = np.asarray(sums, dtype=np.int64)
+    counts = np.asarray(counts, dtype=np.int64)
+    n_levels = sums.shape[0]
+    inside = group_index >= 0
+    width = int(max(sums.max(initial=0), counts.max(initial=0))) + 2
+    # histogram of sums per level and group, then a reversed cumulative sum gives the ">= count" totals
+    flat = (np.arange(n_levels)[:, np.newaxis] * n_groups + group_index[np.newaxis, inside]) * width + sums[:, inside]
+    histogram = np.bincount(flat.ravel(), minlength=n_levels * n_groups * width).reshape(n_levels, n_groups, width)
+    at_least = np.cumsum(histogram[:, :, ::-1], axis=2)[:, :, ::-1]
+    group_len = np.bincount(group_index[inside], minlength=n_groups)
+    # levels x counts x groups
+    return at_least[:, :, counts].transpose(0, 2, 1) / group_len * 100
+
+
+def find_max_of_max(percentages, control_position, counts, sd_levels=SD_LEVELS, limit=CONTROL_LIMIT):
+    # optimized and weighted maximum difference between control and groups over all SD levels and counts.
+    # percentages is the (levels x counts x groups) output of count_curves
+    counts = np.asarray(counts)
+    control = percentages[:, :, control_position]
+    max_diff = percentages.max(axis=2) - control
+    weighted = max_diff * counts
+    weighted = np.where(control <= limit, weighted, -np.inf)
+    max_of_max = {'SD': 0.5, '# of params': 0, 'max diff': 0, 'weighted': 0}
+    if weighted.size == 0:
+        return max_of_max
+    # the first level / count to reach the best weighted value wins, as in a sequential scan
+    best = np.unravel_index(np.argmax(weighted), weighted.shape)
+    if weighted[best] > max_of_max['weighted']:
+        max_of_max = {'SD': sd_levels[best[0]],
+                      '# of params': int(counts[best[1]]),
+                      'max diff': max_diff[best],
+                      'weighted': weighted[best]}
+    return max_of_max
+
+
+def curve_table(percentages, counts, group_names):
+    # counts x groups percentage table of one SD level, in the true_columns_dict layout
+    return pd.DataFrame(percentages, columns=list(group_names), index=pd.Index(counts, name='count').astype(int))
+
+
+def sd_curves_table(percentages, sd_levels, counts, group_names):
+    # long table of the percentage curves of every SD level: SD, count and one column per group
+    index = pd.MultiIndex.from_product([list(sd_levels), list(counts)], names=['SD', 'count'])
+    return pd.DataFrame(percentages.reshape(-1, len(group_names)), index=index, columns=list(group_names)) \
+        .reset_index()
+
+
+def fine_sd_levels(step=0.01, sd_range=SD_RANGE):
+    # evenly spaced SD levels, rounded so that the coarse levels (0.5, 0.6, ...) are hit exactly
+    decimals = max(0, int(np.ceil(-np.log10(step))))
+    n_steps = int(round((sd_range[1] - sd_range[0]) / step))
+    return [round(sd_range[0] + i * step, decimals) for i in range(n_steps + 1)]
+
+
+def count_thresholds(scores, group_index, n_groups, counts):
+    # sort each subject's directional scores once. the k-th highest score is the largest SD at which the subject
+    # still has k affected parameters, so per group and count these thresholds are kept in ascending order
+    counts = np.asarray(counts, dtype=np.int64)
+    ordered = -np.sort(-np.where(np.isnan(scores), -np.inf, scores), axis=1)
+    missing = int(counts.max(initial=0)) - ordered.shape[1]
+    if missing > 0:  # more counts than parameters, these counts are never reached
+        ordered = np.hstack([ordered, np.full((ordered.shape[0], missing), -np.inf)])
+    kth = ordered[:, counts - 1] if len(counts) else ordered[:, :0]
+    return [np.sort(kth[group_index == group], axis=0) for group in range(n_groups)]
+
+
+def threshold_curves(thresholds, sd_levels):
+    # percentage of each group with at least `count` affected parameters for any SD levels, by binary search
+    # over the sorted thresholds of count_thresholds. returns a levels x counts x groups array
+    sd_levels = np.asarray(sd_levels, dtype=float)
+    n_counts = thresholds[0].shape[1] if thresholds else 0
+    percentages = np.zeros((len(sd_levels), n_counts, len(thresholds)))
+    for group, group_thresholds in enumerate(thresholds):
+        group_len = group_thresholds.shape[0]
+        for count in range(n_counts):
+            below = np.searchsorted(group_thresholds[:, count], sd_levels, side='left')
+            percentages[:, count, group] = (group_len - below) / group_len * 100
+    return percentages
+
+
+def level_hit_counts(scores, sd_levels, block=LEVEL_BLOCK):
+    # number of parameters at or above every SD level for every subject, a levels x subjects array. each score is
+    # binned once by binary search over the levels and the bins are summed from the top, block subjects at a time
+    sd_levels = np.asarray(sd_levels, dtype=float)
+    n_subjects, n_params = scores.shape
+    n_bins = len(sd_levels) + 1
+    counts = np.empty((len(sd_levels), n_subjects), dtype=np.min_scalar_type(n_params))
+    for start in range(0, n_subjects, block):
+        part = scores[start:start + block]
+        bins = np.where(np.isnan(part), 0, np.searchsorted(sd_levels, part, side='right'))
+        rows = np.arange(part.shape[0])[:, np.newaxis] * n_bins
+        binned = np.bincount((rows + bins).ravel(), minlength=part.shape[0] * n_bins).reshape(-1, n_bins)
+        counts[:, start:start + block] = binned[:, ::-1].cumsum(axis=1)[:, ::-1][:, 1:].T
+    return counts
+
+
+def param_tasks(params):
+    # task names and the task of every parameter, from the task prefix of the parameter names
+    tasks = list(dict.fromkeys(str(param).split('_')[0] for param in params))
+    return tasks, np.array([tasks.index(str(param).split('_')[0]) for param in params], dtype=np.int64)
+
+
+def task_subsets(tasks, max_size, extra=()):
+    # every combination of up to max_size tasks, the extra subsets and all the tasks together, without repeats
+    subsets = [subset for size in range(1, max_size + 1) for subset in combinations(tasks, size)]
+    subsets += [tuple(task for task in tasks if task in subset) for subset in extra] + [tuple(tasks)]
+    return list(dict.fromkeys(subset for subset in subsets if subset))
+
+
+def task_hit_counts(scores, task_index, n_tasks, sd_levels, block=LEVEL_BLOCK):
+    # number of parameters of every task at or above every SD level for every subject, a levels x subjects x tasks
+    # array. as in level_hit_counts each score is binned once, and the bins of a subject's task are summed from the top
+    sd_levels = np.asarray(sd_levels, dtype=float)
+    n_subjects = scores.shape[0]
+    n_bins = len(sd_levels) + 1
+    task_size = int(np.bincount(task_index, minlength=n_tasks).max(initial=0))
+    counts = np.empty((len(sd_levels), n_subjects, n_tasks), dtype=np.min_scalar_type(task_size))
+    for start in range(0, n_subjects, block):
+        part = scores[start:start + block]
+        bins = np.where(np.isnan(part), 0, np.searchsorted(sd_levels, part, side='right'))
+        cells = (np.arange(part.shape[0])[:, np.newaxis] * n_tasks + task_index[np.newaxis, :]) * n_bins + bins
+        binned = np.bincount(cells.ravel(), minlength=part.shape[0] * n_tasks * n_bins) \
+            .reshape(part.shape[0], n_tasks, n_bins)
+        counts[:, start:start + block] = binned[:, :, ::-1].cumsum(axis=2)[:, :, ::-1][:, :, 1:].transpose(2, 0, 1)
+    return counts
+
+
+def subset_curves(task_counts, membership, group_index, n_groups, counts, block=SUBSET_BLOCK):
+    # percentage curves of task subsets, a subsets x levels x counts x groups array. the hit counts of the subsets
+    # are the per task counts times the tasks x subsets one-hot membership matrix, block subsets at a time
+    n_levels, n_subjects, n_tasks = task_counts.shape
+    flat = task_counts.reshape(-1, n_tasks).astype(np.float32)
+    membership = np.asarray(membership, dtype=np.float32)
+    curves = []
+    for start in range(0, membership.shape[1], block):
+        sums = np.rint(flat @ membership[:, start:start + block]).astype(np.int64)
+        for column in range(sums.shape[1]):
+            curves.append(count_curves(sums[:, column].reshape(n_levels, n_subjects), group_index, n_groups, counts))
+    return np.array(curves).reshape(membership.shape[1], n_levels, len(counts), n_groups)
+
+
+def counts_at_level(scores, level_counts, sd_levels, level):
+    # hit counts of one SD level, looked up on the precomputed grid when the level is one of its levels
+    position = int(np.abs(np.asarray(sd_levels) - level).argmin()) if len(sd_levels) else -1
+    if position >= 0 and np.isclose(sd_levels[position], level, rtol=0, atol=1e-9):
+        return level_counts[position].astype(np.int64)
+    return (scores >= level).sum(axis=1)
+
+
+def corrected_affect_values(high_counts, medium_counts, n_params):
+    # percentage of highly affected parameters plus half the percentage of medium affected ones
+    return high_counts / n_params * 100 + (medium_counts / n_params * 100) / 2
+
+
+def sorted_by_group(values, group_index, n_groups):
+    return [np.sort(values[group_index == group]) for group in range(n_groups)]
+
+
+def level_shares(sorted_values, group_len, medium_start, high_start):
+    # percentage of a group above the high cut point and between the two cut points, by binary search over the
+    # group's sorted corrected affect values
+    highly_affected = len(sorted_values) - np.searchsorted(sorted_values, high_start, side='right')
+    medium_affected = np.searchsorted(sorted_values, high_start, side='left') - \
+        np.searchsorted(sorted_values, medium_start, side='right')
+    return round(highly_affected / group_len * 100, 1), round(max(medium_affected, 0) / group_len * 100, 1)
@@ -0,0 +1,217 @@
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+import numpy as np
+from profiling_engine import CONTROL_LIMIT, directional_scores
+
+
+PERMUTATIONS = 1000
+BOOTSTRAPS = 1000
+BATCH_SIZE = 64
+BATCH_ELEMENTS = 1 << 23  # resamples x subjects x parameters held at once by one batch
+STOP_AFTER = 10  # besag-clifford: stop permuting once this many permutations reach the observed value
+CONFIDENCE = 0.95
+
+_problem = None
+
+
+def resampling_problem(data_df, params, directions, group_index, n_groups, control_position, counts, sd_levels):
+    # the arrays every resampled sweep needs, for the subjects of the included groups. values are centered per
+    # parameter (the z-scores do not change) and missing values are 0 so they drop out of the matrix products
+    included = group_index >= 0
+    values = data_df[list(params)].to_numpy(dtype=float)[included]
+    missing = np.isnan(values)
+    present = (~missing).sum(axis=0)
+    center = np.where(present > 0, np.where(missing, 0, values).sum(axis=0) / np.maximum(present, 1), 0)
+    return {'values': np.where(missing, 0, values - center),
+            'missing': missing,
+            'directions': np.asarray(directions),
+            'group_index': group_index[included],
+            'n_groups': n_groups,
+            'control_position': control_position,
+            'counts': np.asarray(counts, dtype=np.int64),
+            'sd_levels': np.asarray(sd_levels, dtype=float)}
+
+
+def weighted_control_statistics(values, present, weights):
+    # mean and sd (ddof=1) of every parameter for each row of subject weights - 0 / 1 membership for permutations,
+    # multiplicities for bootstraps - as three matrix products
+    counts = weights @ present
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mean = (weights @ values) / counts
+        variance = (weights @ values ** 2 - counts * mean ** 2) / (counts - 1)
+    return mean, np.sqrt(np.maximum(variance, 0))
+
+
+def resampled_scores(problem, mean, std):
+    # directional scores of the subjects against a batch of control statistics, a resamples x subjects x parameters
+    # array
+    values, missing = problem['values'], problem['missing']
+    with np.errstate(divide='ignore', invalid='ignore'):
+        z_scores = (values - mean[:, np.newaxis]) / std[:, np.newaxis]
+    z_scores[:, missing] = np.nan
+    return directional_scores(z_scores, problem['directions'])
+
+
+def resampled_percentages(problem, scores, weights):
+    # count_curves of a batch: the resamples x levels x counts x groups percentages of a batch of scores, with the
+    # subjects of every group weighted by a resamples x groups x subjects array
+    counts, sd_levels = problem['counts'], problem['sd_levels']
+    n_resamples, n_groups, _ = weights.shape
+
+    # k-th highest score of every subject, binned on the SD grid: bin b means affected at the first b levels
+    ordered = -np.sort(-np.where(np.isnan(scores), -np.inf, scores), axis=2)
+    missing_counts = int(counts.max()) - ordered.shape[2]
+    if missing_counts > 0:  # more counts than parameters, these counts are never reached
+        ordered = np.concatenate([ordered, np.full(ordered.shape[:2] + (missing_counts,), -np.inf)], axis=2)
+    bins = np.searchsorted(sd_levels, ordered[:, :, counts - 1], side='right')
+    n_bins = len(sd_levels) + 1
+    offsets = (np.arange(n_resamples)[:, np.newaxis, np.newaxis] * len(counts) + np.arange(len(counts))) * n_bins
+    index = (offsets + bins).ravel()
+
+    percentages = np.empty((n_resamples, len(sd_levels), len(counts), n_groups))
+    for group in range(n_groups):
+        group_weights = np.broadcast_to(weights[:, group, :, np.newaxis], bins.shape).ravel()
+        binned = np.bincount(index, weights=group_weights, minlength=n_resamples * len(counts) * n_bins)
+        binned = binned.reshape(n_resamples, len(counts), n_bins)
+        at_least = binned[:, :, ::-1].cumsum(axis=2)[:, :, ::-1][:, :, 1:]
+        group_len = weights[:, group].sum(axis=1)[:, np.newaxis, np.newaxis]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            percentages[..., group] = (at_least / group_len * 100).transpose(0, 2, 1)
+    return percentages
+
+
+def resampled_optima(problem, percentages, limit=CONTROL_LIMIT):
+    # find_max_of_max of every resample of a batch of percentages
+    counts, sd_levels = problem['counts'], problem['sd_levels']
+    n_resamples = percentages.shape[0]
+    control = percentages[..., problem['control_position']]
+    max_diff = (percentages.max(axis=3) - control).reshape(n_resamples, -1)
+    weighted = np.where(control <= limit, max_diff.reshape(control.shape) * counts, -np.inf).reshape(n_resamples, -1)
+    best = weighted.argmax(axis=1)
+    rows = np.arange(n_resamples)
+    better = weighted[rows, best] > 0
+    level, count = np.unravel_index(best, control.shape[1:])
+    return {'SD': np.where(better, sd_levels[level], 0.5),
+            '# of params': np.where(better, counts[count], 0),
+            'max diff': np.where(better, max_diff[rows, best], 0),
+            'weighted': np.where(better, weighted[rows, best], 0)}
+
+
+def resampled_max_of_max(problem, weights, limit=CONTROL_LIMIT):
+    # 'max diff' and 'weighted' of find_max_of_max over the SD grid for a batch of subject weightings, a
+    # resamples x groups x subjects array. the control statistics, z-scores and group curves of the whole batch are
+    # computed together
+    n_resamples = weights.shape[0]
+    if not len(problem['counts']):
+        return {'max diff': np.zeros(n_resamples), 'weighted': np.zeros(n_resamples)}
+    mean, std = weighted_control_statistics(problem['values'], (~problem['missing']).astype(float),
+                                            weights[:, problem['control_position']])
+    optima = resampled_optima(problem, resampled_percentages(problem, resampled_scores(problem, mean, std), weights),
+                              limit)
+    return {'max diff': optima['max diff'], 'weighted': optima['weighted']}
+
+
+def permutation_weights(rng, group_index, n_groups, size):
+    # group labels shuffled between the subjects, the group sizes are kept
+    labels = rng.permuted(np.tile(group_index, (size, 1)), axis=1)
+    return (labels[:, np.newaxis, :] == np.arange(n_groups)[:, np.newaxis]).astype(float)
+
+
+def bootstrap_weights(rng, group_index, n_groups, size):
+    # subjects drawn with replacement within their own group, as multiplicities
+    weights = np.zeros((size, n_groups, len(group_index)))
+    for group in range(n_groups):
+        members = np.flatnonzero(group_index == group)
+        if len(members):
+            weights[:, group, members] = rng.multinomial(len(members), np.full(len(members), 1 / len(members)),
+                                                         size=size)
+    return weights
+
+
+def resample_batch(problem, kind, seed, size):
+    # one batch of permutations or bootstraps from its own seeded random stream
+    rng = np.random.default_rng(seed)
+    make_weights = permutation_weights if kind == 'permutation' else bootstrap_weights
+    return resampled_max_of_max(problem, make_weights(rng, problem['group_index'], problem['n_groups'], size))
+
+
+def _set_problem(problem):
+    # worker initializer, the arrays are sent once per worker process instead of with every batch
+    global _problem
+    _problem = problem
+
+
+def _pooled_batch(kind, seed, size):
+    return resample_batch(_problem, kind, seed, size)
+
+
+def batch_sizes(total, size):
+    return [min(size, total - start) for start in range(0, total, size)]
+
+
+def significance(problem, observed, permutations=PERMUTATIONS, bootstraps=BOOTSTRAPS, seed=0, workers=None,
+                 batch_size=BATCH_SIZE, stop_after=STOP_AFTER, confidence=CONFIDENCE, progress=None):
+    # permutation p-value of the observed max_of_max and bootstrap confidence intervals of its 'max diff' and
+    # 'weighted'. batches run on a process pool (workers=1 runs them here) from SeedSequence children, so results
+    # only depend on the seed. permuting stops early (besag-clifford) once stop_after permutations reach the
+    # observed weighted value. progress is called with the done fraction
+    size = max(1, min(batch_size, BATCH_ELEMENTS // max(1, problem['values'].size)))
+    permutation_seeds, bootstrap_seeds = np.random.SeedSequence(seed).spawn(2)
+    jobs = [('permutation', batch, child) for batch, child in
+            zip(batch_sizes(permutations, size), permutation_seeds.spawn(len(batch_sizes(permutations, size))))]
+    jobs += [('bootstrap', batch, child) for batch, child in
+             zip(batch_sizes(bootstraps, size), bootstrap_seeds.spawn(len(batch_sizes(bootstraps, size))))]
+
+    executor = None
+    if workers == 1 or len(jobs) <= 1:
+        pending = [partial(resample_batch, problem, kind, child, batch) for kind, batch, child in jobs]
+    else:
+        executor = ProcessPoolExecutor(workers, initializer=_set_problem, initargs=(problem,))
+        pending = [executor.submit(_pooled_batch, kind, child, batch) for kind, batch, child in jobs]
+    results = {'permutation': [], 'bootstrap': []}
+    reached = 0
+    stopped_at = None
+    try:
+        for done, ((kind, batch, child), job) in enumerate(zip(jobs, pending), 1):
+            if kind == 'permutation' and stopped_at is not None:
+                if executor is not None:
+                    job.cancel()
+            else:
+                result = job.result() if executor is not None else job()
+                results[kind].append(result)
+                if kind == 'permutation':
+                    exceeds = np.cumsum(result['weighted'] >= observed['weighted']) + reached
+                    if stop_after and exceeds[-1] >= stop_after:
+                        position = int(np.argmax(exceeds >= stop_after))
+                        stopped_at = sum(len(part['weighted']) for part in results[kind][:-1]) + position + 1
+                    reached = int(exceeds[-1])
+            if progress is not None:
+                progress(done / len(jobs))
+    finally:
+        if executor is not None:
+            executor.shutdown(cancel_futures=True)
+
+    def collected(kind, statistic):
+        parts = [part[statistic] for part in results[kind]]
+        return np.concatenate(parts) if parts else np.empty(0)
+
+    permuted_weighted = collected('permutation', 'weighted')[:stopped_at]
+    permuted_max_diff = collected('permutation', 'max diff')[:stopped_at]
+    n_permutations = len(permuted_weighted)
+    if stopped_at is not None:
+        p_value = stop_after / stopped_at
+    else:
+        p_value = (int((permuted_weighted >= observed['weighted']).sum()) + 1) / (n_permutations + 1)
+    tail = (1 - confidence) / 2
+    summary = {'permutations': n_permutations,
+               'stopped early': stopped_at is not None,
+               'p-value': p_value if n_permutations else np.nan,
+               'p-value max diff': (int((permuted_max_diff >= observed['max diff']).sum()) + 1) / (n_permutations + 1)
+               if n_permutations else np.nan,
+               'bootstraps': bootstraps}
+    for statistic in ['max diff', 'weighted']:
+        resampled = collected('bootstrap', statistic)
+        low, high = np.quantile(resampled, [tail, 1 - tail]) if len(resampled) else (np.nan, np.nan)
+        summary[statistic + ' CI low'] = low
+        summary[statistic + ' CI high'] = high
+    return summary
@@ -0,0 +1,126 @@
+import os
+import pickle
+import shutil
+import sqlite3
+import threading
+import time
+import uuid
+import numpy as np
+
+
+STORE_DIR = os.environ.get('RESULT_STORE_DIR', 'result_store')
+STORE_LIMIT = int(os.environ.get('RESULT_STORE_LIMIT', 2 << 30))  # bytes on disk, 0 turns the store off
+STORE_VERSION = 2  # part of every key, bump it when the outputs of a persisted stage change
+INDEX_FILE = 'index.sqlite'
+VALUES_FILE = 'values.pkl'
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def entry_size(folder):
+    return sum(entry.stat().st_size for entry in os.scandir(folder) if entry.is_file())
+
+
+class ResultStore:
+    # stage outputs on disk, keyed by the stage key (a content hash of the data file and the settings, chained
+    # through the stages). every entry is a folder: numeric arrays as .npy files that are memory-mapped when read
+    # back, the other outputs in one pickle. a sqlite index keeps the size and last use of the entries, the least
+    # recently used are removed when the store grows over limit bytes. read arrays are read-only
+
+    def __init__(self, folder=STORE_DIR, limit=STORE_LIMIT):
+        self.folder = folder
+        self.limit = limit
+        self.lock = threading.Lock()
+        os.makedirs(folder, exist_ok=True)
+        with self.connect() as connection:
+            connection.execute('CREATE TABLE IF NOT EXISTS entries '
+                               '(key TEXT PRIMARY KEY, stage TEXT, bytes INTEGER, used REAL)')
+
+    def connect(self):
+        return sqlite3.connect(os.path.join(self.folder, INDEX_FILE), timeout=30)
+
+    def entry_folder(self, key):
+        return os.path.join(self.folder, key)
+
+    def get(self, key):
+        # the stored outputs of key, or None
+        key = str(STORE_VERSION) + '_' + key
+        folder = self.entry_folder(key)
+        with self.connect() as connection:
+            found = connection.execute('SELECT 1 FROM entries WHERE key = ?', (key,)).fetchone()
+            if found and not os.path.isdir(folder):
+                connection.execute('DELETE FROM entries WHERE key = ?', (key,))
+                return None
+            if not found:
+                return None
+            connection.execute('UPDATE entries SET used = ? WHERE key = ?', (time.time(), key))
+        try:
+            with open(os.path.join(folder, VALUES_FILE), 'rb') as file:
+                outputs, arrays = pickle.load(file)
+            for position, name in enumerate(arrays):
+                outputs[name] = np.load(os.path.join(folder, str(position) + '.npy'), mmap_mode='r')
+        except (OSError, EOFError, pickle.UnpicklingError):  # removed or half written by another process
+            return None
+        return outputs
+
+    def put(self, key, stage_name, outputs):
+        # write the outputs of a stage to a new folder and publish it with a rename
+        key = str(STORE_VERSION) + '_' + key
+        if os.path.isdir(self.entry_folder(key)):  # written by another session, or not indexed after a crash
+            with self.lock, self.connect() as connection:
+                connection.execute('INSERT OR IGNORE INTO entries VALUES (?, ?, ?, ?)',
+                                   (key, stage_name, entry_size(self.entry_folder(key)), time.time()))
+            return
+        staging = os.path.join(self.folder, 'writing_' + uuid.uuid4().hex)
+        os.makedirs(staging)
+        arrays = [name for name, value in outputs.items()
+                  if isinstance(value, np.ndarray) and value.dtype != object]
+        for position, name in enumerate(arrays):
+            np.save(os.path.join(staging, str(position) + '.npy'), outputs[name])
+        values = {name: value for name, value in outputs.items() if name not in arrays}
+        with open(os.path.join(staging, VALUES_FILE), 'wb') as file:
+            pickle.dump((values, arrays), file, protocol=pickle.HIGHEST_PROTOCOL)
+        size = entry_size(staging)
+        if size > self.limit:
+            shutil.rmtree(staging, ignore_errors=True)
+            return
+        try:
+            os.rename(staging, self.entry_folder(key))
+        except OSError:  # stored by another session meanwhile
+            shutil.rmtree(staging, ignore_errors=True)
+        with self.lock, self.connect() as connection:
+            connection.execute('INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?)',
+                               (key, stage_name, size, time.time()))
+            self.evict(connection)
+
+    def evict(self, connection):
+        # remove the least recently used entries until the store fits in its limit
+        total = connection.execute('SELECT COALESCE(SUM(bytes), 0) FROM entries').fetchone()[0]
+        for key, size in connection.execute('SELECT key, bytes FROM entries ORDER BY used').fetchall():
+            if total <= self.limit:
+                break
+            connection.execute('DELETE FROM entries WHERE key = ?', (key,))
+            shutil.rmtree(self.entry_folder(key), ignore_errors=True)
+            total -= size
+
+    def size(self):
+        with self.connect() as connection:
+            return connection.execute('SELECT COUNT(*), COALESCE(SUM(bytes), 0) FROM entries').fetchone()
+
+    def clear(self):
+        with self.lock, self.connect() as connection:
+            for key, in connection.execute('SELECT key FROM entries').fetchall():
+                shutil.rmtree(self.entry_folder(key), ignore_errors=True)
+            connection.execute('DELETE FROM entries')
+
+
+def result_store():
+    # the store of this process in STORE_DIR, None when it is turned off
+    global _store
+    if STORE_LIMIT <= 0:
+        return None
+    with _store_lock:
+        if _store is None:
+            _store = ResultStore()
+        return _store
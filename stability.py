@@ -0,0 +1,83 @@
+import numpy as np
+from resampling import BATCH_SIZE, BATCH_ELEMENTS, weighted_control_statistics, resampled_scores, \
+    resampled_percentages, resampled_optima
+
+
+FOLDS = 10
+REPEATS = 1
+STABILITY_MODES = ['leave-one-out', 'k-fold']
+
+
+def control_folds(n_control, folds=None, repeats=REPEATS, seed=0):
+    # the held out control subjects of every resample as (order, starts): resample r holds out the control subjects
+    # order[starts[r]:starts[r + 1]]. folds=None is leave-one-out, otherwise the control subjects are shuffled and
+    # split into folds nearly equal parts, repeats times
+    if folds is None:
+        return np.arange(n_control), np.arange(n_control)
+    folds = max(2, min(int(folds), n_control))
+    rng = np.random.default_rng(seed)
+    sizes = [len(fold) for fold in np.array_split(np.arange(n_control), folds)]
+    order = np.concatenate([rng.permutation(n_control) for _ in range(repeats)])
+    starts = np.concatenate([[0], np.cumsum(sizes * repeats)[:-1]])
+    return order, starts
+
+
+def held_out_statistics(values, present, order, starts):
+    # control mean and sd (ddof=1) with every fold held out in turn, as updates of the totals of all the control
+    # subjects: the sums of a fold are subtracted from the totals, a rank-one update per resample for leave-one-out.
+    # values are the centered control values with 0 for missing values, present their 0 / 1 mask
+    squares = values ** 2
+    counts = present.sum(axis=0) - np.add.reduceat(present[order], starts, axis=0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mean = (values.sum(axis=0) - np.add.reduceat(values[order], starts, axis=0)) / counts
+        variance = (squares.sum(axis=0) - np.add.reduceat(squares[order], starts, axis=0) - counts * mean ** 2) / \
+            (counts - 1)
+    return mean, np.sqrt(np.maximum(variance, 0))
+
+
+def control_stability(problem, dev_high, num_of_params, folds=None, repeats=REPEATS, seed=0, batch_size=BATCH_SIZE):
+    # the affected classification (num_of_params or more parameters at or above dev_high) and the optimal result
+    # recomputed with the control statistics of every leave-one-out or k-fold resample of the control group. the
+    # subjects are scored against a batch of resamples at once. returns the share of resamples in which every
+    # subject keeps its classification with all the control subjects, the share in which it is affected and the
+    # optimal result of every resample
+    values, present = problem['values'], (~problem['missing']).astype(float)
+    control = np.flatnonzero(problem['group_index'] == problem['control_position'])
+    if len(control) < 3:
+        raise ValueError('the control group needs at least 3 subjects to be resampled')
+    weights = (problem['group_index'] == np.arange(problem['n_groups'])[:, np.newaxis]).astype(float)[np.newaxis]
+
+    mean, std = weighted_control_statistics(values, present, weights[:, problem['control_position']])
+    affected = (resampled_scores(problem, mean, std) >= dev_high).sum(axis=2)[0] >= num_of_params
+    order, starts = control_folds(len(control), folds, repeats, seed)
+    mean, std = held_out_statistics(values[control], present[control], order, starts)
+
+    size = max(1, min(batch_size, BATCH_ELEMENTS // max(1, values.size)))
+    affected_count = np.zeros(len(affected))
+    optima = []
+    for start in range(0, len(starts), size):
+        scores = resampled_scores(problem, mean[start:start + size], std[start:start + size])
+        affected_count += ((scores >= dev_high).sum(axis=2) >= num_of_params).sum(axis=0)
+        if len(problem['counts']):
+            batch_weights = np.broadcast_to(weights, (scores.shape[0],) + weights.shape[1:])
+            optima.append(resampled_optima(problem, resampled_percentages(problem, scores, batch_weights)))
+    affected_share = affected_count / len(starts)
+    return {'affected': affected,
+            'stability': np.where(affected, affected_share, 1 - affected_share),
+            'affected share': affected_share,
+            'optima': {statistic: np.concatenate([part[statistic] for part in optima]) if optima else np.empty(0)
+                       for statistic in ['SD', '# of params', 'max diff', 'weighted']}}
+
+
+def optima_spread(optima, observed):
+    # the optimal result with all the control subjects and its spread over the resamples
+    spread = {}
+    for statistic, resampled in optima.items():
+        spread[statistic] = {'all controls': observed[statistic],
+                             'mean': resampled.mean() if len(resampled) else np.nan,
+                             'sd': resampled.std(ddof=1) if len(resampled) > 1 else np.nan,
+                             'min': resampled.min() if len(resampled) else np.nan,
+                             'max': resampled.max() if len(resampled) else np.nan,
+                             'same as all controls': (resampled == observed[statistic]).mean()
+                             if len(resampled) else np.nan}
+    return spread
@@ -0,0 +1,83 @@
+import io
+import numpy as np
+import pandas as pd
+import pytest
+from backends import get_backend
+from benchmarks.run_benchmarks import check_backends
+from benchmarks.synthetic_data import make_cohort, write_cohort
+from ingestion import ingest
+from pipeline import load_data, loaded_frame, stats_stage, sweep_stage
+from profiling_engine import COUNTS, SD_STEP
+
+# result equivalence of the computation backends with the pandas reference (the statistics the apps compute while
+# reading). run from the repository root: python -m pytest tests
+
+
+@pytest.fixture
+def polars():
+    return pytest.importorskip('polars')
+
+
+@pytest.fixture(params=['csv', 'parquet'])
+def cohort_files(request, tmp_path):
+    path = str(tmp_path / ('cohort.' + request.param))
+    paired_path = str(tmp_path / ('paired.' + request.param))
+    write_cohort(make_cohort(3, 40, 12, ('openfield', 'maze', 'social'), missing_rate=0.05, seed=1), path)
+    write_cohort(make_cohort(2, 40, 12, ('openfield', 'maze', 'social'), missing_rate=0.05, paired=True, seed=1),
+                 paired_path)
+    return path, paired_path
+
+
+def assert_statistics_equal(stats_a, stats_b, rtol=1e-9):
+    pd.testing.assert_series_equal(stats_a['size'], stats_b['size'], check_names=False, check_index_type=False)
+    for statistic in ['count', 'mean', 'std']:
+        pd.testing.assert_frame_equal(stats_a[statistic], stats_b[statistic], rtol=rtol, check_names=False,
+                                      check_column_type=False)
+
+
+def test_pandas_backend_statistics_are_the_ingestion_statistics(cohort_files):
+    path = cohort_files[0]
+    backend = get_backend('pandas')
+    data, stats = backend.load(path)
+    _, ingested = ingest(path)
+    assert_statistics_equal(stats, ingested, rtol=0)
+    assert_statistics_equal(backend.group_statistics(data, data.columns[0], data.columns[2:]), ingested, rtol=0)
+
+
+def test_polars_backend_agrees_with_pandas(polars, cohort_files):
+    assert check_backends(['polars'], *cohort_files) == []
+
+
+def test_pipeline_results_agree_between_backends(polars, cohort_files):
+    path = cohort_files[0]
+    results = []
+    for backend_name in ['pandas', 'polars']:
+        loaded = load_data(backend_name, path)
+        params = tuple(loaded['params'])
+        groups = tuple('group_' + str(group) for group in loaded['stats']['size'].index)
+        stats = stats_stage.__wrapped__(loaded, params)
+        directions = tuple(['both', 'above control', 'below control'][i % 3] for i in range(len(params)))
+        sweep = sweep_stage.__wrapped__(loaded, stats, groups, groups[0], params, directions,
+                                        tuple(COUNTS[:len(params)]), SD_STEP)
+        results.append((loaded, sweep))
+    (loaded_a, sweep_a), (loaded_b, sweep_b) = results
+    assert isinstance(loaded_b['frame'], polars.LazyFrame)  # the file is scored by the polars queries
+    pd.testing.assert_frame_equal(loaded_frame(loaded_a), loaded_frame(loaded_b), check_dtype=False)
+    pd.testing.assert_series_equal(loaded_a['group_labels'], loaded_b['group_labels'])
+    assert_statistics_equal(loaded_a['stats'], loaded_b['stats'])
+    np.testing.assert_allclose(sweep_a['directional'], sweep_b['directional'], rtol=1e-9)
+    for group_a, group_b in zip(sweep_a['thresholds'], sweep_b['thresholds']):
+        np.testing.assert_allclose(group_a, group_b, rtol=1e-9)
+    assert sweep_a['max_of_max'] == pytest.approx(sweep_b['max_of_max'])
+
+
+def test_polars_backend_reads_uploaded_files(polars, cohort_files):
+    path = cohort_files[0]
+    with open(path, 'rb') as file:
+        upload = io.BytesIO(file.read())
+    upload.name = 'upload' + path[path.rindex('.'):]
+    backend = get_backend('polars')
+    data, stats = backend.load(upload)
+    _, ingested = ingest(path)
+    assert_statistics_equal(stats, ingested)
+    assert len(backend.to_pandas(data)) == sum(stats['size'])
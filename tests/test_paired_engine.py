@@ -0,0 +1,92 @@
+import numpy as np
+import pandas as pd
+import pytest
+from benchmarks.synthetic_data import make_cohort
+from paired_engine import STDS, classify_paired_diffs, paired_differences, timepoint_array, contrast_diffs
+from paired_pipeline import paired_classify_stage, contrast_diffs_stage, task_parameter_groups, grouped_differences
+
+# the vectorized paired analysis against the iterrows classifier of the baseline app (paired_affected_v1.1.py), on
+# seeded data. run from the repository root: python -m pytest tests
+
+TASKS = ('openfield', 'maze', 'social')
+
+
+@pytest.fixture(params=[0, 1])
+def per_subject_diffs(request):
+    data_df = make_cohort(2, 25, 8, TASKS, missing_rate=0.05, paired=True, seed=request.param)
+    data_df.columns = [column.lower() for column in data_df.columns]
+    return paired_differences(data_df, data_df.columns[0], data_df.columns[1])
+
+
+def baseline_classification(per_subject_diffs, std):
+    # the baseline's classification of one SD level: every subject's difference against the mean +/- std * SD of
+    # its parameter, with the +1 / -1 / 0 counts per parameter
+    grouped_diffs = pd.DataFrame()
+    grouped_diffs['mean'] = per_subject_diffs.mean()
+    grouped_diffs['std_' + str(std)] = per_subject_diffs.std() * std
+    affected = per_subject_diffs.copy()
+    affected_full = per_subject_diffs.copy()
+    grouped_diffs['+1'] = 0
+    grouped_diffs['-1'] = 0
+    grouped_diffs['0'] = 0
+    for i, row in grouped_diffs.iterrows():
+        for j, subject in per_subject_diffs[i].dropna().items():
+            if (row['mean'] - row['std_' + str(std)] > subject) or (subject > row['mean'] + row['std_' + str(std)]):
+                affected.loc[j, i] = 1
+            else:
+                affected.loc[j, i] = 0
+            if subject > row['mean'] + row['std_' + str(std)]:
+                affected_full.loc[j, i] = 1
+                grouped_diffs.loc[i, '+1'] += 1
+            elif subject < row['mean'] - row['std_' + str(std)]:
+                affected_full.loc[j, i] = -1
+                grouped_diffs.loc[i, '-1'] += 1
+            else:
+                affected_full.loc[j, i] = 0
+                grouped_diffs.loc[i, '0'] += 1
+    return affected, affected_full, grouped_diffs[['+1', '-1', '0']]
+
+
+def test_classification_matches_the_baseline_at_every_sd(per_subject_diffs):
+    affected, affected_full, sign_counts = classify_paired_diffs(per_subject_diffs, STDS)
+    for std in STDS:
+        baseline_affected, baseline_full, baseline_counts = baseline_classification(per_subject_diffs, std)
+        pd.testing.assert_frame_equal(affected[std], baseline_affected)
+        pd.testing.assert_frame_equal(affected_full[std], baseline_full)
+        pd.testing.assert_frame_equal(sign_counts[std], baseline_counts, check_dtype=False)
+
+
+def test_percentages_match_the_baseline(per_subject_diffs):
+    task_groups = task_parameter_groups(per_subject_diffs.columns)
+    classified = paired_classify_stage.__wrapped__({'task_groups': task_groups,
+                                                    'per_subject_diffs': per_subject_diffs,
+                                                    'grouped_diffs': grouped_differences(per_subject_diffs)},
+                                                   tuple(STDS))
+    for std in STDS:
+        affected = baseline_classification(per_subject_diffs, std)[0]
+        sums = affected.sum(axis=1)
+        for parameters in range(1, len(per_subject_diffs.columns) + 1):
+            assert classified['std_df'].loc[parameters, '{:.1f}'.format(std)] == \
+                pytest.approx(len(affected.loc[sums >= parameters]) / len(per_subject_diffs) * 100)
+        for task, params in task_groups.items():
+            np.testing.assert_array_equal(classified['affected'][std]['affected_' + task],
+                                          affected[params].sum(axis=1))
+
+
+@pytest.mark.parametrize('seed', [0, 1])
+def test_contrast_of_two_sessions_matches_the_paired_differences(seed):
+    data_df = make_cohort(2, 25, 8, TASKS, missing_rate=0.05, paired=True, seed=seed)
+    data_df.columns = [column.lower() for column in data_df.columns]
+    group_col, subject_col = data_df.columns[:2]
+    # subjects without their first or their second session are in neither
+    data_df = data_df.drop(data_df.index[[3, 10, 25 + 7, 25 + 18]]).reset_index(drop=True)
+    per_subject_diffs = paired_differences(data_df, group_col, subject_col)
+    params = list(data_df.columns[2:])
+    subjects, timepoints, values, present = timepoint_array(data_df, group_col, subject_col, params)
+    assert timepoints == [0, 1]
+    diffs, included = contrast_diffs(values, present, [(0, 1)])
+    assert included.sum() == len(per_subject_diffs) == 21
+    contrast = contrast_diffs_stage.__wrapped__({'subjects': subjects, 'values': values, 'present': present,
+                                                 'params': params, 'task_groups': task_parameter_groups(params)}, 0, 1)
+    pd.testing.assert_frame_equal(contrast['per_subject_diffs'], per_subject_diffs)
+    pd.testing.assert_frame_equal(contrast['grouped_diffs'], grouped_differences(per_subject_diffs))
@@ -0,0 +1,214 @@
+import numpy as np
+import pandas as pd
+import pytest
+from benchmarks.synthetic_data import make_cohort
+from profiling_engine import COUNTS, SD_LEVELS, SD_STEP, z_score_matrix, directional_scores, group_indices, \
+    count_curves, find_max_of_max, count_thresholds, threshold_curves, fine_sd_levels, level_shares, param_tasks, \
+    task_subsets, task_hit_counts, subset_curves
+from pipeline import level_counts_stage, two_level_stage
+
+# the vectorized profiling engine against the loops of the baseline app (behavioral_profiling_v1.0.py), on seeded
+# data. run from the repository root: python -m pytest tests
+
+TASKS = ('openfield', 'maze', 'social')
+
+
+@pytest.fixture(params=[0, 1, 2])
+def cohort(request):
+    # 3 groups with missing values, the directions cycle through the three modes. the first group is the control
+    data_df = make_cohort(3, 30, 10, TASKS, missing_rate=0.05, seed=request.param)
+    params = list(data_df.columns[2:])
+    directions = [['both', 'above control', 'below control'][i % 3] for i in range(len(params))]
+    return data_df, params, directions
+
+
+def group_statistics(data_df, params):
+    # the baseline's group means and sd, one column per group value
+    group_col = data_df.columns[0]
+    group_mean = pd.DataFrame()
+    group_std = pd.DataFrame()
+    for group in data_df[group_col].unique():
+        group_mean[group] = data_df[data_df[group_col] == group][params].mean()
+        group_std[group] = data_df[data_df[group_col] == group][params].std()
+    return group_mean, group_std
+
+
+def baseline_sweep(data_df, params, directions, sd_levels, counts=None):
+    # the baseline's sd loop: the affected flags of every parameter, the percentage of every group with at least
+    # count affected parameters and the optimum kept over the levels. returns {sd: counts x groups table}, max_of_max
+    group_col, subject_col = data_df.columns[:2]
+    group_mean, group_std = group_statistics(data_df, params)
+    groups = list(group_mean.columns)
+    control_group = groups[0]
+    counts = COUNTS[:len(params)] if counts is None else counts
+    max_of_max = {'SD': 0.5, '# of params': 0, 'max diff': 0, 'weighted': 0}
+    true_columns_dict = {}
+    for sd in sd_levels:
+        true_columns_dict[sd] = pd.DataFrame({'count': counts}).set_index('count')
+        true_false = data_df[[group_col, subject_col]].copy()
+        for param, direction in zip(params, directions):
+            standard_param_col = (data_df[param] - group_mean[control_group][param]) / group_std[control_group][param]
+            if direction == 'both':
+                true_false[param] = abs(standard_param_col) >= sd
+            elif direction == 'above control':
+                true_false[param] = standard_param_col >= sd
+            else:
+                true_false[param] = standard_param_col <= -sd
+        true_false['sum'] = true_false[params].sum(axis=1)
+        for group in groups:
+            group_len = data_df[data_df[group_col] == group].shape[0]
+            percentages = []
+            for count in true_columns_dict[sd].index:
+                percentages.append(true_false[(true_false['sum'] >= count) & (true_false[group_col] == group)]
+                                   .count()['sum'] / group_len * 100)
+            true_columns_dict[sd][group] = percentages
+        cut = true_columns_dict[sd][true_columns_dict[sd][control_group] <= 20].copy()
+        cut['max_diff'] = cut[groups].max(axis=1) - cut[control_group]
+        cut['weighted'] = cut['max_diff'] * cut.index
+        if cut['weighted'].max() > max_of_max['weighted']:
+            max_index = cut['weighted'].idxmax()
+            max_of_max = {'SD': sd, '# of params': int(max_index), 'max diff': cut.loc[max_index, 'max_diff'],
+                          'weighted': cut.loc[max_index, 'weighted']}
+    return true_columns_dict, max_of_max
+
+
+def engine_scores(data_df, params, directions):
+    # the directional scores of every subject and parameter and the subjects' group positions, control first
+    group_mean, group_std = group_statistics(data_df, params)
+    control_group = group_mean.columns[0]
+    z_scores = z_score_matrix(data_df, params, group_mean[control_group], group_std[control_group])
+    return directional_scores(z_scores, directions), group_indices(data_df[data_df.columns[0]], list(group_mean))
+
+
+def assert_same_curves(percentages, true_columns_dict, sd_levels):
+    for level, sd in enumerate(sd_levels):
+        np.testing.assert_allclose(percentages[level], true_columns_dict[sd].to_numpy(), rtol=1e-12)
+
+
+def test_count_curves_match_the_baseline_loop(cohort):
+    data_df, params, directions = cohort
+    true_columns_dict, max_of_max = baseline_sweep(data_df, params, directions, SD_LEVELS)
+    scores, group_index = engine_scores(data_df, params, directions)
+    counts = COUNTS[:len(params)]
+    sums = np.array([(scores >= sd).sum(axis=1) for sd in SD_LEVELS])
+    percentages = count_curves(sums, group_index, 3, counts)
+    assert_same_curves(percentages, true_columns_dict, SD_LEVELS)
+    assert find_max_of_max(percentages, 0, counts, SD_LEVELS) == pytest.approx(max_of_max)
+
+
+def test_directional_scores_match_the_baseline_flags(cohort):
+    data_df, params, directions = cohort
+    scores, _ = engine_scores(data_df, params, directions)
+    group_mean, group_std = group_statistics(data_df, params)
+    control_group = group_mean.columns[0]
+    for position, (param, direction) in enumerate(zip(params, directions)):
+        z_score = (data_df[param] - group_mean[control_group][param]) / group_std[control_group][param]
+        for sd in [0.5, 1.0, 1.5]:
+            if direction == 'both':
+                flags = abs(z_score) >= sd
+            elif direction == 'above control':
+                flags = z_score >= sd
+            else:
+                flags = z_score <= -sd
+            np.testing.assert_array_equal(scores[:, position] >= sd, flags.to_numpy())
+
+
+@pytest.mark.parametrize('cohort', [0], indirect=True)  # the baseline loop takes a few seconds on the 151 levels
+def test_threshold_search_matches_the_baseline_loop_on_the_fine_grid(cohort):
+    data_df, params, directions = cohort
+    sd_levels = fine_sd_levels(SD_STEP)
+    true_columns_dict, max_of_max = baseline_sweep(data_df, params, directions, sd_levels)
+    scores, group_index = engine_scores(data_df, params, directions)
+    counts = COUNTS[:len(params)]
+    percentages = threshold_curves(count_thresholds(scores, group_index, 3, counts), sd_levels)
+    assert_same_curves(percentages, true_columns_dict, sd_levels)
+    assert find_max_of_max(percentages, 0, counts, sd_levels) == pytest.approx(max_of_max)
+
+
+def test_counts_beyond_the_parameters_are_never_reached(cohort):
+    data_df, params, directions = cohort
+    params = params[:3]
+    counts = COUNTS[:5]
+    true_columns_dict, max_of_max = baseline_sweep(data_df, params, directions[:3], SD_LEVELS, counts)
+    scores, group_index = engine_scores(data_df, params, directions[:3])
+    percentages = threshold_curves(count_thresholds(scores, group_index, 3, counts), SD_LEVELS)
+    assert_same_curves(percentages, true_columns_dict, SD_LEVELS)
+    assert find_max_of_max(percentages, 0, counts, SD_LEVELS) == pytest.approx(max_of_max)
+
+
+def baseline_two_levels(data_df, params, directions, dev_high, dev_low):
+    # the baseline's highly (>= dev_high) and medium (dev_low <= score < dev_high) affected counts, with the medium
+    # flags of every parameter, and the corrected affect values
+    group_mean, group_std = group_statistics(data_df, params)
+    control_group = group_mean.columns[0]
+    high = pd.DataFrame(index=data_df.index)
+    medium = pd.DataFrame(index=data_df.index)
+    for param, direction in zip(params, directions):
+        standard_param_col = (data_df[param] - group_mean[control_group][param]) / group_std[control_group][param]
+        if direction == 'both':
+            high[param] = abs(standard_param_col) >= dev_high
+            medium[param] = (abs(standard_param_col) < dev_high) & (abs(standard_param_col) >= dev_low)
+        elif direction == 'above control':
+            high[param] = standard_param_col >= dev_high
+            medium[param] = (standard_param_col < dev_high) & (standard_param_col >= dev_low)
+        else:
+            high[param] = standard_param_col <= -dev_high
+            medium[param] = (standard_param_col > -dev_high) & (standard_param_col <= -dev_low)
+    sum_high = high.sum(axis=1)
+    sum_med = medium.sum(axis=1)
+    corrected = sum_high / len(params) * 100 + (sum_med / len(params) * 100) / 2
+    return sum_high, sum_med, corrected
+
+
+@pytest.mark.parametrize('dev_high, dev_low', [(1.2, 0.84), (1.0, 0.7), (1.5, 1.0 / 3)])  # the last one off the grid
+def test_two_level_shares_match_the_baseline_filters(cohort, dev_high, dev_low):
+    data_df, params, directions = cohort
+    sum_high, sum_med, corrected = baseline_two_levels(data_df, params, directions, dev_high, dev_low)
+    scores, group_index = engine_scores(data_df, params, directions)
+    group_col = data_df.columns[0]
+    groups = list(data_df[group_col].unique())
+    sweep = {'directional': scores}
+    two_level = two_level_stage.__wrapped__({'group_labels': data_df[group_col]}, sweep,
+                                            level_counts_stage.__wrapped__(sweep, SD_STEP),
+                                            {'sum': (scores >= dev_high).sum(axis=1)}, groups, groups[0], dev_high,
+                                            dev_low)
+    np.testing.assert_array_equal(two_level['sum_high'], sum_high)
+    np.testing.assert_array_equal(two_level['sum_med'], sum_med)
+    np.testing.assert_allclose(two_level['affect_value_corrected'], corrected, rtol=1e-12)
+
+    control_values = corrected[data_df[group_col] == groups[0]]
+    medium_default = int(control_values.mean() + control_values.std())
+    high_series = corrected[corrected > medium_default]
+    high_default = int((high_series.max() + high_series.min()) / 2)
+    assert (two_level['medium_default'], two_level['high_default']) == (medium_default, high_default)
+
+    cut_points = [(medium_default, high_default + 1), (0, 100), (10, 10), (40, 20)] + \
+        [(value, value + 5) for value in sorted(set(corrected))[:3]]
+    for medium_start, high_start in cut_points:
+        for group in groups:
+            in_group = data_df[group_col] == group
+            group_len = int(in_group.sum())
+            highly_affected = round(corrected[(corrected > high_start) & in_group].count() / group_len * 100, 1)
+            medium_affected = round(corrected[(corrected < high_start) & (corrected > medium_start) & in_group]
+                                    .count() / group_len * 100, 1)
+            assert level_shares(two_level['sorted_corrected'][group], group_len, medium_start, high_start) == \
+                (highly_affected, medium_affected)
+
+
+@pytest.mark.parametrize('cohort', [0], indirect=True)  # one baseline loop per subset
+def test_subset_curves_match_the_baseline_loop_on_the_subset_parameters(cohort):
+    data_df, params, directions = cohort
+    scores, group_index = engine_scores(data_df, params, directions)
+    tasks, task_index = param_tasks(params)
+    subsets = task_subsets(tasks, 2)
+    membership = np.array([[task in subset for subset in subsets] for task in tasks])
+    counts = COUNTS[:len(params)]
+    curves = subset_curves(task_hit_counts(scores, task_index, len(tasks), SD_LEVELS), membership, group_index, 3,
+                           counts, block=2)
+    assert len(subsets) == 7
+    for subset, percentages in zip(subsets, curves):
+        in_subset = np.isin(task_index, [tasks.index(task) for task in subset])
+        true_columns_dict, max_of_max = baseline_sweep(data_df, list(np.array(params)[in_subset]),
+                                                       list(np.array(directions)[in_subset]), SD_LEVELS, counts)
+        assert_same_curves(percentages, true_columns_dict, SD_LEVELS)
+        assert find_max_of_max(percentages, 0, counts, SD_LEVELS) == pytest.approx(max_of_max)
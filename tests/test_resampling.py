@@ -0,0 +1,61 @@
+import numpy as np
+import pytest
+from benchmarks.synthetic_data import make_cohort
+from profiling_engine import COUNTS, SD_STEP, z_score_matrix, directional_scores, group_indices, count_thresholds, \
+    threshold_curves, fine_sd_levels, find_max_of_max
+from resampling import resampling_problem, resampled_max_of_max, significance
+
+# the batched resampling against the observed sweep and its own results on other process pools, on seeded data.
+# run from the repository root: python -m pytest tests
+
+
+@pytest.fixture(params=[0, 1])
+def cohort(request):
+    data_df = make_cohort(3, 30, 10, ('openfield', 'maze', 'social'), missing_rate=0.05, seed=request.param)
+    params = list(data_df.columns[2:])
+    directions = [['both', 'above control', 'below control'][i % 3] for i in range(len(params))]
+    groups = list(data_df[data_df.columns[0]].unique())
+    group_index = group_indices(data_df[data_df.columns[0]], groups)
+    counts = COUNTS[:len(params)]
+    problem = resampling_problem(data_df, params, directions, group_index, len(groups), 0, counts,
+                                 fine_sd_levels(SD_STEP))
+    return data_df, params, directions, group_index, problem
+
+
+def observed_max_of_max(data_df, params, directions, group_index):
+    # the sweep of the app: scores against the control statistics, then the optimum over the fine SD grid
+    control = data_df[group_index == 0][params]
+    scores = directional_scores(z_score_matrix(data_df, params, control.mean(), control.std()), directions)
+    counts = COUNTS[:len(params)]
+    sd_levels = fine_sd_levels(SD_STEP)
+    percentages = threshold_curves(count_thresholds(scores, group_index, 3, counts), sd_levels)
+    return find_max_of_max(percentages, 0, counts, sd_levels)
+
+
+def test_identity_weights_give_the_observed_optimum(cohort):
+    data_df, params, directions, group_index, problem = cohort
+    observed = observed_max_of_max(data_df, params, directions, group_index)
+    assert observed['weighted'] > 0
+    identity = (group_index == np.arange(3)[:, np.newaxis]).astype(float)[np.newaxis]
+    resampled = resampled_max_of_max(problem, np.repeat(identity, 2, axis=0))
+    np.testing.assert_allclose(resampled['max diff'], observed['max diff'], rtol=1e-9)
+    np.testing.assert_allclose(resampled['weighted'], observed['weighted'], rtol=1e-9)
+
+
+def test_significance_does_not_depend_on_the_workers(cohort):
+    data_df, params, directions, group_index, problem = cohort
+    observed = observed_max_of_max(data_df, params, directions, group_index)
+    results = [significance(problem, observed, permutations=80, bootstraps=60, seed=3, workers=workers,
+                            batch_size=16, stop_after=0) for workers in [1, 2]]
+    assert results[0]['permutations'] == 80
+    assert results[0] == pytest.approx(results[1], nan_ok=True)
+    assert significance(problem, observed, 80, 60, seed=3, workers=1, batch_size=16, stop_after=0) == results[0]
+
+
+def test_early_stopping_does_not_depend_on_the_workers(cohort):
+    data_df, params, directions, group_index, problem = cohort
+    observed = dict(observed_max_of_max(data_df, params, directions, group_index), weighted=0)  # every one reaches
+    results = [significance(problem, observed, permutations=200, bootstraps=0, seed=5, workers=workers,
+                            batch_size=16, stop_after=10) for workers in [1, 2]]
+    assert results[0]['stopped early'] and results[0]['permutations'] == 10
+    assert results[0] == pytest.approx(results[1], nan_ok=True)
@@ -0,0 +1,71 @@
+import numpy as np
+import pytest
+from benchmarks.synthetic_data import make_cohort
+from profiling_engine import COUNTS, SD_STEP, z_score_matrix, directional_scores, group_indices, count_thresholds, \
+    threshold_curves, fine_sd_levels, find_max_of_max
+from resampling import resampling_problem
+from stability import control_folds, control_stability
+
+# the control resampling of the stability analysis against refits with the held out control subjects dropped, on
+# seeded data. run from the repository root: python -m pytest tests
+
+
+@pytest.fixture(params=[0, 1])
+def cohort(request):
+    data_df = make_cohort(3, 30, 10, ('openfield', 'maze', 'social'), missing_rate=0.05, seed=request.param)
+    params = list(data_df.columns[2:])
+    directions = [['both', 'above control', 'below control'][i % 3] for i in range(len(params))]
+    group_index = group_indices(data_df[data_df.columns[0]], list(data_df[data_df.columns[0]].unique()))
+    problem = resampling_problem(data_df, params, directions, group_index, 3, 0, COUNTS[:len(params)],
+                                 fine_sd_levels(SD_STEP))
+    return data_df, params, directions, group_index, problem
+
+
+def refit(data_df, params, directions, group_index, control, dev_high, num_of_params):
+    # the affected flags and the optimum with the control statistics of the given control rows, as the app computes
+    # them with all the control subjects
+    scores = directional_scores(z_score_matrix(data_df, params, data_df.iloc[control][params].mean(),
+                                               data_df.iloc[control][params].std()), directions)
+    counts = COUNTS[:len(params)]
+    sd_levels = fine_sd_levels(SD_STEP)
+    percentages = threshold_curves(count_thresholds(scores, group_index, 3, counts), sd_levels)
+    return (scores >= dev_high).sum(axis=1) >= num_of_params, find_max_of_max(percentages, 0, counts, sd_levels)
+
+
+def assert_same_as_refits(stability, data_df, params, directions, group_index, order, starts, dev_high,
+                          num_of_params):
+    control = np.flatnonzero(group_index == 0)
+    affected, _ = refit(data_df, params, directions, group_index, control, dev_high, num_of_params)
+    np.testing.assert_array_equal(stability['affected'], affected)
+    affected_count = np.zeros(len(data_df))
+    for resample, (start, stop) in enumerate(zip(starts, list(starts[1:]) + [len(order)])):
+        kept = np.delete(control, order[start:stop])
+        held_out_affected, max_of_max = refit(data_df, params, directions, group_index, kept, dev_high, num_of_params)
+        affected_count += held_out_affected
+        assert stability['optima']['SD'][resample] == pytest.approx(max_of_max['SD'])
+        assert stability['optima']['# of params'][resample] == max_of_max['# of params']
+        assert stability['optima']['max diff'][resample] == pytest.approx(max_of_max['max diff'])
+        assert stability['optima']['weighted'][resample] == pytest.approx(max_of_max['weighted'])
+    np.testing.assert_allclose(stability['affected share'], affected_count / len(starts))
+    np.testing.assert_allclose(stability['stability'], np.where(affected, affected_count, len(starts) -
+                                                                affected_count) / len(starts))
+
+
+@pytest.mark.parametrize('dev_high, num_of_params', [(1.2, 2), (0.8, 4)])
+def test_leave_one_out_matches_the_refits(cohort, dev_high, num_of_params):
+    data_df, params, directions, group_index, problem = cohort
+    stability = control_stability(problem, dev_high, num_of_params, batch_size=7)
+    assert len(stability['optima']['SD']) == 30
+    order, starts = control_folds(30)
+    assert_same_as_refits(stability, data_df, params, directions, group_index, order, starts, dev_high,
+                          num_of_params)
+
+
+def test_k_fold_matches_the_refits(cohort):
+    data_df, params, directions, group_index, problem = cohort
+    stability = control_stability(problem, 1.2, 2, folds=4, repeats=2, seed=1, batch_size=3)
+    order, starts = control_folds(30, 4, 2, seed=1)
+    assert len(starts) == 8
+    for repeat in range(2):  # every repeat splits the control subjects into the folds
+        assert sorted(order[repeat * 30:(repeat + 1) * 30]) == list(range(30))
+    assert_same_as_refits(stability, data_df, params, directions, group_index, order, starts, 1.2, 2)